@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Persistent, size-bounded cache of downloaded HRRR files
+#
+# Files are stored under a content address derived from (cycle, fhr, product, message subset), so
+# reruns, retries and other stations reuse what has already been fetched instead of going back to
+# S3.  Writes are atomic (temporary name + os.replace), reads refresh the file's mtime, and once
+# the cache grows beyond max_bytes the least recently used files are evicted.
+#
+import os
+import json
+import time
+import hashlib
+
+# Cache location and disk-usage cap, overridable from the environment
+HRRR_CACHE_DIR = os.environ.get('HRRR_CACHE_DIR', './hrrr_cache/')
+HRRR_CACHE_MAX_BYTES = int(float(os.environ.get('HRRR_CACHE_MAX_BYTES', 10e9)))
+
+# Files used within this many seconds are never evicted, another worker may be about to read them
+EVICT_MIN_AGE = 60.0
+
+
+class HRRRCache:
+    """Content-addressed HRRR file cache with LRU eviction.
+
+    Args:
+        cachedir (str, optional): cache directory, created if needed. Defaults to HRRR_CACHE_DIR.
+        max_bytes (int, optional): disk-usage cap. Defaults to HRRR_CACHE_MAX_BYTES.
+    """
+
+    def __init__(self, cachedir=None, max_bytes=None):
+        self.cachedir = cachedir or HRRR_CACHE_DIR
+        self.max_bytes = HRRR_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(self.cachedir, exist_ok=True)
+
+    @staticmethod
+    def key(cycle, fhr, product='wrfprs', subset='all'):
+        """Content address of an HRRR file, subset is any JSON-serialisable description of the messages."""
+        description = json.dumps([str(cycle), int(fhr), product, subset], sort_keys=True)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cachedir, key+'.grib2')
+
+    def contains(self, key):
+        return os.path.exists(self.path(key))
+
+    def get(self, key):
+        """Path of the cached file (refreshing its LRU position) or None on a miss."""
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def put(self, key, srcfile):
+        """Move srcfile into the cache atomically and evict down to the cap, returns the cached path."""
+        path = self.path(key)
+        tmpfile = path+'.'+str(os.getpid())+'.part'
+        try:
+            os.replace(srcfile, tmpfile)
+        except OSError:
+            # Different filesystem, copy instead
+            with open(srcfile, 'rb') as fin, open(tmpfile, 'wb') as fout:
+                for chunk in iter(lambda: fin.read(16*1024*1024), b''):
+                    fout.write(chunk)
+            os.remove(srcfile)
+        os.replace(tmpfile, path)
+        self.evict(keep=path)
+        return path
+
+    def entries(self):
+        """(mtime, size, path) of every cached file, least recently used first."""
+        entries = []
+        for name in os.listdir(self.cachedir):
+            if not name.endswith('.grib2'):
+                continue
+            path = os.path.join(self.cachedir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def usage(self):
+        return sum(size for mtime, size, path in self.entries())
+
+    def evict(self, keep=None):
+        """Remove least recently used files until the cache is under max_bytes."""
+        entries = self.entries()
+        total = sum(size for mtime, size, path in entries)
+        now = time.time()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep or now - mtime < EVICT_MIN_AGE:
+                continue
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def report(self, evictions=True):
+        """Counts and disk usage on one line.
+
+        Args:
+            evictions (bool, optional): include the evictions, leave them out for an instance that did
+                not store the files itself (the puts of other processes are not counted). Defaults to True.
+        """
+        entries = self.entries()
+        return ('HRRR cache '+self.cachedir+': '+str(self.hits)+' hits, '+str(self.misses)+' misses, '
+                + (str(self.evictions)+' evictions, ' if evictions else '')+str(len(entries))+' files, '
+                + str(round(sum(size for mtime, size, path in entries)/1e6, 1))+' of '
+                + str(round(self.max_bytes/1e6, 1))+' MB')
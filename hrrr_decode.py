@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Single-pass decoding of the HRRR fields used by processhrrr
+#
+# decode_hrrr walks the GRIB file once with eccodes, picks out the messages we need by
+# (shortName, typeOfLevel, stepType, stepRange) and returns them as plain numpy arrays using the
+# same variable names as the merged xarray dataset processhrrr used to build.  open_hrrr_cfgrib is
+# the original 17 x xr.open_dataset path, kept as the reference for compare_decode_timing.
+#
+# With gridpoints every field is sampled at the site grid points as soon as it is decoded, so the
+# full-grid arrays never outlive their message and all later math runs on a handful of points.
+#
+# Run as a script to time both paths on a file:  python hrrr_decode.py <gribfile> <fhr>
+#
+import os
+import sys
+import glob
+import time
+import numpy as np
+import xarray as xr
+import eccodes
+from hrrr_grid import grid_signature
+
+# Single level fields: (variable name, accepted shortNames, typeOfLevel)
+# Newer ecCodes releases call the surface radiation fluxes sdswrf, suswrf, ...
+HRRR_FIELDS = [
+    ('orog', ('orog',), 'surface'),                      # Surface elevation (m)
+    ('u10m', ('10u',), 'heightAboveGround'),             # Grid-relative 10-m u wind (m/s)
+    ('v10m', ('10v',), 'heightAboveGround'),             # Grid-relative 10-m v wind (m/s)
+    ('t2m', ('2t',), 'heightAboveGround'),               # 2-m temperature (K)
+    ('rh2m', ('2r',), 'heightAboveGround'),              # 2-m rh (%)
+    ('tsfc', ('t',), 'surface'),                         # Surface temperature (K)
+    ('psfc', ('sp',), 'surface'),                        # Surface pressure (Pa)
+    ('dswrf', ('dswrf', 'sdswrf'), 'surface'),           # Surface downward shortwave radiation (W/m**2)
+    ('uswrf', ('uswrf', 'suswrf'), 'surface'),           # Surface upward shortwave radiation (W/m**2)
+    ('dlwrf', ('dlwrf', 'sdlwrf'), 'surface'),           # Surface downward longwave radiation (W/m**2)
+    ('ulwrf', ('ulwrf', 'sulwrf'), 'surface'),           # Surface upward longwave radiation (W/m**2)
+]
+
+# Lambert conformal grid keys, see hrrr_grid.HRRR_GRID
+GRID_KEYS = ['Nx', 'Ny', 'latitudeOfFirstGridPointInDegrees', 'longitudeOfFirstGridPointInDegrees', 'LaDInDegrees',
+             'LoVInDegrees', 'Latin1InDegrees', 'Latin2InDegrees', 'DxInMetres', 'DyInMetres', 'radius']
+
+# Isobaric fields: (variable name, shortName)
+HRRR_PRESS_FIELDS = [
+    ('upress', 'u'),                                     # Grid-relative pressure-level u wind (m/s)
+    ('vpress', 'v'),                                     # Grid-relative pressure-level v wind (m/s)
+    ('hpress', 'gh'),                                    # Pressure-level geopotential height (m)
+    ('tpress', 't'),                                     # Pressure level temperature (K)
+    ('tdpress', 'dpt'),                                  # Pressure level dewpoint temperature (K)
+]
+
+
+# Sampled grid point latitudes/longitudes by grid and grid points, they are the same in every file
+_latlon_points = {}
+
+
+# stepRange of the hourly water-equivalent precipitation for forecast hour fhr
+def precip_step_range(fhr):
+    fhr = int(fhr)
+    if fhr == 0:
+        return str(fhr)
+    return str(fhr-1)+'-'+str(fhr)
+
+
+def decode_hrrr(localfile, fhr, latlon=True, gridpoints=None):
+    """Decode the fields processhrrr needs from localfile in a single pass.
+
+    Args:
+        localfile (str): HRRR wrfprs GRIB2 file (whole file or byte-range subset)
+        fhr (int): forecast hour, selects the hourly precipitation stepRange
+        latlon (bool, optional): also return the 2D latitude/longitude arrays. Defaults to True.
+        gridpoints (callable, optional): grid -> (y, x) integer index arrays of the points to keep, called
+            with the projection parameters of the file.  Defaults to None, keeping the whole grid.
+
+    Returns:
+        dict: 2D (y, x) arrays for the single level fields and hourlyprecip, 3D (level, y, x)
+        arrays for the isobaric fields ordered like cfgrib (decreasing pressure), the
+        isobaricInhPa levels, the grid projection parameters under 'grid' and, if requested,
+        latitude and longitude (0-360).  With gridpoints the (y, x) dimensions are replaced by
+        one point dimension and the indices are returned under 'gridpoints'.
+    """
+    single = {}
+    for name, shortnames, typeoflevel in HRRR_FIELDS:
+        for shortname in shortnames:
+            single[(shortname, typeoflevel, 'instant')] = name
+    press = {shortname: name for name, shortname in HRRR_PRESS_FIELDS}
+    steprange = precip_step_range(fhr)
+
+    hrrrdata = {}
+    levels = {name: {} for name, shortname in HRRR_PRESS_FIELDS}
+    with open(localfile, 'rb') as f:
+        while True:
+            h = eccodes.codes_grib_new_from_file(f)
+            if h is None:
+                break
+            try:
+                shortname = eccodes.codes_get(h, 'shortName')
+                typeoflevel = eccodes.codes_get(h, 'typeOfLevel')
+                steptype = eccodes.codes_get(h, 'stepType')
+                if (shortname, typeoflevel, steptype) in single:
+                    name = single[(shortname, typeoflevel, steptype)]
+                elif typeoflevel == 'isobaricInhPa' and steptype == 'instant' and shortname in press:
+                    name = press[shortname]
+                elif shortname == 'tp' and eccodes.codes_get(h, 'stepRange') == steprange:
+                    name = 'hourlyprecip'
+                else:
+                    continue
+                shape = (eccodes.codes_get(h, 'Nj'), eccodes.codes_get(h, 'Ni'))
+                if 'grid' not in hrrrdata:
+                    hrrrdata['grid'] = {key: eccodes.codes_get(h, key) for key in GRID_KEYS}
+                    if gridpoints is not None:
+                        y, x = (np.asarray(index) for index in gridpoints(hrrrdata['grid']))
+                        hrrrdata['gridpoints'] = (y, x)
+                values = eccodes.codes_get_values(h).astype(np.float32).reshape(shape)
+                if gridpoints is not None:
+                    values = values[y, x]
+                if name in levels:
+                    levels[name][eccodes.codes_get(h, 'level')] = values
+                else:
+                    hrrrdata[name] = values
+                if latlon and 'latitude' not in hrrrdata:
+                    if gridpoints is None:
+                        hrrrdata['latitude'] = eccodes.codes_get_array(h, 'latitudes').reshape(shape)
+                        hrrrdata['longitude'] = eccodes.codes_get_array(h, 'longitudes').reshape(shape)
+                    else:
+                        key = (grid_signature(hrrrdata['grid']), y.tobytes(), x.tobytes())
+                        if key not in _latlon_points:
+                            _latlon_points[key] = (eccodes.codes_get_array(h, 'latitudes').reshape(shape)[y, x],
+                                                   eccodes.codes_get_array(h, 'longitudes').reshape(shape)[y, x])
+                        hrrrdata['latitude'], hrrrdata['longitude'] = _latlon_points[key]
+            finally:
+                eccodes.codes_release(h)
+
+    # Stack isobaric fields from the bottom (highest pressure) up
+    for name, shortname in HRRR_PRESS_FIELDS:
+        if len(levels[name]) == 0:
+            continue
+        isobaric = sorted(levels[name], reverse=True)
+        hrrrdata[name] = np.stack([levels[name][level] for level in isobaric])
+        hrrrdata['isobaricInhPa'] = np.array(isobaric, dtype=float)
+
+    missing = [name for name, shortnames, typeoflevel in HRRR_FIELDS if name not in hrrrdata]
+    missing += [name for name, shortname in HRRR_PRESS_FIELDS if name not in hrrrdata]
+    if 'hourlyprecip' not in hrrrdata:
+        missing.append('hourlyprecip')
+    if missing:
+        raise KeyError('Fields not found in '+localfile+': '+', '.join(missing))
+    return hrrrdata
+
+
+# Open a field with cfgrib, falling back to the newer ecCodes shortName for the radiation fluxes
+def _open_cfgrib(localfile, filter_by_keys, rename=None, **kwargs):
+    ds = xr.open_dataset(localfile, engine='cfgrib', filter_by_keys=filter_by_keys, **kwargs)
+    shortname = filter_by_keys['shortName']
+    if len(ds.data_vars) == 0 and shortname in ('dswrf', 'uswrf', 'dlwrf', 'ulwrf'):
+        ds = xr.open_dataset(localfile, engine='cfgrib', filter_by_keys=dict(filter_by_keys, shortName='s'+shortname),
+                             **kwargs).rename({'s'+shortname: shortname})
+    if rename is not None:
+        ds = ds.rename(rename)
+    return ds
+
+
+def open_hrrr_cfgrib(localfile, fhr, timings=None):
+    """Original decode path: one cfgrib open_dataset per field followed by xr.merge.
+
+    Args:
+        timings (dict, optional): if given, seconds spent in the 'open' and 'merge' stages are stored here
+
+    Returns:
+        xarray.Dataset: merged dataset with the processhrrr variable names
+    """
+    start = time.time()
+    datasets = []
+    for name, shortnames, typeoflevel in HRRR_FIELDS:
+        rename = {'u10': 'u10m', 'v10': 'v10m', 'r2': 'rh2m', 't': 'tsfc', 'sp': 'psfc'}
+        filter_by_keys = {'typeOfLevel': typeoflevel, 'stepType': 'instant', 'shortName': shortnames[0]}
+        kwargs = {'decode_coords': 'all'} if name == 'orog' else {}
+        ds = _open_cfgrib(localfile, filter_by_keys, **kwargs)
+        datasets.append(ds.rename({var: rename[var] for var in ds.data_vars if var in rename}))
+    for name, shortname in HRRR_PRESS_FIELDS:
+        datasets.append(_open_cfgrib(localfile, {'typeOfLevel': 'isobaricInhPa', 'stepType': 'instant',
+                                                 'shortName': shortname}, rename={shortname: name}, decode_coords='all'))
+    datasets.append(_open_cfgrib(localfile, {'stepRange': precip_step_range(fhr), 'shortName': 'tp'},
+                                 rename={'tp': 'hourlyprecip'}))
+    opened = time.time()
+
+    hrrrdata = xr.merge(datasets, compat='override')
+    if timings is not None:
+        timings['open'] = opened - start
+        timings['merge'] = time.time() - opened
+    return hrrrdata
+
+
+def compare_decode_timing(localfile, fhr, repeat=3):
+    """Per-stage timing of the cfgrib path against decode_hrrr on the same file.
+
+    cfgrib's on-disk index is removed before every repeat since processhrrr reads each forecast
+    file exactly once, so the cost of building it is part of the current path.
+
+    Returns:
+        dict: best-of-repeat seconds per stage for 'cfgrib' (open, merge, load, total) and
+        'eccodes' (decode, total)
+    """
+    results = {'cfgrib': {}, 'eccodes': {}}
+    for i in range(repeat):
+        for indexfile in glob.glob(localfile+'.*.idx'):
+            os.remove(indexfile)
+        timings = {}
+        start = time.time()
+        hrrrdata = open_hrrr_cfgrib(localfile, fhr, timings)
+        loaded = time.time()
+        hrrrdata.load()
+        timings['load'] = time.time() - loaded
+        timings['total'] = time.time() - start
+        for stage, seconds in timings.items():
+            results['cfgrib'][stage] = min(seconds, results['cfgrib'].get(stage, np.inf))
+
+        start = time.time()
+        decode_hrrr(localfile, fhr)
+        seconds = time.time() - start
+        for stage in ('decode', 'total'):
+            results['eccodes'][stage] = min(seconds, results['eccodes'].get(stage, np.inf))
+    return results
+
+
+if __name__ == "__main__":
+
+    localfile = sys.argv[1]
+    fhr = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    repeat = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+
+    results = compare_decode_timing(localfile, fhr, repeat)
+    for path, stages in results.items():
+        print(path+': '+', '.join(stage+' '+str(round(seconds, 3))+' s' for stage, seconds in stages.items()))
+    print('Speedup: '+str(round(results['cfgrib']['total']/results['eccodes']['total'], 1))+'x')
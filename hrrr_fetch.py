@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Byte-range retrieval of HRRR pressure-level files from AWS
+#
+# Every wrfprs file on AWS has a wgrib2 style .idx sidecar that lists the starting byte of each
+# GRIB message.  Rather than downloading the whole file (hundreds of MB) we read the inventory,
+# work out which messages processhrrr actually needs, and fetch only those with ranged GETs.
+# The GRIB2 messages are self contained so the fetched pieces are simply concatenated into a
+# compact local GRIB file that cfgrib/eccodes read like the original.
+#
+import os
+import re
+import time
+import boto3
+from concurrent.futures import ThreadPoolExecutor
+from botocore import UNSIGNED
+from botocore.client import Config
+from botocore.exceptions import ClientError
+from pipeline_timing import stage, add_bytes
+
+# AWS bucket holding the HRRR archive
+HRRR_BUCKET = 'noaa-hrrr-bdp-pds'
+
+# Endpoint override (e.g. a local S3 stand-in for testing), None uses AWS
+HRRR_S3_ENDPOINT_URL = os.environ.get('HRRR_S3_ENDPOINT_URL')
+
+# Connections per client, enough for the parallel chunks of a whole-file download
+HRRR_MAX_POOL_CONNECTIONS = 16
+
+# Whole-file downloads are split in chunks of this size (bytes) fetched this many at a time
+HRRR_CHUNKSIZE = 16*1024*1024
+HRRR_MAX_CONCURRENCY = 8
+
+# (process id, endpoint, client) of this worker process's S3 client, see worker_s3_client
+_worker_s3 = None
+
+
+class HRRRNotAvailable(Exception):
+    """An HRRR file is not (yet) on the server, e.g. a cycle that is still being published."""
+
+
+# Fields needed by processhrrr as (variable, level) regular expressions on the wgrib2 inventory
+HRRR_IDX_FIELDS = [
+    ('HGT', 'surface'),                          # orog
+    ('UGRD', '10 m above ground'),               # 10u
+    ('VGRD', '10 m above ground'),               # 10v
+    ('TMP', '2 m above ground'),                 # 2t
+    ('RH', '2 m above ground'),                  # 2r
+    ('TMP', 'surface'),                          # surface t
+    ('PRES', 'surface'),                         # sp
+    ('DSWRF', 'surface'),
+    ('USWRF', 'surface'),
+    ('DLWRF', 'surface'),
+    ('ULWRF', 'surface'),
+    ('(?:UGRD|VGRD|HGT|TMP|DPT)', r'\d+ mb'),    # isobaric u, v, gh, t, dpt
+]
+
+
+# Object key for a given cycle and forecast hour
+def hrrr_object_key(yr, mn, dy, hr, fhr):
+    return 'hrrr.'+str(yr)+str(mn)+str(dy)+'/conus/hrrr.t'+str(hr)+'z.wrfprsf'+str(fhr).zfill(2)+'.grib2'
+
+
+# S3 client with the settings used throughout the HRRR workflow
+# Clients are thread safe, give one shared by several threads a max_pool_connections of at least the thread count
+def make_s3_client(endpoint_url=None, max_pool_connections=HRRR_MAX_POOL_CONNECTIONS):
+    endpoint_url = endpoint_url or HRRR_S3_ENDPOINT_URL
+    s3config = {}
+    if endpoint_url is not None:
+        s3config = {'addressing_style': 'path'}
+    return boto3.client('s3',
+                        region_name='us-east-1',
+                        endpoint_url=endpoint_url,
+                        config=Config(
+                            signature_version=UNSIGNED,
+                            connect_timeout=5,
+                            read_timeout=30,
+                            max_pool_connections=max_pool_connections,
+                            retries={
+                                'max_attempts': 3,
+                                'mode': 'standard'
+                            },
+                            s3=s3config
+                        ))
+
+
+def init_worker_s3(endpoint_url=None, max_pool_connections=HRRR_MAX_POOL_CONNECTIONS):
+    """Pool initializer building the S3 client every task of the worker process reuses."""
+    global _worker_s3
+    start = time.time()
+    endpoint_url = endpoint_url or HRRR_S3_ENDPOINT_URL
+    _worker_s3 = (os.getpid(), endpoint_url, make_s3_client(endpoint_url, max_pool_connections))
+    print('S3 client for process '+str(os.getpid())+' ready in '+str(round(time.time() - start, 3))+' s')
+
+
+def worker_s3_client():
+    """The S3 client of this process, built on first use when there was no init_worker_s3.
+
+    A client inherited from the parent process (fork) or made for another endpoint is replaced.
+    """
+    if _worker_s3 is None or _worker_s3[:2] != (os.getpid(), HRRR_S3_ENDPOINT_URL):
+        init_worker_s3()
+    return _worker_s3[2]
+
+
+# True for the 404 S3 answers with when an object does not exist (yet)
+def is_not_found(error):
+    return isinstance(error, ClientError) and \
+        error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+
+def parse_idx(text):
+    """Parse a wgrib2 style inventory.
+
+    Args:
+        text (str): contents of the .idx file, one line per message formatted as
+            ``num:offset:d=YYYYMMDDHH:VAR:LEVEL:FCST:``
+
+    Returns:
+        list: ``(offset, end, search)`` per message where ``end`` is the last byte of the message
+        (None for the final message) and ``search`` is the ``:VAR:LEVEL:FCST:`` string to match on.
+    """
+    entries = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        parts = line.split(':')
+        entries.append([int(parts[1]), None, ':'+':'.join(parts[3:6])+':'])
+    entries.sort(key=lambda entry: entry[0])
+    for entry, nextentry in zip(entries[:-1], entries[1:]):
+        entry[1] = nextentry[0] - 1
+    return [tuple(entry) for entry in entries]
+
+
+def hrrr_idx_patterns(fhr):
+    """Regular expressions selecting the messages processhrrr reads for forecast hour fhr."""
+    fhr = int(fhr)
+    fcst = 'anl' if fhr == 0 else str(fhr)+' hour fcst'
+    patterns = [':'+var+':'+level+':'+fcst+':' for var, level in HRRR_IDX_FIELDS]
+    # Hourly precipitation, matching the stepRange selected in processhrrr
+    if fhr == 0:
+        patterns.append(':APCP:surface:(?:0-0 day|0 hour) acc fcst:')
+    else:
+        patterns.append(':APCP:surface:'+str(fhr-1)+'-'+str(fhr)+' hour acc fcst:')
+    return [re.compile(pattern) for pattern in patterns]
+
+
+def idx_byte_ranges(entries, patterns):
+    """Byte ranges covering the matching messages, with adjacent messages coalesced.
+
+    Returns:
+        list: ``(start, end)`` tuples, ``end`` is inclusive or None to read to end of file.
+    """
+    ranges = []
+    for offset, end, search in entries:
+        if not any(pattern.search(search) for pattern in patterns):
+            continue
+        if ranges and ranges[-1][1] is not None and ranges[-1][1] + 1 == offset:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((offset, end))
+    return ranges
+
+
+def fetch_hrrr_subset(s3, bucket, key, localfile, fhr):
+    """Download only the messages needed for fhr from s3://bucket/key into localfile.
+
+    Returns:
+        int: number of GRIB bytes fetched
+    """
+    with stage('s3_get_idx'):
+        idxbytes = s3.get_object(Bucket=bucket, Key=key+'.idx')['Body'].read()
+    add_bytes('s3_get_idx', len(idxbytes))
+    idxtext = idxbytes.decode()
+    patterns = hrrr_idx_patterns(fhr)
+    ranges = idx_byte_ranges(parse_idx(idxtext), patterns)
+    if len(ranges) == 0:
+        raise ValueError('No matching HRRR messages in '+key+'.idx')
+
+    # Write to a temporary name so a partial download never looks like a complete file
+    nbytes = 0
+    tmpfile = localfile+'.part'
+    with stage('s3_get'), open(tmpfile, 'wb') as f:
+        for start, end in ranges:
+            byterange = 'bytes='+str(start)+'-'+('' if end is None else str(end))
+            body = s3.get_object(Bucket=bucket, Key=key, Range=byterange)['Body']
+            for chunk in iter(lambda: body.read(1024*1024), b''):
+                f.write(chunk)
+                nbytes += len(chunk)
+    add_bytes('s3_get', nbytes)
+    os.replace(tmpfile, localfile)
+    return nbytes
+
+
+def fetch_hrrr_file(s3, bucket, key, localfile, chunksize=HRRR_CHUNKSIZE, max_concurrency=HRRR_MAX_CONCURRENCY):
+    """Download the whole of s3://bucket/key into localfile without a HEAD request.
+
+    The first chunk's GET also returns the object size (Content-Range), the remaining chunks are then
+    fetched max_concurrency at a time.  A missing object surfaces as the 404 ClientError of that GET.
+
+    Returns:
+        int: number of bytes fetched
+    """
+    with stage('s3_get'):
+        return _fetch_hrrr_file(s3, bucket, key, localfile, chunksize, max_concurrency)
+
+
+def _fetch_hrrr_file(s3, bucket, key, localfile, chunksize, max_concurrency):
+    response = s3.get_object(Bucket=bucket, Key=key, Range='bytes=0-'+str(chunksize-1))
+    first = response['Body'].read()
+    size = int(response['ContentRange'].split('/')[-1]) if 'ContentRange' in response else len(first)
+
+    def fetch_chunk(start):
+        end = min(start+chunksize, size) - 1
+        body = s3.get_object(Bucket=bucket, Key=key, Range='bytes='+str(start)+'-'+str(end))['Body'].read()
+        os.pwrite(fd, body, start)
+        return len(body)
+
+    # Write to a temporary name so a partial download never looks like a complete file
+    tmpfile = localfile+'.part'
+    fd = os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.pwrite(fd, first, 0)
+        nbytes = len(first)
+        starts = range(len(first), size, chunksize)
+        if len(starts) > 0:
+            with ThreadPoolExecutor(max_workers=max_concurrency) as threads:
+                nbytes += sum(threads.map(fetch_chunk, starts))
+    finally:
+        os.close(fd)
+    if nbytes != size:
+        raise IOError('Incomplete download of '+key+': '+str(nbytes)+' of '+str(size)+' bytes')
+    add_bytes('s3_get', nbytes)
+    os.replace(tmpfile, localfile)
+    return nbytes
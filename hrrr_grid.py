@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# coding: utf-8
+# HRRR Lambert conformal grid geometry
+#
+# The HRRR grid is a regular 3-km grid on a spherical Lambert conformal projection, so the grid
+# index of any (lat, lon) follows analytically from the projection parameters in the GRIB header.
+# This replaces building a KDTree over all ~1.9M grid point lat/lons (in degrees) for every file,
+# and nearest-point selection is done in projected distance rather than in raw degrees.
+#
+import os
+import json
+import numpy as np
+
+# Projection of the operational HRRR CONUS grid (GRIB2 keys, shapeOfTheEarth = 6)
+HRRR_GRID = {
+    'Nx': 1799,
+    'Ny': 1059,
+    'latitudeOfFirstGridPointInDegrees': 21.138123,
+    'longitudeOfFirstGridPointInDegrees': 237.280472,
+    'LaDInDegrees': 38.5,
+    'LoVInDegrees': 262.5,
+    'Latin1InDegrees': 38.5,
+    'Latin2InDegrees': 38.5,
+    'DxInMetres': 3000.0,
+    'DyInMetres': 3000.0,
+    'radius': 6371229.0,
+}
+
+# In-process memo of site grid points, backed by the JSON cache file
+_site_index = {}
+
+
+# Cone constant n and the mapping constant R*F of the projection
+def _cone(grid):
+    phi1 = np.radians(grid['Latin1InDegrees'])
+    phi2 = np.radians(grid['Latin2InDegrees'])
+    if np.isclose(phi1, phi2):
+        n = np.sin(phi1)
+    else:
+        n = np.log(np.cos(phi1)/np.cos(phi2))/np.log(np.tan(np.pi/4 + phi2/2)/np.tan(np.pi/4 + phi1/2))
+    rf = grid['radius']*np.cos(phi1)*np.tan(np.pi/4 + phi1/2)**n/n
+    return n, rf
+
+
+# Projected coordinates (m) with the pole of the cone at the origin
+def _project(lat, lon, grid):
+    n, rf = _cone(grid)
+    rho = rf/np.tan(np.pi/4 + np.radians(lat)/2)**n
+    theta = n*np.radians((np.asarray(lon) - grid['LoVInDegrees'] + 180.) % 360. - 180.)
+    return rho*np.sin(theta), -rho*np.cos(theta)
+
+
+def latlon_to_gridyx(lat, lon, grid=HRRR_GRID):
+    """Fractional (y, x) grid index of lat/lon (degrees, longitude either -180..180 or 0..360).
+
+    Works on scalars or arrays.  Indices count from the first grid point with y increasing
+    northward, matching the (y, x) dimensions of the decoded HRRR fields.
+    """
+    x, y = _project(lat, lon, grid)
+    x1, y1 = _project(grid['latitudeOfFirstGridPointInDegrees'], grid['longitudeOfFirstGridPointInDegrees'], grid)
+    return (y - y1)/grid['DyInMetres'], (x - x1)/grid['DxInMetres']
+
+
+def gridyx_to_latlon(y, x, grid=HRRR_GRID):
+    """Inverse of latlon_to_gridyx, longitudes are returned in 0..360 like the HRRR files."""
+    n, rf = _cone(grid)
+    x1, y1 = _project(grid['latitudeOfFirstGridPointInDegrees'], grid['longitudeOfFirstGridPointInDegrees'], grid)
+    px = x1 + np.asarray(x)*grid['DxInMetres']
+    py = y1 + np.asarray(y)*grid['DyInMetres']
+    rho = np.sign(n)*np.hypot(px, py)
+    theta = np.arctan2(np.sign(n)*px, -np.sign(n)*py)
+    lat = np.degrees(2*np.arctan((rf/rho)**(1/n)) - np.pi/2)
+    lon = (grid['LoVInDegrees'] + np.degrees(theta/n)) % 360.
+    return lat, lon
+
+
+def nearest_gridpoint(lat, lon, grid=HRRR_GRID):
+    """Integer (y, x) of the grid point closest to lat/lon, ValueError if it is off the grid."""
+    fy, fx = latlon_to_gridyx(lat, lon, grid)
+    y, x = int(np.round(fy)), int(np.round(fx))
+    if not (0 <= y < grid['Ny'] and 0 <= x < grid['Nx']):
+        raise ValueError('Site '+str(lat)+', '+str(lon)+' is outside the HRRR grid')
+    return y, x
+
+
+# Key identifying a grid in the site cache
+def grid_signature(grid):
+    return '/'.join(str(grid[key]) for key in sorted(grid))
+
+
+def cached_gridpoint(lat, lon, grid=HRRR_GRID, cachefile=None):
+    """nearest_gridpoint with results persisted in cachefile (JSON) across runs and processes."""
+    key = grid_signature(grid)+'|'+str(round(float(lat), 6))+'|'+str(round(float(lon), 6))
+    if key in _site_index:
+        return _site_index[key]
+
+    cache = {}
+    if cachefile is not None and os.path.exists(cachefile):
+        try:
+            with open(cachefile) as f:
+                cache = json.load(f)
+        except ValueError:
+            cache = {}
+    if key in cache:
+        _site_index[key] = tuple(cache[key])
+        return _site_index[key]
+
+    _site_index[key] = nearest_gridpoint(lat, lon, grid)
+    if cachefile is not None:
+        cache[key] = list(_site_index[key])
+        tmpfile = cachefile+'.'+str(os.getpid())
+        with open(tmpfile, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmpfile, cachefile)
+    return _site_index[key]
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Vectorized vertical interpolation and wet-bulb zero heights for batched HRRR profiles
+#
+# valheight and calcwbzlevel in hrrr_snowpack_1_4 work on one profile at a time through Python
+# lists and .index() scans.  The functions here take profiles stacked along any leading
+# dimensions (e.g. sites x hours x levels, levels last and ordered bottom up like the decoded
+# isobaric fields) and do the same arithmetic in one NumPy call.  Results are identical to the
+# scalar functions, including their quirks, except that the cases where those raise (height above
+# the top level, wet-bulb temperature above zero at the top level) give NaN.
+#
+# wet_bulb_profiles computes wet-bulb temperatures for the same kind of batches.  MetPy's
+# wet_bulb_temperature lifts every point to its LCL and then runs an adaptive ODE solver back
+# down the moist adiabat, one point at a time.  The numpy backend does the same Normand
+# construction for all points at once, MetPy's closed form LCL followed by a fixed-step RK4
+# descent of MetPy's moist lapse rate (same constants and saturation vapor pressure), and stays
+# within WETBULB_TOLERANCE of MetPy.  backend='metpy' is kept as the reference.
+#
+import os
+import sys
+import time
+import numpy as np
+from metpy.calc import lcl, wet_bulb_temperature
+from metpy.constants import nounit as mpconsts
+from metpy.units import units
+
+# RK4 steps in ln(p) from the LCL down to the starting pressure, and the resulting agreement with MetPy (K)
+WETBULB_STEPS = 4
+WETBULB_TOLERANCE = 1e-3
+
+# Backend used by processhrrrfile, overridable from the environment
+WETBULB_BACKENDS = ('numpy', 'metpy')
+HRRR_WETBULB_BACKEND = os.environ.get('HRRR_WETBULB_BACKEND', 'numpy')
+
+
+def interp_heights(vals, zvals, heights):
+    """Linear interpolation of profiles to heights, batched valheight.
+
+    Args:
+        vals (array): (..., level) profile values
+        zvals (array): (..., level) heights of the levels, increasing upward
+        heights (array): (..., nheight) heights to interpolate to (e.g. site elevation + AGL offsets),
+            treated like the Python floats valheight takes, i.e. in the precision of zvals
+
+    Returns:
+        array: (..., nheight) interpolated values.  A height equal to a level height takes that level's
+        value.  A height below the lowest level wraps around to the top level like valheight's ind-1 = -1,
+        a height above the highest level is NaN.
+    """
+    vals = np.asarray(vals)
+    zvals = np.asarray(zvals)
+    heights = np.asarray(heights)
+    if np.issubdtype(zvals.dtype, np.floating):
+        heights = heights.astype(zvals.dtype)
+
+    z = zvals[..., np.newaxis, :]
+    h = heights[..., np.newaxis]
+    v = np.broadcast_to(vals[..., np.newaxis, :], np.broadcast_shapes(z.shape, h.shape))
+    z = np.broadcast_to(z, v.shape)
+
+    # First level above the height, valheight also stops at a level height of exactly 0
+    above = (z > h) | (z == 0)
+    ind = np.argmax(above, axis=-1)[..., np.newaxis]
+    lower = np.where(ind == 0, z.shape[-1] - 1, ind - 1)
+    z0, z1 = np.take_along_axis(z, lower, -1)[..., 0], np.take_along_axis(z, ind, -1)[..., 0]
+    v0, v1 = np.take_along_axis(v, lower, -1)[..., 0], np.take_along_axis(v, ind, -1)[..., 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        val = ((heights - z0)/(z1 - z0))*(v1 - v0) + v0
+    val = np.where(above.any(axis=-1), val, np.nan)
+
+    # Heights on a level take the value of the first such level
+    exact = z == h
+    vexact = np.take_along_axis(v, np.argmax(exact, axis=-1)[..., np.newaxis], -1)[..., 0]
+    return np.where(exact.any(axis=-1), vexact, val)
+
+
+def wbz_heights(twvals, zvals):
+    """Height of the wet-bulb zero, batched calcwbzlevel.
+
+    Args:
+        twvals (array): (..., level) wet-bulb temperature (C)
+        zvals (array): (..., level) heights of the levels, increasing upward
+
+    Returns:
+        array: (...) height of the highest crossing from above to below zero, the first level where the
+        wet-bulb temperature is exactly zero if there is one, 0 for a column entirely at or below zero and
+        NaN when the top level is above zero.
+    """
+    twvals = np.asarray(twvals)
+    zvals = np.asarray(zvals)
+    nlev = twvals.shape[-1]
+
+    # Interpolate between the highest level above zero and the one over it
+    positive = twvals > 0
+    top = nlev - 1 - np.argmax(positive[..., ::-1], axis=-1)
+    lower = top[..., np.newaxis]
+    upper = np.minimum(top + 1, nlev - 1)[..., np.newaxis]
+    t0, t1 = np.take_along_axis(twvals, lower, -1)[..., 0], np.take_along_axis(twvals, upper, -1)[..., 0]
+    z0, z1 = np.take_along_axis(zvals, lower, -1)[..., 0], np.take_along_axis(zvals, upper, -1)[..., 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        wbzlev = z0 + (t0/(t0 - t1))*(z1 - z0)
+    wbzlev = np.where(top == nlev - 1, np.nan, wbzlev)
+
+    # A level at exactly zero
+    zero = twvals == 0
+    zexact = np.take_along_axis(zvals, np.argmax(zero, axis=-1)[..., np.newaxis], -1)[..., 0]
+    wbzlev = np.where(zero.any(axis=-1), zexact, wbzlev)
+
+    # Column at or below freezing
+    return np.where(np.max(twvals, axis=-1) <= 0, 0, wbzlev)
+
+
+# Saturation mixing ratio over liquid water (kg/kg) at p (Pa) and t (K), as in MetPy (Ambaum 2020 vapor pressure)
+def _saturation_mixing_ratio(p, t):
+    latent_heat = mpconsts.Lv - (mpconsts.Cp_l - mpconsts.Cp_v)*(t - mpconsts.T0)
+    heat_power = (mpconsts.Cp_l - mpconsts.Cp_v)/mpconsts.Rv
+    exp_term = (mpconsts.Lv/mpconsts.T0 - latent_heat/t)/mpconsts.Rv
+    e_s = mpconsts.sat_pressure_0c*(mpconsts.T0/t)**heat_power*np.exp(exp_term)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(e_s >= p, np.nan, mpconsts.epsilon*e_s/(p - e_s))
+
+
+# Moist adiabatic lapse rate dT/dln(p) of MetPy's moist_lapse
+def _moist_lapse_rate(p, t):
+    rs = _saturation_mixing_ratio(p, t)
+    return ((mpconsts.Rd*t + mpconsts.Lv*rs)
+            / (mpconsts.Cp_d + mpconsts.Lv*mpconsts.Lv*rs*mpconsts.epsilon/(mpconsts.Rd*t**2)))
+
+
+def wet_bulb_profiles(pressure, temperature, dewpoint, backend=HRRR_WETBULB_BACKEND, steps=WETBULB_STEPS):
+    """Wet-bulb temperature (Normand's rule) of every point of a batch of profiles.
+
+    Args:
+        pressure (array): pressure (hPa), broadcast against temperature, e.g. the (level,) isobaric levels
+        temperature (array): (..., level) temperature (K)
+        dewpoint (array): (..., level) dewpoint (K)
+        backend (str, optional): 'numpy' for the batched RK4 descent or 'metpy' for one
+            wet_bulb_temperature call per profile. Defaults to HRRR_WETBULB_BACKEND ('numpy').
+        steps (int, optional): RK4 steps of the numpy backend. Defaults to WETBULB_STEPS.
+
+    Returns:
+        array: (..., level) wet-bulb temperature (K), float64
+    """
+    temperature = np.asarray(temperature, dtype=float)
+    dewpoint = np.asarray(dewpoint, dtype=float)
+    pressure = np.broadcast_to(np.asarray(pressure, dtype=float), temperature.shape)
+
+    if backend == 'metpy':
+        wetbulb = np.empty(temperature.shape)
+        for index in np.ndindex(temperature.shape[:-1]):
+            wetbulb[index] = wet_bulb_temperature(pressure[index] * units.hPa, temperature[index] * units.degK,
+                                                  dewpoint[index] * units.degK).m_as('K')
+        return wetbulb
+    if backend != 'numpy':
+        raise ValueError('backend must be one of '+str(WETBULB_BACKENDS))
+
+    # Lift to the LCL, then descend the moist adiabat to the starting pressure
+    lcl_press, lcl_temp = lcl(pressure * units.hPa, temperature * units.degK, dewpoint * units.degK)
+    p0 = lcl_press.m_as('Pa')
+    t = lcl_temp.m_as('K')
+    h = (np.log(pressure*100.) - np.log(p0))/steps
+    for i in range(steps):
+        p = p0*np.exp(i*h)
+        k1 = _moist_lapse_rate(p, t)
+        k2 = _moist_lapse_rate(p*np.exp(h/2), t + h/2*k1)
+        k3 = _moist_lapse_rate(p*np.exp(h/2), t + h/2*k2)
+        k4 = _moist_lapse_rate(p*np.exp(h), t + h*k3)
+        t = t + h/6*(k1 + 2*k2 + 2*k3 + k4)
+    return t
+
+
+def compare_wetbulb_timing(nprofiles=147, nlevels=40, seed=0):
+    """Seconds taken by each backend and their largest difference (K) on random HRRR-like profiles.
+
+    The default batch is 3 sites x 49 forecast hours of 40 isobaric levels.
+    """
+    rng = np.random.default_rng(seed)
+    pressure = np.linspace(1000., 1000. - 25.*(nlevels - 1), nlevels)
+    temperature = np.linspace(300., 215., nlevels) + rng.normal(0., 3., (nprofiles, nlevels))
+    dewpoint = temperature - rng.uniform(0., 25., temperature.shape)
+    results = {}
+    wetbulb = {}
+    for backend in WETBULB_BACKENDS:
+        start = time.time()
+        wetbulb[backend] = wet_bulb_profiles(pressure, temperature, dewpoint, backend)
+        results[backend] = time.time() - start
+    results['maxdiff'] = float(np.nanmax(np.abs(wetbulb['numpy'] - wetbulb['metpy'])))
+    return results
+
+
+# Time both wet-bulb backends:  python hrrr_profiles.py [nprofiles] [nlevels]
+if __name__ == "__main__":
+
+    nprofiles = int(sys.argv[1]) if len(sys.argv) > 1 else 147
+    nlevels = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+
+    results = compare_wetbulb_timing(nprofiles, nlevels)
+    print('metpy: '+str(round(results['metpy'], 3))+' s, numpy: '+str(round(results['numpy'], 4))+' s')
+    print('Speedup: '+str(round(results['metpy']/results['numpy']))+'x, largest difference '
+          + str(round(results['maxdiff'], 6))+' K (tolerance '+str(WETBULB_TOLERANCE)+' K)')
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Fault-tolerant scheduling of HRRR forecast hours
+#
+# Pool.starmap is all-or-nothing: one wrfprsfNN that is not on AWS yet (the usual case when a
+# cycle is still being published when we poll) raises in the parent and every finished hour is
+# thrown away.  Here each forecast hour is an independent task.  Failed hours are retried with
+# exponential backoff while the others carry on, and whatever is still missing after the last
+# retry is handed back to the caller as a gap instead of an exception.  Finished hours are
+# checkpointed by the task itself (processhrrr_sites writes to the point forecast store), so a
+# rerun only picks up the gaps.
+#
+import os
+import time
+import traceback
+from multiprocessing import Pool
+from hrrr_fetch import HRRRNotAvailable
+
+# Retries per forecast hour and the first backoff delay (s), doubled on every retry
+HRRR_RETRIES = int(os.environ.get('HRRR_RETRIES', 3))
+HRRR_BACKOFF = float(os.environ.get('HRRR_BACKOFF', 60.))
+HRRR_BACKOFF_MAX = 600.
+
+# How many earlier cycles to search for a forecast valid at the time of a missing hour
+HRRR_FALLBACK_CYCLES = 3
+
+# What to do with forecast hours that could not be produced
+GAP_POLICIES = ('previous', 'nodata', 'raise')
+
+
+# Runs in the worker, failures come back as values so one bad hour never breaks the pool
+def _run_task(func, args):
+    try:
+        return True, func(*args)
+    except Exception as e:
+        if not isinstance(e, HRRRNotAvailable):
+            traceback.print_exc()
+        return False, type(e).__name__+': '+str(e)
+
+
+def run_forecast_hours(func, items, key, processes, retries=HRRR_RETRIES, backoff=HRRR_BACKOFF,
+                       backoff_max=HRRR_BACKOFF_MAX, initializer=None, on_result=None):
+    """Run func(*item) for every item in a process pool, retrying the ones that fail.
+
+    Args:
+        func (callable): module level function, e.g. processhrrr_sites
+        items (list): argument tuples, one per forecast hour
+        key (callable): item -> key of the results, e.g. the forecast hour
+        processes (int): maximum number of parallel processes
+        retries (int, optional): retries per item after the first attempt. Defaults to HRRR_RETRIES.
+        backoff (float, optional): delay (s) before the first retry, doubled for each further retry.
+            Defaults to HRRR_BACKOFF.
+        backoff_max (float, optional): cap on the delay (s). Defaults to HRRR_BACKOFF_MAX.
+        initializer (callable, optional): run once in every worker process, e.g. hrrr_fetch.init_worker_s3.
+        on_result (callable, optional): on_result(key, result) is called for every item that succeeds, as soon
+            as it is collected (in item order within each attempt).
+
+    Returns:
+        tuple: (results, failures) dicts keyed by key(item), failures holds the last error message of
+        every item that did not succeed
+    """
+    results = {}
+    failures = {}
+    pending = list(items)
+    if len(pending) == 0:
+        return results, failures
+
+    with Pool(processes=min(len(pending), processes), initializer=initializer) as p:
+        for attempt in range(retries+1):
+            if attempt > 0:
+                delay = min(backoff*2**(attempt-1), backoff_max)
+                print('Retrying '+str(len(pending))+' forecast hours in '+str(delay)+' s (attempt '
+                      + str(attempt+1)+' of '+str(retries+1)+')')
+                time.sleep(delay)
+            tasks = [(item, p.apply_async(_run_task, (func, item))) for item in pending]
+            pending = []
+            for item, task in tasks:
+                ok, value = task.get()
+                if ok:
+                    results[key(item)] = value
+                    failures.pop(key(item), None)
+                    if on_result is not None:
+                        on_result(key(item), value)
+                else:
+                    failures[key(item)] = value
+                    pending.append(item)
+            if len(pending) == 0:
+                break
+
+    return results, failures
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Snow-to-liquid ratio (SLR) random forest, loaded once per process
+#
+# The model takes temperature and wind speed 500, 1000 and 2000 m above the site (T05K ... SPD2K),
+# standardized with the saved scaler.  Loading the keys, scaler and pickled forest costs far more
+# than a prediction, so every process loads them once (get_slr_predictor, also usable as a pool
+# initializer) and predicts for all sites of a forecast hour in one call.  Without the model file
+# the predictor returns 0, which is what processhrrr produced while the model was commented out.
+#
+import os
+import numpy as np
+import pandas as pd
+
+# Model files, by default next to this module
+HRRR_SLR_MODEL_DIR = os.environ.get('HRRR_SLR_MODEL_DIR', os.path.dirname(os.path.abspath(__file__)))
+SLR_KEYS_FILE = 'SingleSite_slr_model_keysAGL30.npy'
+SLR_SCALER_FILE = 'SingleSite_slr_model_scalerAGL30.npy'
+SLR_MODEL_FILE = 'SingleSite_RF_slr_modelAGL30.pickle'
+
+# Model features, temperature (K) and wind speed (m/s) 0.5, 1 and 2 km above the site
+SLR_FEATURES = ['T05K', 'T1K', 'T2K', 'SPD05K', 'SPD1K', 'SPD2K']
+
+# Predictors of this process by model directory, see get_slr_predictor
+_predictors = {}
+
+
+class SLRPredictor:
+    """SLR random forest with its feature keys and scaler.
+
+    Args:
+        modeldir (str, optional): directory with the keys, scaler and model files. Defaults to
+            HRRR_SLR_MODEL_DIR.
+    """
+
+    def __init__(self, modeldir=None):
+        self.modeldir = modeldir or HRRR_SLR_MODEL_DIR
+        self.keys = list(SLR_FEATURES)
+        self.scaler = None
+        self.model = None
+        modelfile = os.path.join(self.modeldir, SLR_MODEL_FILE)
+        if not os.path.exists(modelfile):
+            print('SLR model '+modelfile+' not found, SLR set to 0')
+            return
+        self.keys = [str(key) for key in np.load(os.path.join(self.modeldir, SLR_KEYS_FILE), allow_pickle=True)]
+        self.scaler = np.load(os.path.join(self.modeldir, SLR_SCALER_FILE), allow_pickle=True)[()]
+        self.model = np.load(modelfile, allow_pickle=True)
+
+    @property
+    def available(self):
+        return self.model is not None
+
+    def predict(self, features):
+        """SLR for every row of features.
+
+        Args:
+            features (dict or DataFrame): SLR_FEATURES columns, one value per site/hour
+
+        Returns:
+            array: predicted SLR, 0 everywhere when the model is not available and for rows with missing
+            features (e.g. a level above the top of the HRRR profile)
+        """
+        features = pd.DataFrame(features)[self.keys]
+        slr = np.zeros(len(features))
+        valid = np.isfinite(features.to_numpy(dtype=float)).all(axis=1)
+        if not self.available or not valid.any():
+            return slr
+        features = features[valid]
+        data_norm = pd.DataFrame(self.scaler.transform(features), index=features.index, columns=features.keys())
+        slr[valid] = self.model.predict(data_norm)
+        return slr
+
+
+def get_slr_predictor(modeldir=None):
+    """The SLRPredictor of this process, loaded on first use."""
+    modeldir = modeldir or HRRR_SLR_MODEL_DIR
+    if modeldir not in _predictors:
+        _predictors[modeldir] = SLRPredictor(modeldir)
+    return _predictors[modeldir]
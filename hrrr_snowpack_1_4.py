@@ -11,9 +11,6 @@
 import numpy as np
 import pandas as pd
 import xarray as xr
-import boto3
-from botocore import UNSIGNED
-from botocore.client import Config
 import datetime
 import os
 import requests
@@ -21,226 +18,236 @@ import sys
 import glob
 from metpy.units import units
 from metpy.calc import wind_direction
-from metpy.calc import wet_bulb_temperature
 import cfgrib
-from scipy import spatial
 from sklearn.neighbors import KDTree
 from multiprocessing import Pool
+from collections import namedtuple
 from platform import python_version
 import warnings
 warnings.filterwarnings('ignore')
 import time
-
-
-
-
-# Downloads HRRR from AWS, identifies or calculates needed variables, and finds values for closest grid point to site coordinates
-# Use grib_ls <gribfilename> on the commandline on the linux system for complete list of shortName, typeOfLevel, etc.
-def processhrrr (yr, mn, dy, hr, fhr, sitelat, sitelon,siteelev,mlthick, scratchdir):
+from botocore.exceptions import ClientError
+from hrrr_fetch import HRRR_BUCKET, HRRRNotAvailable, hrrr_object_key, make_s3_client, fetch_hrrr_subset, hrrr_idx_patterns
+from hrrr_fetch import HRRR_MAX_CONCURRENCY, fetch_hrrr_file, init_worker_s3, worker_s3_client, is_not_found
+from hrrr_cache import HRRRCache, HRRR_CACHE_DIR
+from hrrr_store import PointStore, HRRR_STORE_DIR
+from hrrr_decode import decode_hrrr
+from hrrr_grid import cached_gridpoint
+from hrrr_profiles import interp_heights, wbz_heights, wet_bulb_profiles
+from hrrr_slr import get_slr_predictor
+from hrrr_scheduler import HRRR_RETRIES, HRRR_BACKOFF, HRRR_FALLBACK_CYCLES, GAP_POLICIES, run_forecast_hours
+from hrrr_pipeline import HRRR_FETCH_WORKERS, run_pipeline
+from pipeline_timing import stage, add_bytes, timed_unit
+
+
+
+
+# Output columns of processhrrr, one row per forecast hour
+COLUMNS = ['INIT (YYYYMMDDHH UTC)','FHR','Grid Point Lat','Grid Point Lon','Grid Point Elev (m)','PSFC (PA)','TSFC (K)','T2m (K)','RH2m (%)',
+           'Wind Speed 10m (m/s)','Wind Direction 10 m (deg)','Downward Short Wave (W/m2)', 'Upward Short Wave (W/m2)',
+           'Downward Long Wave (W/m2)','Upward Long Wave (W/m2)','Water Equiv Precip (mm)',
+           'Wet-Bulb Zero Height (m)','Snow-to-Liquid Ratio','Snowfall (cm)']
+
+# A forecast site: station id, lat, lon (deg), elevation (m) and depth of melting layer below wet-bulb zero (m)
+Site = namedtuple('Site', ['stid', 'lat', 'lon', 'elev', 'mlthick'])
+
+# Reads a site registry, a csv file with stid,lat,lon,elev,mlthick columns
+def load_site_registry(registryfile):
+    registry = pd.read_csv(registryfile, dtype={'stid': str}, comment='#', skipinitialspace=True)
+    return [Site(row.stid, float(row.lat), float(row.lon), float(row.elev), float(row.mlthick))
+            for row in registry.itertuples(index=False)]
+
+# Cache key of the file fetched for a forecast hour, the message subset depends on fhr when using byte ranges
+def hrrr_cache_key(yr, mn, dy, hr, fhr, byterange=True):
+    subset = [pattern.pattern for pattern in hrrr_idx_patterns(fhr)] if byterange else 'all'
+    return HRRRCache.key(str(yr)+str(mn)+str(dy)+str(hr), fhr, 'wrfprs', subset)
+
+# Fields identifying a forecast hour in the timing log
+def hour_fields(yr, mn, dy, hr, fhr, *args):
+    return {'cycle': str(yr)+str(mn)+str(dy)+str(hr), 'fhr': int(fhr)}
+
+# Downloads HRRR from AWS into scratchdir and returns the local file name
+# With a cachedir the file is taken from, or stored in, the persistent HRRR cache instead
+# Pass an s3 client to reuse its connection pool, otherwise the client of this worker process is used
+# A 404 from the GET itself means the file is not (yet) available, there is no separate HEAD request
+# Every call is a timed 'hrrr_fetch' unit (pipeline_timing.py)
+@timed_unit('hrrr_fetch', lambda *args, **kwargs: hour_fields(*args))
+def fetchhrrr (yr, mn, dy, hr, fhr, scratchdir, byterange=True, cachedir=HRRR_CACHE_DIR, s3=None):
 
     # File names and URLs on AWS and local disk
     serverfile = 'hrrr.t'+str(hr)+'z.wrfprsf'+str(fhr).zfill(2)+'.grib2'
     localfile = scratchdir+str(yr)+str(mn)+str(dy)+str(hr)+'F'+str(fhr).zfill(2)+'hrrr.grib2'
-    awsbucket_name = 'noaa-hrrr-bdp-pds'
-    awsobject_key = 'hrrr.'+str(yr)+str(mn)+str(dy)+'/conus/'+serverfile
+    awsbucket_name = HRRR_BUCKET
+    awsobject_key = hrrr_object_key(yr, mn, dy, hr, fhr)
+
+    # Use the cached copy if there is one
+    if cachedir is not None:
+        cache = HRRRCache(cachedir)
+        cachekey = hrrr_cache_key(yr, mn, dy, hr, fhr, byterange)
+        with stage('hrrr_cache'):
+            cachedfile = cache.get(cachekey)
+        if cachedfile is not None:
+            return cachedfile
 
     # boto3 settings
-    s3 = boto3.client('s3',
-                      config=Config(                                                                                                                            
-                          signature_version=UNSIGNED,  # Specify your signature version if required                                                             
-                          connect_timeout=5,           # Set connection timeout to 5 seconds                                                                             
-                          read_timeout=30,             # Set read timeout to 30 seconds                                                                                 
-                          retries={                                                                                                                             
-                              'max_attempts': 3,       # Set the maximum number of retry attempts                                                                    
-                              'mode': 'standard'       # Use the standard retry mode                                                                                
-                          }                                                                                                                                     
-                      ))
-
-
-    # Try to retrieve from AWS
-    awsraise = 0
-    try:                                                                                                                                                        
-        s3.head_object(Bucket=awsbucket_name, Key=awsobject_key)                                                                                                
-    except:
-        awsraise = 1
-
-    if awsraise == 0:
-        s3.download_file(awsbucket_name,awsobject_key,localfile)
-    else:
+    if s3 is None:
+        s3 = worker_s3_client()
+
+    # Retrieve from AWS, either just the needed messages (byterange) or the whole file
+    start = time.time()
+    try:
+        if byterange:
+            nbytes = fetch_hrrr_subset(s3, awsbucket_name, awsobject_key, localfile, fhr)
+        else:
+            nbytes = fetch_hrrr_file(s3, awsbucket_name, awsobject_key, localfile)
+    except ClientError as e:
+        if not is_not_found(e):
+            raise
         print(serverfile+' not available')
-        raise
-
-    # Load needed variables and rename to something less obtuse if needed
-    # Surface elevation (m)
-    orog_in = xr.open_dataset(localfile, decode_coords='all', engine='cfgrib', filter_by_keys={'stepType': 'instant',
-                                        'typeOfLevel': 'surface', 'shortName':'orog'}) 
-
-    # Grid-relative 10-m u wind (m/s)
-    u10m_in = xr.open_dataset(localfile, engine='cfgrib', filter_by_keys={'typeOfLevel': 'heightAboveGround',
-                                        'stepType':'instant', 'shortName':'10u'}).rename({'u10':'u10m'})
-    
-    # Grid-relative 10-m v wind (m/s)
-    v10m_in = xr.open_dataset(localfile, engine='cfgrib', filter_by_keys={'typeOfLevel': 'heightAboveGround',
-                                        'stepType':'instant', 'shortName':'10v'}).rename({'v10':'v10m'}) 
-    
-    # 2-m temperature (K)
-    t2m_in = xr.open_dataset(localfile, engine='cfgrib', filter_by_keys={'typeOfLevel': 'heightAboveGround',
-                                        'stepType':'instant', 'shortName':'2t'})   # Variable name is t2m in dataset
+        raise HRRRNotAvailable(serverfile+' not available') from e
+    print(serverfile+': '+str(round(nbytes/1e6, 1))+' MB in '+str(round(time.time() - start, 3))+' s')
 
-    # 2-m rh (%)
-    rh2m_in = xr.open_dataset(localfile, engine='cfgrib', filter_by_keys={'typeOfLevel': 'heightAboveGround',
-                                        'stepType':'instant', 'shortName':'2r'}).rename({'r2':'rh2m'})
-    
-    # Surface temperature (K)
-    tsfc_in = xr.open_dataset(localfile, engine='cfgrib', filter_by_keys={'typeOfLevel': 'surface',
-                                        'stepType':'instant', 'shortName':'t'}).rename({'t':'tsfc'}) 
-    
-    # Surface pressure (Pa)
-    psfc_in = xr.open_dataset(localfile, engine='cfgrib', filter_by_keys={'typeOfLevel': 'surface',
-                                        'stepType':'instant', 'shortName':'sp'}).rename({'sp':'psfc'}) 
-    
-    # Surface downward shortwave radiation (W/m**2)
-    dswrf_in = xr.open_dataset(localfile, engine='cfgrib', filter_by_keys={'typeOfLevel': 'surface',
-                                        'stepType':'instant', 'shortName':'dswrf'})
+    if cachedir is not None:
+        with stage('hrrr_cache'):
+            localfile = cache.put(cachekey, localfile)
 
-    # Surface upward shortwave radiation (W/m**2)
-    uswrf_in = xr.open_dataset(localfile, engine='cfgrib', filter_by_keys={'typeOfLevel': 'surface',
-                                        'stepType':'instant', 'shortName':'uswrf'})
+    return localfile
 
-    # Surface downward longwave radiation (W/m**2)
-    dlwrf_in = xr.open_dataset(localfile, engine='cfgrib', filter_by_keys={'typeOfLevel': 'surface',
-                                        'stepType':'instant', 'shortName':'dlwrf'})
-    
-    # Surface upward longwave radiation (W/m**2)
-    ulwrf_in = xr.open_dataset(localfile, engine='cfgrib', filter_by_keys={'typeOfLevel': 'surface',
-                                        'stepType':'instant', 'shortName':'ulwrf'})
-    
-    # Grid-relative pressure-level u wind (m/s) 
-    upress_in = xr.open_dataset(localfile, decode_coords='all', engine='cfgrib', filter_by_keys={'typeOfLevel': 'isobaricInhPa',
-                                        'stepType':'instant', 'shortName':'u'}).rename({'u':'upress'}) 
+# Downloads HRRR from AWS, identifies or calculates needed variables, and finds values for the closest grid point to
+# every site in sites.  The file is fetched and decoded once however many sites there are.  Returns one tuple per site.
+# With a storedir the rows are also written to the point forecast store (hrrr_store.py) as soon as they are computed.
+def processhrrr_sites (yr, mn, dy, hr, fhr, sites, scratchdir, byterange=True, cachedir=HRRR_CACHE_DIR, storedir=None):
 
-    # Grid-relative pressure-level v wind (m/s)
-    vpress_in = xr.open_dataset(localfile, decode_coords='all', engine='cfgrib', filter_by_keys={'typeOfLevel': 'isobaricInhPa',
-                                        'stepType':'instant', 'shortName':'v'}).rename({'v':'vpress'}) 
-    
-    # Pressure-level geopotential height (m)
-    hpress_in = xr.open_dataset(localfile, decode_coords='all', engine='cfgrib', filter_by_keys={'typeOfLevel': 'isobaricInhPa',
-                                        'stepType':'instant', 'shortName':'gh'}).rename({'gh':'hpress'}) 
-
-    # Pressure level temperature 
-    tpress_in = xr.open_dataset(localfile, decode_coords='all', engine='cfgrib', filter_by_keys={'typeOfLevel': 'isobaricInhPa',
-                                        'stepType':'instant', 'shortName':'t'}).rename({'t':'tpress'}) 
-
-    # Pressure level dewpoint temperature
-    tdpress_in = xr.open_dataset(localfile, decode_coords='all', engine='cfgrib', filter_by_keys={'typeOfLevel': 'isobaricInhPa',
-                                        'stepType':'instant', 'shortName':'dpt'}).rename({'dpt':'tdpress'}) 
-
-    # Hourly water-equivalent precipitation (kg/m**2 which is same as mm)
-    if fhr == 0:
-        hourly_precip_in = xr.open_dataset(localfile, engine='cfgrib', filter_by_keys={
-                                        'stepRange': str(fhr), 'shortName':'tp'}).rename({'tp' : 'hourlyprecip'})
-    else:
-        prev_fhr = fhr - 1
-        hourly_precip_in = xr.open_dataset(localfile, engine='cfgrib', filter_by_keys={
-                                        'stepRange': str(prev_fhr)+'-'+str(fhr), 'shortName':'tp'}).rename({'tp' : 'hourlyprecip'})
+    localfile = fetchhrrr(yr, mn, dy, hr, fhr, scratchdir, byterange, cachedir)
+    return processhrrrfile(localfile, yr, mn, dy, hr, fhr, sites, scratchdir, storedir)
 
-    # Merge into single dataset
-    hrrrdata = xr.merge([orog_in,u10m_in,v10m_in,t2m_in,rh2m_in, tsfc_in, psfc_in, dswrf_in,uswrf_in,dlwrf_in,
-                         ulwrf_in,upress_in,vpress_in,hpress_in,tpress_in,tdpress_in,hourly_precip_in], compat='override') 
-
-    # Calculate 10-m wind speed
-    hrrrdata = hrrrdata.assign(wspd10m=(hrrrdata['u10m']**2 + hrrrdata['v10m']**2)**0.5)
-
-    # Calculate pressure level wind speeds
-    hrrrdata = hrrrdata.assign(wspdpress=(hrrrdata['upress']**2 + hrrrdata['vpress']**2)**0.5)
-    
-    # Grid rotate winds and store as u10mearth and v10mearth (see https://rapidrefresh.noaa.gov/faq/HRRR.faq.html)
-    rotcon, lonp, latp =.0622515, -97.5, 38.5
-    angle2 = rotcon*(hrrrdata['latitude'] - lonp)*0.017453
-    sinx2, cosx2 = np.sin(angle2), np.cos(angle2)
-    hrrrdata = hrrrdata.assign(u10m_er=cosx2*hrrrdata['u10m']+sinx2*hrrrdata['v10m'])
-    hrrrdata = hrrrdata.assign(v10m_er=-sinx2*hrrrdata['u10m']+cosx2*hrrrdata['v10m'])
-    hrrrdata.u10m_er.attrs['units'] = 'm s**-1'
-    hrrrdata.v10m_er.attrs['units'] = 'm s**-1'
-
-    # Calculate earth-relative wind direction
-    hrrrdata = hrrrdata.assign(wdir10m=wind_direction(hrrrdata['u10m_er'],hrrrdata['v10m_er']))
-
-    # Get data for gridpoint closest to site coordinates and save in dataframe
-    # See https://github.com/blaylockbk/pyBKB_v3/blob/master/demo/KDTree_nearest_neighbor.ipynb
-    lons = hrrrdata.longitude.values
-    lats = hrrrdata.latitude.values
-    tree = spatial.KDTree(np.column_stack([lons.ravel(), lats.ravel()]))
-    point = np.array([sitelon+360., sitelat])  # Add 360 to match HRRR lons 
-    dist, idx = tree.query(point)
-    y,x = np.unravel_index(idx,lons.shape)
+# Decode and compute stage of processhrrr_sites for an HRRR file that has already been fetched to localfile
+# Use grib_ls <gribfilename> on the commandline on the linux system for complete list of shortName, typeOfLevel, etc.
+# Every call is a timed 'hrrr_decode' unit (pipeline_timing.py)
+@timed_unit('hrrr_decode', lambda localfile, *args, **kwargs: hour_fields(*args))
+def processhrrrfile (localfile, yr, mn, dy, hr, fhr, sites, scratchdir, storedir=None):
+
+    # Grid points closest to the site coordinates, straight from the Lambert conformal projection and cached across runs
+    def sitepoints(grid):
+        with stage('neighbor_lookup'):
+            gridpoints = [cached_gridpoint(site.lat, site.lon, grid, scratchdir+'hrrr_site_index.json') for site in sites]
+        return np.array([gridpoint[0] for gridpoint in gridpoints]), np.array([gridpoint[1] for gridpoint in gridpoints])
+
+    # Load needed variables in a single pass over the file (see hrrr_decode.py for the field list)
+    # Every field is sampled at the site grid points while decoding, so all math below runs on one value per site
+    # (and one profile per site for the isobaric fields, shaped (level, site)) rather than the full CONUS grid
+    # (the neighbor lookup runs inside and is part of grib_decode)
+    with stage('grib_decode'):
+        hrrrdata = decode_hrrr(localfile, fhr, gridpoints=sitepoints)
+
+    with stage('derived'):
+        # Calculate 10-m wind speed
+        hrrrdata['wspd10m'] = (hrrrdata['u10m']**2 + hrrrdata['v10m']**2)**0.5
+
+        # Calculate pressure level wind speeds
+        hrrrdata['wspdpress'] = (hrrrdata['upress']**2 + hrrrdata['vpress']**2)**0.5
+
+        # Grid rotate winds and store as u10mearth and v10mearth (see https://rapidrefresh.noaa.gov/faq/HRRR.faq.html)
+        rotcon, lonp, latp =.0622515, -97.5, 38.5
+        angle2 = rotcon*(hrrrdata['latitude'] - lonp)*0.017453
+        sinx2, cosx2 = np.sin(angle2), np.cos(angle2)
+        hrrrdata['u10m_er'] = cosx2*hrrrdata['u10m']+sinx2*hrrrdata['v10m']
+        hrrrdata['v10m_er'] = -sinx2*hrrrdata['u10m']+cosx2*hrrrdata['v10m']
+
+        # Calculate earth-relative wind direction
+        hrrrdata['wdir10m'] = wind_direction(hrrrdata['u10m_er'] * units('m/s'), hrrrdata['v10m_er'] * units('m/s')).magnitude
+
+    # Get data for gridpoints closest to site coordinates
     yyyymmddhh = str(yr)+str(mn)+str(dy)+str(hr)
     ifhr = int(fhr)
-    nearest_lat = np.round(hrrrdata.latitude.isel(x=x,y=y).values,3)   
-    nearest_lon = np.round(hrrrdata.longitude.isel(x=x,y=y).values - 360.,3)  # Subtract 360 for negative wes lon
-    nearest_elev = np.round(hrrrdata.orog.isel(x=x,y=y).values,3)
-    nearest_psfc = np.round(hrrrdata.psfc.isel(x=x,y=y).values,3)
-    nearest_tsfc = np.round(hrrrdata.tsfc.isel(x=x,y=y).values,3)
-    nearest_t2m = np.round(hrrrdata.t2m.isel(x=x,y=y).values,3)
-    nearest_rh2m = np.round(hrrrdata.rh2m.isel(x=x,y=y).values,3)
-    nearest_wspd10m = np.round(hrrrdata.wspd10m.isel(x=x,y=y).values,3)
-    nearest_wdir10m = np.round(hrrrdata.wdir10m.isel(x=x,y=y).values,3)
-    nearest_dswrf = np.round(hrrrdata.dswrf.isel(x=x,y=y).values,3)
-    nearest_uswrf = np.round(hrrrdata.uswrf.isel(x=x,y=y).values,3)
-    nearest_dlwrf = np.round(hrrrdata.dlwrf.isel(x=x,y=y).values,3)
-    nearest_ulwrf = np.round(hrrrdata.ulwrf.isel(x=x,y=y).values,3)
-    nearest_hourlyprecip = np.round(hrrrdata.hourlyprecip.isel(x=x,y=y).values,3)
-
-    # Create height-level data (AGL) needed for producing SLR forecast
-    data = {
-        'T05K' : [valheight(hrrrdata.tpress.isel(x=x,y=y).values,hrrrdata.hpress.isel(x=x,y=y).values,siteelev+500)],
-        'T1K'  : [valheight(hrrrdata.tpress.isel(x=x,y=y).values,hrrrdata.hpress.isel(x=x,y=y).values,siteelev+1000)],  
-        'T2K'  : [valheight(hrrrdata.tpress.isel(x=x,y=y).values,hrrrdata.hpress.isel(x=x,y=y).values,siteelev+2000)],  
-        'SPD05K' : [valheight(hrrrdata.wspdpress.isel(x=x,y=y).values,hrrrdata.hpress.isel(x=x,y=y).values,siteelev+500)],
-        'SPD1K'  : [valheight(hrrrdata.wspdpress.isel(x=x,y=y).values,hrrrdata.hpress.isel(x=x,y=y).values,siteelev+1000)],
-        'SPD2K'  : [valheight(hrrrdata.wspdpress.isel(x=x,y=y).values,hrrrdata.hpress.isel(x=x,y=y).values,siteelev+2000)]
-    }
-    slrdf = pd.DataFrame(data)
-
-    # Load keys, scalar, and model and run random forest for slr
-    #keys = np.load('./SingleSite_slr_model_keysAGL30.npy', allow_pickle=True)
-    #scaler = np.load('./SingleSite_slr_model_scalerAGL30.npy', allow_pickle=True)[()]
-    #model = np.load('./SingleSite_RF_slr_modelAGL30.pickle', allow_pickle=True)
-    #data_norm = pd.DataFrame(scaler.transform(slrdf), index=slrdf.index, columns=slrdf.keys())
-    #nearest_slr = float(model.predict(data_norm))
-
-    # Get wet bulb temperature profile for snow level calculation
-    nearest_wbprofile = wet_bulb_temperature(hrrrdata.isobaricInhPa.values * units.hPa,
-                                             hrrrdata.tpress.isel(x=x,y=y).values * units.degK,
-                                             hrrrdata.tdpress.isel(x=x,y=y).values * units.degK)
-    
-
-    # Determine wet-bulb zero height 
-    nearest_wbzheight = np.round(calcwbzlevel(nearest_wbprofile.magnitude - 273.15, hrrrdata.hpress.isel(x=x,y=y).values),1)
-    
-    
-    # Adjust SLR if site below wet-bulb zero height
-    nearest_slr = 0 # allocate slr otherwise throws error if not assigned in if statement
-    # Decreases SLR linearly to zero at mlthick distance below wet-bulb zero height
-    if nearest_wbzheight > siteelev and nearest_wbzheight < siteelev + mlthick:
-        nearest_slr = nearest_slr*(siteelev+mlthick-nearest_wbzheight)/mlthick
-    elif nearest_wbzheight > siteelev+mlthick:
-        nearest_slr = 0.0
-
-    # If SLR < 3 just make it zero
-    if nearest_slr < 3:
-        nearest_slr = 0
-
-    nearest_slr = np.round(nearest_slr,1)
+    nearest_lat = np.round(hrrrdata['latitude'],3)   
+    nearest_lon = np.round(hrrrdata['longitude'] - 360.,3)  # Subtract 360 for negative wes lon
+    nearest_elev = np.round(hrrrdata['orog'],3)
+    nearest_psfc = np.round(hrrrdata['psfc'],3)
+    nearest_tsfc = np.round(hrrrdata['tsfc'],3)
+    nearest_t2m = np.round(hrrrdata['t2m'],3)
+    nearest_rh2m = np.round(hrrrdata['rh2m'],3)
+    nearest_wspd10m = np.round(hrrrdata['wspd10m'],3)
+    nearest_wdir10m = np.round(hrrrdata['wdir10m'],3)
+    nearest_dswrf = np.round(hrrrdata['dswrf'],3)
+    nearest_uswrf = np.round(hrrrdata['uswrf'],3)
+    nearest_dlwrf = np.round(hrrrdata['dlwrf'],3)
+    nearest_ulwrf = np.round(hrrrdata['ulwrf'],3)
+    nearest_hourlyprecip = np.round(hrrrdata['hourlyprecip'],3)
+
+    # Profiles at the site grid points, shaped (level, site)
+    tpress = hrrrdata['tpress']
+    tdpress = hrrrdata['tdpress']
+    hpress = hrrrdata['hpress']
+    wspdpress = hrrrdata['wspdpress']
+
+    # Create height-level data (AGL) needed for producing SLR forecast, every site and height in one call (hrrr_profiles.py)
+    aglheights = np.array([[site.elev+500, site.elev+1000, site.elev+2000] for site in sites])
+    with stage('derived'):
+        tagl = interp_heights(tpress.T, hpress.T, aglheights)
+        spdagl = interp_heights(wspdpress.T, hpress.T, aglheights)
+
+    with stage('wet_bulb'):
+        # Get wet bulb temperature profiles for snow level calculation, every level of every site at once
+        nearest_wbprofiles = wet_bulb_profiles(hrrrdata['isobaricInhPa'], tpress.T, tdpress.T)
+
+        # Determine wet-bulb zero heights
+        nearest_wbzheights = np.round(wbz_heights(nearest_wbprofiles - 273.15, hpress.T),1)
+
+    # Random forest SLR for every site in one call, the model is loaded once per process (hrrr_slr.py)
+    slrdf = pd.DataFrame({
+        'T05K' : tagl[:,0],
+        'T1K'  : tagl[:,1],
+        'T2K'  : tagl[:,2],
+        'SPD05K' : spdagl[:,0],
+        'SPD1K'  : spdagl[:,1],
+        'SPD2K'  : spdagl[:,2]
+    })
+    with stage('slr'):
+        slrs = get_slr_predictor().predict(slrdf)
+
+    output = []
+    for i, site in enumerate(sites):
+        siteelev, mlthick = site.elev, site.mlthick
+        nearest_wbzheight = nearest_wbzheights[i]
+        nearest_slr = slrs[i]
+
+        # Adjust SLR if site below wet-bulb zero height
+        # Decreases SLR linearly to zero at mlthick distance below wet-bulb zero height
+        if nearest_wbzheight > siteelev and nearest_wbzheight < siteelev + mlthick:
+            nearest_slr = nearest_slr*(siteelev+mlthick-nearest_wbzheight)/mlthick
+        elif nearest_wbzheight > siteelev+mlthick:
+            nearest_slr = 0.0
+
+        # If SLR < 3 just make it zero
+        if nearest_slr < 3:
+            nearest_slr = 0
+
+        nearest_slr = np.round(nearest_slr,1)
+            
+        # Calculate snowfall...convert to cm
+        nearest_snow = np.round((nearest_hourlyprecip[i] * nearest_slr)/10,1)
         
-    # Calculate snowfall...convert to cm
-    nearest_snow = np.round((nearest_hourlyprecip * nearest_slr)/10,1)
-    
-    return (
-        yyyymmddhh, ifhr, nearest_lat, nearest_lon, nearest_elev, nearest_psfc, nearest_tsfc, nearest_t2m, nearest_rh2m,
-        nearest_wspd10m, nearest_wdir10m, nearest_dswrf, nearest_uswrf, nearest_dlwrf,
-        nearest_ulwrf, nearest_hourlyprecip, nearest_wbzheight, nearest_slr, nearest_snow
-        )
+        output.append((
+            yyyymmddhh, ifhr, nearest_lat[i], nearest_lon[i], nearest_elev[i], nearest_psfc[i], nearest_tsfc[i], nearest_t2m[i],
+            nearest_rh2m[i], nearest_wspd10m[i], nearest_wdir10m[i], nearest_dswrf[i], nearest_uswrf[i], nearest_dlwrf[i],
+            nearest_ulwrf[i], nearest_hourlyprecip[i], nearest_wbzheight, nearest_slr, nearest_snow
+            ))
+
+    if storedir is not None:
+        with stage('store_write'):
+            PointStore(storedir).write(yyyymmddhh, ifhr, sites, output, COLUMNS)
+    return output
+
+# Pool initializer, builds the S3 client and loads the SLR model once per worker process
+def init_hrrr_worker():
+    init_worker_s3()
+    get_slr_predictor()
+
+# Single site version of processhrrr_sites, returns one tuple of COLUMNS
+def processhrrr (yr, mn, dy, hr, fhr, sitelat, sitelon,siteelev,mlthick, scratchdir, byterange=True, cachedir=HRRR_CACHE_DIR):
+    site = Site(None, sitelat, sitelon, siteelev, mlthick)
+    return processhrrr_sites(yr, mn, dy, hr, fhr, [site], scratchdir, byterange, cachedir)[0]
 
 # Calculates height of wet-bulb zero
 def calcwbzlevel(twvals,zvals):
@@ -273,20 +280,94 @@ def delhrrrfiles():
         for file in filelist:
             os.remove(file)
 
-def get_hrrr_forecast(forecast_start_time,sitelat,sitelon,siteelev = 2668.0,mlthick = 300,maxprocesses = 10):
-    """_summary_
+# Cycle date strings and last forecast hour (48 h for 00, 06, 12, 18 UTC, 18 h otherwise) for a start time
+def hrrr_cycle(forecast_start_time):
+    # Get rid of mm ss and extract yr mn dy hr
+    run_date = forecast_start_time.strftime('%Y-%m-%d-%H')
+    yr,mn,dy,hr = str(run_date).split('-')
+    if (hr == '00' or hr == '06' or hr == '12' or hr == '18'):
+        maxfhr = 48
+    else:
+        maxfhr = 18 
+    return yr, mn, dy, hr, maxfhr
+
+# Rows standing in for forecast hour fhr of a cycle that could not be produced.  With gap_policy 'previous' the
+# most recent earlier cycle (up to fallback_cycles hours back) with a forecast valid at the same time is used, taken
+# from the point forecast store or computed, and its rows keep their own INIT and FHR.  Otherwise, or if no earlier
+# cycle has it either, nodata rows (NaN) are returned.  Returns the rows and a description of where they came from.
+def fillhrrrgap (yr, mn, dy, hr, fhr, sites, scratchdir, byterange=True, cachedir=HRRR_CACHE_DIR, storedir=None,
+                 gap_policy='previous', fallback_cycles=HRRR_FALLBACK_CYCLES):
+
+    cycle_time = datetime.datetime.strptime(yr+mn+dy+hr, '%Y%m%d%H')
+    if gap_policy == 'previous':
+        for lag in range(1, fallback_cycles+1):
+            pyr,pmn,pdy,phr,pmaxfhr = hrrr_cycle(cycle_time - datetime.timedelta(hours=lag))
+            pfhr = int(fhr) + lag
+            if pfhr > pmaxfhr:
+                continue
+            if storedir is not None:
+                stored = PointStore(storedir).read_hour(pyr+pmn+pdy+phr, pfhr, sites)
+                if stored is not None:
+                    return list(zip(*(stored[column].to_numpy() for column in COLUMNS))), pyr+pmn+pdy+phr+'F'+str(pfhr).zfill(2)
+            try:
+                rows = processhrrr_sites(pyr, pmn, pdy, phr, pfhr, sites, scratchdir, byterange, cachedir, storedir)
+            except Exception as e:
+                print('Fallback to '+pyr+pmn+pdy+phr+'F'+str(pfhr).zfill(2)+' failed: '+str(e))
+                continue
+            return rows, pyr+pmn+pdy+phr+'F'+str(pfhr).zfill(2)
+
+    nodata = tuple([np.nan]*(len(COLUMNS)-2))
+    return [(yr+mn+dy+hr, int(fhr)) + nodata for site in sites], 'nodata'
+
+@timed_unit('hrrr_forecast', lambda forecast_start_time, sites, *args, **kwargs: {
+    'cycle': forecast_start_time.strftime('%Y%m%d%H'), 'sites': len(sites)})
+def get_hrrr_forecast_sites(forecast_start_time, sites, maxprocesses = 10, byterange = True, long_format = False, csvdir = './',
+                            cachedir = HRRR_CACHE_DIR, storedir = HRRR_STORE_DIR, retries = HRRR_RETRIES,
+                            backoff = HRRR_BACKOFF, gap_policy = 'previous', pipeline = True,
+                            fetchworkers = HRRR_FETCH_WORKERS, on_hour = None):
+    """HRRR point forecasts for a whole registry of sites from one pass over each forecast hour.
+
+    Each forecast hour is fetched and decoded once and all sites are sampled from it, so the cost scales
+    with the number of forecast hours rather than hours x sites.
 
     Args:
-        forecast_start_time (_type_): _description_
-        sitelat (_type_): _description_
-        sitelon (_type_): _description_
-        siteelev (float, optional): _description_. Defaults to 2668.0.
-        mlthick (int, optional): _description_. Defaults to 300.
-        maxprocesses (int, optional): _description_. Defaults to 10.
+        forecast_start_time (datetime): start of the HRRR cycle to use
+        sites (list): Site tuples, e.g. from load_site_registry
+        maxprocesses (int, optional): maximum number of parallel (decode) processes. Defaults to 10.
+        byterange (bool, optional): fetch only the needed GRIB messages using the .idx inventory. Defaults to True.
+        long_format (bool, optional): return one table with a 'Station ID' column instead of one per site.
+            Defaults to False.
+        csvdir (str, optional): directory for the hrrr_to_snowpack_<stid>_YYYYMMDDHH.csv files, None to skip
+            writing them. Defaults to './'.
+        cachedir (str, optional): persistent HRRR file cache (see hrrr_cache.py), None to always download.
+            Defaults to HRRR_CACHE_DIR.
+        storedir (str, optional): point forecast store (see hrrr_store.py).  Forecast hours already stored for all
+            sites are loaded instead of recomputed and new ones are written as they finish.  None to always
+            recompute.  Defaults to HRRR_STORE_DIR.
+        retries (int, optional): retries of a forecast hour that fails, e.g. because the cycle is still being
+            published. Defaults to HRRR_RETRIES.
+        backoff (float, optional): delay (s) before the first retry, doubled for each further retry.
+            Defaults to HRRR_BACKOFF.
+        gap_policy (str, optional): what to do with forecast hours that still fail after the retries:
+            'previous' uses the forecast valid at the same time from an earlier cycle (see fillhrrrgap), 'nodata'
+            fills them with NaN and 'raise' raises HRRRNotAvailable.  Defaults to 'previous'.
+        pipeline (bool, optional): download in fetchworkers threads while maxprocesses processes decode
+            (see hrrr_pipeline.py) rather than each process doing both in turn. Defaults to True.
+        fetchworkers (int, optional): concurrent downloads of the pipeline. Defaults to HRRR_FETCH_WORKERS.
+        on_hour (callable, optional): on_hour(fhr, tables) is called with a one-row COLUMNS table per station id
+            for every forecast hour, in forecast hour order, as soon as it and all hours before it are done.
+            Lets callers write the forecast horizon reached so far while later hours are still running.
 
     Returns:
-        _type_: _description_
+        dict or DataFrame: COLUMNS table per station id, or a single long-format table.  Forecast hours that
+        were filled are listed in the attrs['hrrr_gaps'] of each table as {fhr: source}.
+
+    Every call is a timed 'hrrr_forecast' unit, and every forecast hour an 'hrrr_fetch' and an 'hrrr_decode'
+    unit, written to TIMING_LOG (see pipeline_timing.py).
     """
+    if gap_policy not in GAP_POLICIES:
+        raise ValueError('gap_policy must be one of '+str(GAP_POLICIES))
+
     # Create global var for the scratch dir
     # Scratch directory to temporarily store HRRR grib files
     scratchdir = './hrrr_scratch/'
@@ -295,41 +376,147 @@ def get_hrrr_forecast(forecast_start_time,sitelat,sitelon,siteelev = 2668.0,mlth
     if not os.path.exists(scratchdir):
         os.makedirs(scratchdir)
 
-    # Get rid of mm ss and extract yr mn dy hr
-    run_date = forecast_start_time.strftime('%Y-%m-%d-%H')
-    yr,mn,dy,hr = str(run_date).split('-')
-    if (hr == '00' or hr == '06' or hr == '12' or hr == '18'):
-        maxfhr = 48
-    else:
-        maxfhr = 18 
-    fhrs = tuple(range(maxfhr+1))
-    items = [(yr,mn,dy,hr,fhr) for fhr in fhrs]
+    yr,mn,dy,hr,maxfhr = hrrr_cycle(forecast_start_time)
 
     # Parallel process if requested
     # Must be run parallel to get output file
     start_time = time.time()
 
     fhrs = tuple(range(maxfhr+1))
-    items = [(yr,mn,dy,hr,fhr,sitelat,sitelon, siteelev, mlthick,scratchdir) for fhr in fhrs]
-    processes = min(maxfhr+1, maxprocesses)
-    print('Running with '+str(processes)+' processes')
-    with Pool(processes=processes) as p:
-        output = p.starmap(processhrrr, items)
-    columns = ['INIT (YYYYMMDDHH UTC)','FHR','Grid Point Lat','Grid Point Lon','Grid Point Elev (m)','PSFC (PA)','TSFC (K)','T2m (K)','RH2m (%)',
-            'Wind Speed 10m (m/s)','Wind Direction 10 m (deg)','Downward Short Wave (W/m2)', 'Upward Short Wave (W/m2)',
-            'Downward Long Wave (W/m2)','Upward Long Wave (W/m2)','Water Equiv Precip (mm)',
-            'Wet-Bulb Zero Height (m)','Snow-to-Liquid Ratio','Snowfall (cm)']
-    sitedf = pd.DataFrame(output, columns=columns)
-    sitedf.to_csv('./hrrr_to_snowpack_'+yr+mn+dy+hr+'.csv', index=False)
+    output = {}
+    streamed = [0]
+
+    def stream():
+        # Hand the finished forecast hours at the front of the horizon to on_hour
+        while on_hour is not None and streamed[0] < len(fhrs) and fhrs[streamed[0]] in output:
+            fhr = fhrs[streamed[0]]
+            on_hour(fhr, {site.stid: pd.DataFrame([output[fhr][i]], columns=COLUMNS) for i, site in enumerate(sites)})
+            streamed[0] += 1
+
+    def finished(fhr, rows):
+        output[fhr] = rows
+        stream()
+
+    # Load forecast hours already in the point forecast store
+    if storedir is not None:
+        store = PointStore(storedir)
+        for fhr in fhrs:
+            with stage('store_read'):
+                stored = store.read_hour(yr+mn+dy+hr, fhr, sites)
+            if stored is not None:
+                # Numpy scalars keep the column dtypes of freshly computed rows
+                output[fhr] = list(zip(*(stored[column].to_numpy() for column in COLUMNS)))
+        if len(output) > 0:
+            print('Loaded '+str(len(output))+' forecast hours from '+storedir)
+    stream()
+    items = [(yr,mn,dy,hr,fhr,sites,scratchdir,byterange,cachedir,storedir) for fhr in fhrs if fhr not in output]
+
+    # Forecast hours already in the cache will not be downloaded
+    if cachedir is not None:
+        cache = HRRRCache(cachedir)
+        for item in items:
+            if cache.contains(hrrr_cache_key(yr, mn, dy, hr, item[4], byterange)):
+                cache.hits += 1
+            else:
+                cache.misses += 1
+
+    # Each forecast hour is retried on its own, hours that finish are checkpointed in the store
+    failures = {}
+    if len(items) > 0 and pipeline:
+        processes = min(len(items), maxprocesses)
+        print('Running with '+str(fetchworkers)+' fetch threads and '+str(processes)+' decode processes for '
+              + str(len(sites))+' sites')
+        # Whole-file downloads fetch several chunks at a time
+        s3 = make_s3_client(max_pool_connections=fetchworkers if byterange else fetchworkers*HRRR_MAX_CONCURRENCY)
+        stages = [(item[:5]+(scratchdir,byterange,cachedir,s3), item[:6]+(scratchdir,storedir)) for item in items]
+        results, failures, stats = run_pipeline(fetchhrrr, processhrrrfile, stages, lambda stage: stage[0][4],
+                                                fetchworkers, processes, retries=retries, backoff=backoff,
+                                                initializer=get_slr_predictor, on_result=finished)
+        output.update(results)
+        print('Pipeline: '+str(round(stats['fhr_per_min'], 1))+' forecast hours/min, fetch '
+              + str(round(stats['fetch'], 1))+' s, decode '+str(round(stats['decode'], 1))+' s')
+    elif len(items) > 0:
+        processes = min(len(items), maxprocesses)
+        print('Running with '+str(processes)+' processes for '+str(len(sites))+' sites')
+        results, failures = run_forecast_hours(processhrrr_sites, items, lambda item: item[4], processes,
+                                               retries, backoff, initializer=init_hrrr_worker,
+                                               on_result=finished)
+        output.update(results)
+
+    # Fill the forecast hours that could not be produced
+    gaps = {}
+    if len(failures) > 0:
+        print('HRRR forecast hours not available: '+str(sorted(failures)))
+        if gap_policy == 'raise':
+            raise HRRRNotAvailable('HRRR '+yr+mn+dy+hr+' forecast hours '+str(sorted(failures))+' not available')
+        for fhr in sorted(failures):
+            output[fhr], gaps[fhr] = fillhrrrgap(yr, mn, dy, hr, fhr, sites, scratchdir, byterange, cachedir,
+                                                 storedir, gap_policy)
+            print('F'+str(fhr).zfill(2)+' filled from '+gaps[fhr])
+    stream()
+    output = [output[fhr] for fhr in fhrs]
+
+    # output is [fhr][site], regroup into a table per site
+    sitedfs = {}
+    for i, site in enumerate(sites):
+        sitedfs[site.stid] = pd.DataFrame([rows[i] for rows in output], columns=COLUMNS)
+        sitedfs[site.stid].attrs['hrrr_gaps'] = gaps
+        if csvdir is not None:
+            csvfile = os.path.join(csvdir, 'hrrr_to_snowpack_'+str(site.stid)+'_'+yr+mn+dy+hr+'.csv')
+            with stage('csv_write'):
+                sitedfs[site.stid].to_csv(csvfile, index=False)
+            add_bytes('csv_write', os.path.getsize(csvfile))
 
     # Delete any existing grib2 or idx files
     delhrrrfiles()
+    if cachedir is not None:
+        # Hits and misses from the check above, the files are stored (and evicted) by the fetch workers
+        print(cache.report(evictions=False))
 
     end_time = time.time()
     elapsed_time = end_time - start_time
     print('Elapsed time to get HRRR forcast: ' + str(elapsed_time))
     print('HRRR Processing complete')
 
+    if long_format:
+        longdf = pd.concat([sitedf.assign(**{'Station ID': stid}) for stid, sitedf in sitedfs.items()],
+                           ignore_index=True)[['Station ID'] + COLUMNS]
+        longdf.attrs['hrrr_gaps'] = gaps
+        return longdf
+    return sitedfs
+
+def get_hrrr_forecast(forecast_start_time,sitelat,sitelon,siteelev = 2668.0,mlthick = 300,maxprocesses = 10,byterange = True,
+                      cachedir = HRRR_CACHE_DIR, storedir = HRRR_STORE_DIR, retries = HRRR_RETRIES, backoff = HRRR_BACKOFF,
+                      gap_policy = 'previous'):
+    """_summary_
+
+    Args:
+        forecast_start_time (_type_): _description_
+        sitelat (_type_): _description_
+        sitelon (_type_): _description_
+        siteelev (float, optional): _description_. Defaults to 2668.0.
+        mlthick (int, optional): _description_. Defaults to 300.
+        maxprocesses (int, optional): _description_. Defaults to 10.
+        byterange (bool, optional): fetch only the needed GRIB messages using the .idx inventory
+            instead of the whole wrfprs file. Defaults to True.
+        cachedir (str, optional): persistent HRRR file cache, None to always download. Defaults to HRRR_CACHE_DIR.
+        storedir (str, optional): point forecast store, None to always recompute. Defaults to HRRR_STORE_DIR.
+        retries (int, optional): retries of a forecast hour that fails. Defaults to HRRR_RETRIES.
+        backoff (float, optional): delay (s) before the first retry, doubled for each further retry.
+            Defaults to HRRR_BACKOFF.
+        gap_policy (str, optional): 'previous', 'nodata' or 'raise', see get_hrrr_forecast_sites.
+            Defaults to 'previous'.
+
+    Returns:
+        _type_: _description_
+    """
+    site = Site('site', sitelat, sitelon, siteelev, mlthick)
+    sitedf = get_hrrr_forecast_sites(forecast_start_time, [site], maxprocesses, byterange, csvdir=None,
+                                     cachedir=cachedir, storedir=storedir, retries=retries, backoff=backoff,
+                                     gap_policy=gap_policy)[site.stid]
+    yr,mn,dy,hr,maxfhr = hrrr_cycle(forecast_start_time)
+    sitedf.to_csv('./hrrr_to_snowpack_'+yr+mn+dy+hr+'.csv', index=False)
+
     return sitedf
 
 # ------------------ MAIN PROGRAM ----------------
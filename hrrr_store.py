@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Columnar store of HRRR point forecasts
+#
+# Every (cycle, fhr) computed by processhrrr_sites is written as soon as it is done to a Parquet
+# file in a directory partitioned by cycle:
+#
+#     <storedir>/cycle=YYYYMMDDHH/fhr=NN.parquet
+#
+# one row per site.  Reruns of a cycle, retries after a crash and other consumers (e.g.
+# mesowest_to_smet_forecast) load those rows instead of fetching and decoding HRRR again, and the
+# directory doubles as a queryable archive (pd.read_parquet(storedir) reads the whole thing).
+#
+import os
+import glob
+import pandas as pd
+
+# Store location, overridable from the environment
+HRRR_STORE_DIR = os.environ.get('HRRR_STORE_DIR', './hrrr_store/')
+
+# Columns identifying the site a row belongs to
+SITE_COLUMNS = ['Station ID', 'Site Lat', 'Site Lon', 'Site Elev (m)', 'Melting Layer (m)']
+
+
+class PointStore:
+    """Parquet store of processhrrr_sites results.
+
+    Args:
+        storedir (str, optional): root of the store, created if needed. Defaults to HRRR_STORE_DIR.
+    """
+
+    def __init__(self, storedir=None):
+        self.storedir = storedir or HRRR_STORE_DIR
+        os.makedirs(self.storedir, exist_ok=True)
+
+    def path(self, cycle, fhr):
+        return os.path.join(self.storedir, 'cycle='+str(cycle), 'fhr='+str(int(fhr)).zfill(2)+'.parquet')
+
+    @staticmethod
+    def site_frame(sites):
+        return pd.DataFrame([(str(site.stid), float(site.lat), float(site.lon), float(site.elev), float(site.mlthick))
+                             for site in sites], columns=SITE_COLUMNS)
+
+    def write(self, cycle, fhr, sites, rows, columns):
+        """Store the rows (one tuple of columns per site) of a forecast hour.
+
+        Sites already stored for this hour that are not in sites are kept.
+        """
+        df = pd.concat([self.site_frame(sites), pd.DataFrame(rows, columns=columns)], axis=1)
+        path = self.path(cycle, fhr)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            df = pd.concat([pd.read_parquet(path), df], ignore_index=True)
+            df = df.drop_duplicates(subset=SITE_COLUMNS, keep='last').reset_index(drop=True)
+        tmpfile = path+'.'+str(os.getpid())+'.part'
+        df.to_parquet(tmpfile, index=False)
+        os.replace(tmpfile, path)
+
+    def read_hour(self, cycle, fhr, sites=None):
+        """Rows of one forecast hour in the order of sites, None unless every site is stored."""
+        path = self.path(cycle, fhr)
+        if not os.path.exists(path):
+            return None
+        df = pd.read_parquet(path)
+        if sites is None:
+            return df
+        df = self.site_frame(sites).merge(df, on=SITE_COLUMNS, how='left', validate='one_to_one')
+        if df['FHR'].isna().any():
+            return None
+        return df
+
+    def has(self, cycle, fhr, sites):
+        return self.read_hour(cycle, fhr, sites) is not None
+
+    def fhrs(self, cycle):
+        """Forecast hours stored for a cycle."""
+        paths = glob.glob(os.path.join(self.storedir, 'cycle='+str(cycle), 'fhr=*.parquet'))
+        return sorted(int(os.path.basename(path)[4:-8]) for path in paths)
+
+    def read(self, cycle, stid=None):
+        """All stored rows of a cycle (optionally one station) as a long table sorted by station and FHR."""
+        paths = [self.path(cycle, fhr) for fhr in self.fhrs(cycle)]
+        if len(paths) == 0:
+            return None
+        df = pd.concat([pd.read_parquet(path) for path in paths], ignore_index=True)
+        if stid is not None:
+            df = df[df['Station ID'] == str(stid)]
+        return df.sort_values(['Station ID', 'FHR'], kind='stable').reset_index(drop=True)
+
+
+def load_point_forecast(cycle, stid, storedir=None):
+    """Stored forecast of one station for cycle YYYYMMDDHH, without the site columns, or None."""
+    df = PointStore(storedir).read(cycle, stid)
+    if df is None or len(df) == 0:
+        return None
+    return df.drop(columns=SITE_COLUMNS)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of raw Mesowest API responses
+
+Responses are stored gzipped under a key derived from (stations, window).
+A window that ended well before it was fetched will not change any more and
+never expires; a window reaching up to the time of the request (the usual
+"until now" run) can still gain observations and is only reused for
+MESOWEST_CACHE_TTL seconds.  In offline mode every cached response is served
+whatever its age, so a SMET build can be replayed without network access.
+"""
+import os
+import json
+import gzip
+import time
+import hashlib
+import threading
+from datetime import datetime, timezone
+
+# Cache location, overridable from the environment
+MESOWEST_CACHE_DIR = os.environ.get('MESOWEST_CACHE_DIR', './mesowest_cache/')
+
+# Seconds a response to a window reaching up to the time of the request is reused
+MESOWEST_CACHE_TTL = float(os.environ.get('MESOWEST_CACHE_TTL', 600.))
+
+# Windows that ended this many seconds before they were fetched are final, late reports have arrived by then
+MESOWEST_CACHE_FINAL_AFTER = 86400.
+
+# Serve everything from the cache and never request the API
+MESOWEST_OFFLINE = os.environ.get('MESOWEST_OFFLINE', '').lower() in ('1', 'true', 'yes')
+
+
+class MesowestNotCached(Exception):
+    """Raised in offline mode for a response that is not in the cache."""
+
+
+class MesowestCache:
+    """
+    Gzipped JSON responses keyed by stations and window
+
+    Parameters
+    ----------
+    cachedir : string, optional
+        cache directory, created if needed. Default is MESOWEST_CACHE_DIR.
+    ttl : float, optional
+        seconds a response to an open window is reused. Default is MESOWEST_CACHE_TTL.
+
+    """
+
+    def __init__(self, cachedir=None, ttl=None):
+        self.cachedir = cachedir or MESOWEST_CACHE_DIR
+        self.ttl = MESOWEST_CACHE_TTL if ttl is None else ttl
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.cachedir, exist_ok=True)
+
+    @staticmethod
+    def key(stids, start_time, end_time):
+        """
+        Key of a request, the order of the stations does not matter
+        """
+        if isinstance(stids, str):
+            stids = stids.split(',')
+        description = json.dumps([sorted(stids), str(start_time)[0:12], str(end_time)[0:12]])
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cachedir, key+'.json.gz')
+
+    @staticmethod
+    def is_final(end_time, fetched):
+        """
+        Whether a window ending at end_time (YYYYMMDDHHmm, UTC) was complete when fetched (epoch seconds)
+        """
+        end = datetime.strptime(str(end_time)[0:12], '%Y%m%d%H%M').replace(tzinfo=timezone.utc).timestamp()
+        return end < fetched - MESOWEST_CACHE_FINAL_AFTER
+
+    def get(self, stids, start_time, end_time, offline=False):
+        """
+        Cached response, None if missing or expired (never expired when offline)
+        """
+        path = self.path(self.key(stids, start_time, end_time))
+        try:
+            fetched = os.path.getmtime(path)
+            if offline or self.is_final(end_time, fetched) or time.time() - fetched < self.ttl:
+                with gzip.open(path, 'rt') as f:
+                    data = json.load(f)
+                self.hits += 1
+                return data
+        except (FileNotFoundError, EOFError, OSError, ValueError):
+            pass
+        self.misses += 1
+        return None
+
+    def put(self, stids, start_time, end_time, data):
+        """
+        Store a response atomically, its mtime is the time it was fetched
+        """
+        path = self.path(self.key(stids, start_time, end_time))
+        tmpfile = path+'.'+str(os.getpid())+'.'+str(threading.get_ident())+'.part'
+        with gzip.open(tmpfile, 'wt') as f:
+            json.dump(data, f)
+        os.replace(tmpfile, path)
+        return path
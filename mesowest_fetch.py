@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Mesowest timeseries requests
+
+All requests go through one pooled requests.Session per process, with a
+timeout and retries (with backoff) on connection errors and 429/5xx answers.
+Several stations are fetched per request with the API's comma separated stid
+list, and the requests for a list of stations run concurrently, so a regional
+run takes about as long as its slowest request instead of the sum of all of
+them.  Long windows of one station (backfills over several seasons) are split
+in time chunks fetched concurrently and handed over in time order, a few at a
+time, so the memory used does not grow with the window.  MESOWEST_API_URL can
+point to a local stand-in (offline_fixtures.LocalMesowestServer) for testing.
+Responses are kept in an on-disk cache (mesowest_cache), so reruns over past
+windows do not request the API again and a run can be replayed offline.
+"""
+import os
+import time
+import requests
+from collections import deque
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from mesowest_cache import MESOWEST_CACHE_DIR, MESOWEST_OFFLINE, MesowestCache, MesowestNotCached
+from pipeline_timing import stage, add_bytes
+
+# Timeseries endpoint and token, overridable from the environment
+MESOWEST_API_URL = os.environ.get('MESOWEST_API_URL', 'http://api.mesowest.net/v2/stations/timeseries')
+MESOWEST_TOKEN = os.environ.get('MESOWEST_TOKEN', '3d5845d69f0e47aca3f810de0bb6fd3f')
+
+# Connect and read timeouts (s); a season of a station can take a while to assemble on the server
+MESOWEST_CONNECT_TIMEOUT = 10.
+MESOWEST_TIMEOUT = float(os.environ.get('MESOWEST_TIMEOUT', 120.))
+
+# Retries per request and the backoff factor (s) of urllib3, delays of 0, 2, 4 ... times the factor
+MESOWEST_RETRIES = int(os.environ.get('MESOWEST_RETRIES', 3))
+MESOWEST_BACKOFF = float(os.environ.get('MESOWEST_BACKOFF', 1.))
+MESOWEST_RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# Concurrent requests, and stations asked for in one request
+MESOWEST_MAX_WORKERS = int(os.environ.get('MESOWEST_MAX_WORKERS', 8))
+MESOWEST_STATIONS_PER_REQUEST = 10
+
+# Windows longer than this (days) are fetched in chunks of this length, see iter_timeseries_chunks
+MESOWEST_CHUNK_DAYS = float(os.environ.get('MESOWEST_CHUNK_DAYS', 31))
+
+# SUMMARY RESPONSE_CODE of a request for stations without data in the window
+MESOWEST_NO_DATA = 2
+
+# Session of this process, (pid, session), see get_session
+_session = None
+
+
+class MesowestError(Exception):
+    """
+    Raised for an answer of the API that is not a timeseries, e.g. no stations
+    found or an invalid token. response_code is the SUMMARY RESPONSE_CODE
+    (MESOWEST_NO_DATA when none of the stations have data in the window).
+    """
+
+    def __init__(self, message, response_code=None):
+        super().__init__(message)
+        self.response_code = response_code
+
+
+def check_response(data, url):
+    """
+    Raise MesowestError unless data is a successful response with a STATION list
+    """
+    summary = data.get('SUMMARY', {})
+    code = summary.get('RESPONSE_CODE', 1 if 'STATION' in data else None)
+    if code != 1 or 'STATION' not in data:
+        raise MesowestError(str(summary.get('RESPONSE_MESSAGE', 'No STATION in the response'))+': '+url, code)
+
+
+def make_session(retries=MESOWEST_RETRIES, backoff=MESOWEST_BACKOFF, pool_maxsize=MESOWEST_MAX_WORKERS):
+    """
+    requests.Session with a connection pool and retries
+
+    Parameters
+    ----------
+    retries : int, optional
+        retries of a failed request
+    backoff : float, optional
+        urllib3 backoff factor (s)
+    pool_maxsize : int, optional
+        connections kept open per host, at least the number of concurrent requests
+
+    Returns
+    -------
+    session : requests.Session
+
+    """
+    retry = Retry(total=retries, connect=retries, read=retries, status=retries, backoff_factor=backoff,
+                  status_forcelist=MESOWEST_RETRY_STATUS, allowed_methods=frozenset(['GET']),
+                  raise_on_status=False)
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=pool_maxsize)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """
+    The pooled session of this process, created on first use (and again after a fork)
+    """
+    global _session
+    if _session is None or _session[0] != os.getpid():
+        _session = (os.getpid(), make_session())
+    return _session[1]
+
+
+def mesowest_url(stids, start_time, end_time, api_url=None):
+    """
+    Timeseries url for one station or a list of stations
+
+    Parameters
+    ----------
+    stids : string or list of string
+        station ID(s)
+    start_time, end_time : string
+        window in YYYYMMDDHHmm, UTC
+
+    Returns
+    -------
+    url : string
+
+    """
+    if not isinstance(stids, str):
+        stids = ','.join(stids)
+    return f'{api_url or MESOWEST_API_URL}?stid={stids}&token={MESOWEST_TOKEN}&start={start_time}&end={end_time}'
+
+
+def fetch_timeseries(stids, start_time, end_time, session=None, cachedir=MESOWEST_CACHE_DIR, offline=MESOWEST_OFFLINE):
+    """
+    Request the timeseries of one or more stations
+
+    Parameters
+    ----------
+    stids : string or list of string
+        station ID(s)
+    start_time, end_time : string
+        window in YYYYMMDDHHmm, UTC
+    session : requests.Session, optional
+        session to use. Default is the session of this process.
+    cachedir : string, optional
+        response cache, see mesowest_cache. None to always request the API.
+    offline : boolean, optional
+        only serve responses from the cache, whatever their age
+
+    Returns
+    -------
+    data : dict
+        decoded JSON response, with a STATION entry per station found
+
+    Raises
+    ------
+    requests.RequestException
+        if the request still fails after the retries
+    MesowestNotCached
+        if offline and the response is not in the cache
+    MesowestError
+        if the API answered with an error or no data, such answers are not cached
+
+    """
+    cache = MesowestCache(cachedir) if cachedir else None
+    if cache is not None:
+        with stage('mesowest_cache'):
+            data = cache.get(stids, start_time, end_time, offline)
+        # Only timeseries are cached, an entry without STATION is from an older version and is not served
+        if data is not None and 'STATION' in data:
+            return data
+    url = mesowest_url(stids, start_time, end_time)
+    if offline:
+        raise MesowestNotCached(url)
+    session = session or get_session()
+    with stage('mesowest_fetch'):
+        response = session.get(url, timeout=(MESOWEST_CONNECT_TIMEOUT, MESOWEST_TIMEOUT))
+        response.raise_for_status()
+        data = response.json()
+    add_bytes('mesowest_fetch', len(response.content))
+    check_response(data, url)
+    if cache is not None:
+        with stage('mesowest_cache'):
+            cache.put(stids, start_time, end_time, data)
+    return data
+
+
+def split_stations(data):
+    """
+    One response per station (STID -> data with a single STATION entry) from a multi-station response
+    """
+    other = {key: value for key, value in data.items() if key != 'STATION'}
+    return {station['STID']: dict(other, STATION=[station]) for station in data.get('STATION', [])}
+
+
+def fetch_stations(stids, start_time, end_time, stations_per_request=MESOWEST_STATIONS_PER_REQUEST,
+                   max_workers=MESOWEST_MAX_WORKERS, session=None, cachedir=MESOWEST_CACHE_DIR,
+                   offline=MESOWEST_OFFLINE):
+    """
+    Timeseries of a list of stations, several stations per request and the requests in parallel
+
+    Parameters
+    ----------
+    stids : list of string
+        station IDs
+    start_time : string or dict
+        window start in YYYYMMDDHHmm, UTC, or a start per station. Stations are
+        only grouped in a request with stations of the same start.
+    end_time : string
+        window end in YYYYMMDDHHmm, UTC
+    stations_per_request : int, optional
+        stations asked for in one request
+    max_workers : int, optional
+        concurrent requests
+    session : requests.Session, optional
+        session to use. Default is the session of this process.
+    cachedir, offline : optional
+        see fetch_timeseries
+
+    Returns
+    -------
+    results : dict
+        STID -> single station response, see split_stations
+    failures : dict
+        STID -> error message for the stations that failed or were not in the response
+
+    """
+    starts = start_time if isinstance(start_time, dict) else {stid: start_time for stid in stids}
+    bystart = {}
+    for stid in stids:
+        bystart.setdefault(starts[stid], []).append(stid)
+    groups = [(start, group[i:i+stations_per_request]) for start, group in bystart.items()
+              for i in range(0, len(group), stations_per_request)]
+
+    results = {}
+    failures = {}
+    if len(groups) == 0:
+        return results, failures
+    if not offline:
+        session = session or get_session()
+    fetchstart = time.time()
+    with ThreadPoolExecutor(max_workers=min(len(groups), max_workers)) as threads:
+        tasks = {threads.submit(fetch_timeseries, group, start, end_time, session, cachedir, offline): group for start, group in groups}
+        for task in as_completed(tasks):
+            group = tasks[task]
+            try:
+                stations = split_stations(task.result())
+            except Exception as e:
+                for stid in group:
+                    failures[stid] = type(e).__name__+': '+str(e)
+                continue
+            for stid in group:
+                if stid in stations:
+                    results[stid] = stations[stid]
+                else:
+                    failures[stid] = 'Station not in the Mesowest response'
+    print('Fetched '+str(len(results))+' of '+str(len(stids))+' stations in '+str(len(groups))+' requests, '
+          + str(round(time.time() - fetchstart, 1))+' s')
+    return results, failures
+
+
+def parse_api_time(api_time):
+    """
+    datetime of an API time string, YYYYMMDDHHmm (seconds, if given, are ignored)
+    """
+    return datetime.strptime(str(api_time)[0:12], '%Y%m%d%H%M')
+
+
+def split_window(start_time, end_time, chunk_days=MESOWEST_CHUNK_DAYS):
+    """
+    Consecutive windows of at most chunk_days covering [start_time, end_time]
+
+    Parameters
+    ----------
+    start_time, end_time : string
+        window in YYYYMMDDHHmm, UTC, both ends included as by the API
+    chunk_days : float, optional
+        length of the windows
+
+    Returns
+    -------
+    windows : list of tuple
+        (start, end) in YYYYMMDDHHmm, not overlapping (each starts a minute after
+        the previous one ends)
+
+    """
+    start = parse_api_time(start_time)
+    end = parse_api_time(end_time)
+    step = timedelta(days=chunk_days)
+    windows = []
+    while start <= end:
+        stop = min(start + step - timedelta(minutes=1), end)
+        windows.append((start.strftime('%Y%m%d%H%M'), stop.strftime('%Y%m%d%H%M')))
+        start = stop + timedelta(minutes=1)
+    return windows
+
+
+def _fetch_chunk(stid, start_time, end_time, session, cachedir, offline):
+    try:
+        return fetch_timeseries(stid, start_time, end_time, session, cachedir, offline)
+    except MesowestError as e:
+        if e.response_code != MESOWEST_NO_DATA:
+            raise
+        print('No Mesowest data for '+stid+' from '+start_time+' to '+end_time+', chunk skipped ('+str(e)+')')
+        return None
+
+
+def iter_timeseries_chunks(stid, start_time, end_time, chunk_days=MESOWEST_CHUNK_DAYS, max_workers=MESOWEST_MAX_WORKERS,
+                           session=None, cachedir=MESOWEST_CACHE_DIR, offline=MESOWEST_OFFLINE):
+    """
+    Responses for a long window of one station, fetched in chunks
+
+    The chunks are requested concurrently but at most max_workers are in flight
+    or waiting to be consumed at any time, and they are yielded in time order.
+
+    Parameters
+    ----------
+    stid : string
+        station ID
+    start_time, end_time : string
+        window in YYYYMMDDHHmm, UTC
+    chunk_days : float, optional
+        length of the chunks
+    max_workers : int, optional
+        concurrent requests
+    session : requests.Session, optional
+        session to use. Default is the session of this process.
+    cachedir, offline : optional
+        see fetch_timeseries
+
+    Yields
+    ------
+    data : dict or None
+        decoded JSON response of the next chunk, None (and the window is printed)
+        if the station has no data in it, e.g. a season it was not reporting
+
+    Raises
+    ------
+    MesowestError
+        for any other error answer of the API
+
+    """
+    if not offline:
+        session = session or get_session()
+    windows = split_window(start_time, end_time, chunk_days)
+    with ThreadPoolExecutor(max_workers=max(1, min(len(windows), max_workers))) as threads:
+        pending = deque()
+        for window in windows:
+            if len(pending) >= max_workers:
+                yield pending.popleft().result()
+            pending.append(threads.submit(_fetch_chunk, stid, window[0], window[1], session, cachedir, offline))
+        while len(pending) > 0:
+            yield pending.popleft().result()
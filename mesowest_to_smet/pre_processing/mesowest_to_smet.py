@@ -8,11 +8,16 @@ Created on Sat Jul 20 09:39:04 2024
 
 @author: Travis Morrison
 """
+import os
 import sys
 import requests
 import json
 import numpy as np
 from datetime import datetime, timedelta, timezone
+# smet_io lives at the top of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from smet_io import format_smet_header, write_smet_rows
+from station_corrections import station_corrections, apply_corrections
 
 
 
@@ -95,23 +100,12 @@ def mesowest_to_smet(start_time, current_time,stid,make_input_plot,forecast_bool
     TSS = [temp + 273.15 for temp in observations['surface_temp_set_1']]
     RH = [rh / 100.0 for rh in observations['relative_humidity_set_1']]
     ISWR = observations['solar_radiation_set_1']
-    #Removing negative solar radation values
-    for i in range(len(ISWR)):
-        if ISWR[i]<0:
-            ISWR[i] = 0
     VW = observations['wind_speed_set_1']
     DW = observations['wind_direction_set_1']
     HS = [depth / 1000.0 for depth in observations['snow_depth_set_1']]
     TSG = [273.15] * len(HS)  # Ground surface temperature assumed to be 0°C
     #PSUM = 
 
-    # Apply specific station adjustments
-    # HS 
-    HS[:450] = np.zeros(450)
-    HS[4196] = HS[4195]
-    HS[4323] = HS[4322]
-    HS[4197:4262] = [depth - 2 for depth in HS[4197:4262]]
- 
     # Replace NaNs with -999
     TA = [-999 if val is None else val for val in TA]
     TSS = [-999 if val is None else val for val in TSS]
@@ -122,6 +116,12 @@ def mesowest_to_smet(start_time, current_time,stid,make_input_plot,forecast_bool
     HS = [-999 if val is None else val for val in HS]
     TSG = [-999 if val is None else val for val in TSG]
 
+    # Apply specific station adjustments (negative ISWR, HS sensor problems), see station_corrections.py
+    date = [datetime(years[i], months[i], days[i], hours[i], minutes[i], seconds[i]) for i in range(len(HS))]
+    corrected = apply_corrections(np.array(date, dtype='datetime64[s]'), {'HS': HS, 'ISWR': ISWR},
+                                  station_corrections(stid))
+    HS, ISWR = corrected['HS'], corrected['ISWR']
+
     # Print data out to SMET file
     StationID = data['STATION'][0]['STID']
     StationName = data['STATION'][0]['NAME']
@@ -133,27 +133,12 @@ def mesowest_to_smet(start_time, current_time,stid,make_input_plot,forecast_bool
     
     fileID = open(f'{StationID}.smet', 'w')
     
-    fileID.write('SMET 1.1 ASCII\n')
-    fileID.write('[HEADER]\n')
-    fileID.write(f'station_id       = {StationID}\n')
-    fileID.write(f'station_name     = {StationName}\n')
-    fileID.write(f'latitude         = {latitude}\n')
-    fileID.write(f'longitude        = {longitude}\n')
-    fileID.write(f'altitude         = {altitude}\n')
-    #fileID.write(f'easting          = {easting}\n')
-    #fileID.write(f'northing         = {northing}\n')
-    fileID.write('nodata           = -999\n')
-    fileID.write('tz               = 1\n')
-    fileID.write(f'source           = {source}\n')
-    fileID.write(f'fields           = timestamp TA RH TSG TSS HS VW DW ISWR\n')
-    fileID.write('[DATA]\n')
-
+    #easting, northing could be added to the header
+    fileID.write(format_smet_header({'station_id': StationID, 'station_name': StationName, 'latitude': latitude,
+                                     'longitude': longitude, 'altitude': altitude, 'nodata': -999, 'tz': 1,
+                                     'source': source, 'fields': 'timestamp TA RH TSG TSS HS VW DW ISWR'}))
 
-    date = []
-    for i in range(len(HS)):
-        date.append(datetime(years[i], months[i], days[i], hours[i], minutes[i], seconds[i]))
-        iso_date = date[i].isoformat()
-        fileID.write(f'{iso_date} {TA[i]:.2f} {RH[i]:.2f} {TSG[i]:.2f} {TSS[i]:.2f} {HS[i]:.2f} {VW[i]:.2f} {DW[i]:.2f} {ISWR[i]:.2f}\n')
+    write_smet_rows(fileID, np.array([d.isoformat() for d in date]), [TA, RH, TSG, TSS, HS, VW, DW, ISWR])
     
     fileID.close()
 
@@ -7,20 +7,170 @@ Created on Sat Jul 20 09:39:04 2024
 @author: Travis Morrison
 Add email with log 
 """
+import os
 import sys
-import requests
 import json
+import shutil
+import tempfile
 import numpy as np
 from datetime import datetime, timedelta, timezone
 import pandas as pd
 import logging
+from mesowest_fetch import (MESOWEST_MAX_WORKERS, MESOWEST_STATIONS_PER_REQUEST, MESOWEST_CHUNK_DAYS, mesowest_url,
+                            fetch_timeseries, fetch_stations, parse_api_time, iter_timeseries_chunks)
+from mesowest_cache import MESOWEST_CACHE_DIR, MESOWEST_OFFLINE
+from mesowest_transform import NODATA, OBSERVATION_TRANSFORMS, transform_observations, transform_forecast
+from observation_qc import qc_context, qc_blocks, format_qc_report
+from pipeline_timing import stage, timed_unit
+from smet_io import (format_smet_header, write_smet_rows, read_smet, read_smet_header, read_last_line,
+                     read_smet_obs_end, write_smet_obs_end, find_row_offset)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-#import hrrr_snowpack_1_4 as hrrr
+# Parallel HRRR processes and depth of melting layer below wet-bulb zero (m) of the appended forecast
+FORECAST_MAXPROCESSES = 20
+FORECAST_MLTHICK = 300
 
+# Hours before the last observation an incremental run writes again, and hours before those it fetches as
+# read-only context, so QC sees the same neighbours as in a full build (see observation_qc.qc_context)
+QC_CONTEXT_HOURS = qc_context()
 
 
-def mesowest_to_smet(start_time, current_time,stid,make_input_plot,forecast_bool):
+def observation_blocks(stid, start_time, current_time, data=None, workdir=None, chunk_days=MESOWEST_CHUNK_DAYS,
+                       cachedir=MESOWEST_CACHE_DIR, offline=MESOWEST_OFFLINE):
+    """
+    Function to get the station metadata and the transformed observations of a window, in time ordered blocks
+
+    A window longer than chunk_days that was not already fetched is requested in
+    chunks (iter_timeseries_chunks). Each chunk is transformed as soon as it
+    arrives and its columns saved to workdir, so only a few raw responses are
+    in memory at a time however long the window is.
+
+    Parameters
+    ----------
+    stid : string
+        station ID from Mesowest
+    start_time, current_time : string
+        window in YYYYMMDDHHmm. Time in UTC
+    data : dict, optional
+        Mesowest response for the window, already fetched
+    workdir : string, optional
+        directory for the blocks of a chunked window
+    chunk_days : float, optional
+        windows longer than this are fetched in chunks of this length
+    cachedir, offline : optional
+        response cache and offline replay, see mesowest_fetch.fetch_timeseries
+
+    Returns
+    -------
+    station : dict
+        STATION entry of the response without the OBSERVATIONS
+    blocks : list
+        (timestamps, columns) of transform_observations, or .npz files of them in
+        workdir, see load_observation_block
+    fields : list
+        SMET fields (without timestamp) found in any block, in table order
+    last_timestamp : datetime64 or None
+        latest observation, None if there are none
+
+    """
+    chunked = data is None and parse_api_time(current_time) - parse_api_time(start_time) > timedelta(days=chunk_days)
+    if chunked:
+        print("Fetching " + stid + " in chunks of " + str(chunk_days) + " days")
+        responses = iter_timeseries_chunks(stid, start_time, current_time, chunk_days, cachedir=cachedir,
+                                           offline=offline)
+    else:
+        if data is None:
+            print("mesowest_url: " + mesowest_url(stid, start_time, current_time))
+            data = fetch_timeseries(stid, start_time, current_time, cachedir=cachedir, offline=offline)
+        responses = [data]
+
+    station = None
+    blocks = []
+    found = set()
+    last_timestamp = None
+    for i, response in enumerate(responses):
+        if response is None or len(response['STATION']) == 0:
+            continue  # No data in this chunk
+        if station is None:
+            station = {key: value for key, value in response['STATION'][0].items() if key != 'OBSERVATIONS'}
+        # A variable missing from a chunk (e.g. a month long outage) is nodata there, see below
+        with stage('mesowest_transform'):
+            timestamps, columns = transform_observations(response['STATION'][0]['OBSERVATIONS'], all_optional=chunked)
+        del response
+        found.update(columns)
+        if len(timestamps) > 0:
+            last_timestamp = timestamps.max() if last_timestamp is None else max(last_timestamp, timestamps.max())
+        if chunked:
+            blocks.append(os.path.join(workdir, 'block'+str(i).zfill(5)+'.npz'))
+            np.savez(blocks[-1], timestamp=timestamps, **columns)
+        else:
+            blocks.append((timestamps, columns))
+
+    if station is None:
+        raise ValueError("No Mesowest data for " + stid + " from " + start_time + " to " + current_time)
+    for field, transform in OBSERVATION_TRANSFORMS.items():
+        if chunked and field not in found:
+            if not transform.get('optional', False):
+                raise KeyError(transform['source'])
+            print(field + " not found")
+    return station, blocks, [field for field in OBSERVATION_TRANSFORMS if field in found], last_timestamp
+
+
+def incremental_start(obs_end, start_time, hours=2*QC_CONTEXT_HOURS):
+    """
+    Where an incremental run starts, some hours before the last observation, not before start_time
+
+    The rows of the last QC_CONTEXT_HOURS can change with the new observations
+    and are written again. QC of the first of them looks at the QC_CONTEXT_HOURS
+    before, so the run fetches from 2*QC_CONTEXT_HOURS before the last
+    observation (the default) and writes from QC_CONTEXT_HOURS before it.
+
+    Returns
+    -------
+    start : datetime
+        first observation fetched (or written again, with hours=QC_CONTEXT_HOURS)
+
+    """
+    start = datetime.strptime(obs_end[1], '%Y-%m-%dT%H:%M:%S') - timedelta(hours=hours)
+    return max(start, parse_api_time(start_time))
+
+
+def unwritten_rows(blocks, fields, last=None):
+    """
+    Rows of observation_blocks after last, without repeated timestamps (chunk borders) and with every field
+
+    Yields
+    ------
+    timestamps, columns : array, dict
+        columns has fields, nodata where a block does not have the field
+
+    """
+    for block in blocks:
+        timestamps, columns = load_observation_block(block)
+        keep = np.ones(len(timestamps), dtype=bool)
+        keep[1:] = timestamps[1:] > timestamps[:-1]
+        if last is not None:
+            keep &= timestamps > last
+        if not keep.any():
+            continue
+        yield timestamps[keep], {field: columns[field][keep] if field in columns else np.full(keep.sum(), float(NODATA))
+                                 for field in fields}
+        last = timestamps[keep][-1]
+
+
+def load_observation_block(block):
+    """
+    (timestamps, columns) of a block of observation_blocks
+    """
+    if isinstance(block, tuple):
+        return block
+    with np.load(block) as arrays:
+        return arrays['timestamp'], {field: arrays[field] for field in arrays.files if field != 'timestamp'}
+
+
+@timed_unit('mesowest_to_smet', lambda start_time, current_time, stid, *args, **kwargs: {'stid': stid})
+def mesowest_to_smet(start_time, current_time,stid,make_input_plot,forecast_bool,incremental=False,data=None,
+                     cachedir=MESOWEST_CACHE_DIR,offline=MESOWEST_OFFLINE,forecast=None,qc=True):
     """
     Function to collect data from the mesowest api and create a snowpack input file
     
@@ -40,311 +190,314 @@ def mesowest_to_smet(start_time, current_time,stid,make_input_plot,forecast_bool
         DESCRIPTION.
     forecast bool : boolean
         DESCRIPTION.
+    incremental : boolean, optional
+        if {stid}.smet was built by an earlier run, request only the observations
+        after its last one and append them (dropping the forecast rows of the
+        earlier run) instead of rebuilding the whole season. The last
+        QC_CONTEXT_HOURS are written again, checked with the QC_CONTEXT_HOURS
+        before them, so the file is the same as a full build. Falls back to a full build if there is no such file or
+        the fields changed. Default is False.
+    data : dict, optional
+        Mesowest response for this station and window, already fetched (e.g. by
+        mesowest_to_smet_stations). Default is to request it.
+    cachedir : string, optional
+        cache of the Mesowest responses, see mesowest_cache. None to always
+        request the API. Default is MESOWEST_CACHE_DIR.
+    offline : boolean, optional
+        replay the build from the cached responses only, without requesting the
+        API. Default is MESOWEST_OFFLINE.
+    forecast : DataFrame, optional
+        HRRR forecast of the station already fetched, see finish_smet. Default
+        is to fetch it if forecast_bool.
+    qc : boolean, optional
+        check the observations (observation_qc) before writing them, False
+        writes them as received from Mesowest. An incremental run should use
+        the same setting as the run that built the file. Default is True.
 
     Returns
     -------
     None.
 
+    Every call is a timed 'mesowest_to_smet' unit written to TIMING_LOG, see
+    pipeline_timing.
+
     """
+    smetfile = f'{stid}.smet'
+    obs_end = read_smet_obs_end(smetfile) if incremental else None
+    if obs_end is not None:
+        season_start_time = start_time
+        # Start before the last observation in the file so the response always has the station metadata, the
+        # rows that can change are written again and their QC sees the rows before them (only read)
+        rewrite_start = incremental_start(obs_end, start_time, QC_CONTEXT_HOURS)
+        start_time = incremental_start(obs_end, start_time).strftime('%Y%m%d%H%M')
+        print("Appending observations after " + obs_end[1] + " to " + smetfile)
     print("Building *.smet file for " + stid + " from " + start_time + " to " + current_time)
     
-    # build API url
-    mesowest_url = f'http://api.mesowest.net/v2/stations/timeseries?stid={stid}&token=3d5845d69f0e47aca3f810de0bb6fd3f&start={start_time}&end={current_time}'
-    print("mesowest_url: " + mesowest_url)
-
-    # Call mesowest API
-    response = requests.get(mesowest_url)
-    data = response.json()
-    observations = data['STATION'][0]['OBSERVATIONS']
-    data_length = len(observations['date_time'])
-    
-    #allocate the date time arrays
-    years = []
-    months = []
-    days = []
-    hours = []
-    minutes = []
-    seconds = []
-    
-    # Collect the datetime vars from the mesowest station
-    years = [int(dt[0:4]) for dt in observations['date_time']]
-    months = [int(dt[5:7]) for dt in observations['date_time']]
-    days = [int(dt[8:10]) for dt in observations['date_time']]
-    hours = [int(dt[11:13]) for dt in observations['date_time']]
-    minutes = [int(dt[14:16]) for dt in observations['date_time']]
-    seconds = [int(dt[17:19]) for dt in observations['date_time']]
-
-    # Print out current time and station last obs time to user
-    station_last_obs_time = str(years[-1])+'-'+str(months[-1]).zfill(2)+'-'+str(days[-1]).zfill(2)+'T'+str(hours[-1]).zfill(2)+':'+str(minutes[-1]).zfill(2)+':00'
-   
-    
-    #end_date = datetime.strptime(station_last_obs_time, '%y%m%d%H%M%S')
-    #print(datetime.strptime(station_last_obs_time, '%Y-%m-%dT%H:%M:%S'))
-
-    print("Station last obs time is: " + station_last_obs_time)
-    print("Current time is: " + current_time)
-    print("SMET Obs will be output to: " + station_last_obs_time)
-
-    # Add specific vars adjustment - all stations
-    TA = [temp + 273.15 for temp in observations['air_temp_set_1']]
-   
-    RH = [rh / 100.0 for rh in observations['relative_humidity_set_1']]
-    VW = observations['wind_speed_set_1']
-    DW = observations['wind_direction_set_1']
-    HS = [depth / 1000.0 for depth in observations['snow_depth_set_1']]
-    TSG = [273.15] * len(HS)  # Ground surface temperature assumed to be 0°C
-    #PSUM = 
-
-    ISWR_flag = False
-    RSWR_flag = False
-    ILWR_flag = False
-    RLWR_flag = False
-    try:
-        ISWR = observations['solar_radiation_set_1']
-        # Handle None values
-        ISWR = [-999 if val is None else val for val in ISWR]
-        #Removing negative solar radation values
-        ISWR = [0 if 0 > val > -100 else val for val in ISWR]
-        #If values are less than -100, set to -999
-        ISWR = [val if val > -100 else -999 for val in ISWR]
-        ISWR_flag = True
-        # Check for consecutive -999 values in ISWR and interpolate if 6 or fewer consecutive hours
-        '''for i in range(len(ISWR)):
-            if ISWR[i] == -999:
-                start = i
-                while i < len(ISWR) and ISWR[i] == -999:
-                    i += 1
-                end = i
-                if end - start <= 6:  # If 6 or fewer consecutive hours
-                    if start > 0 and end < len(ISWR):  # Ensure bounds for interpolation
-                        step = (ISWR[end] - ISWR[start - 1]) / (end - start + 1)
-                        for j in range(start, end):
-                            ISWR[j] = ISWR[start - 1] + step * (j - start + 1)'''
-    except:
-        ISWR_flag = False
-        print("ISWR not found")
-    try:
-        RSWR = observations['outgoing_radiation_sw_set_1']
-        # Handle None values
-        RSWR = [-999 if val is None else val for val in RSWR]         
-        #Removing negative solar radation values
-        RSWR = [0 if 0 > val > -100 else val for val in RSWR]
-        #If values are less than -100, set to -999
-        RSWR = [val if val > -100 else -999 for val in RSWR]
-        RSWR_flag = True
-    except:
-        RSWR_flag = False
-        print("RSWR not found")
-    try:
-        ILWR = observations['incoming_radiation_lw_set_1']
-        # Handle None values
-        ILWR = [-999 if val is None else val for val in ILWR]
-        # Removing negative radiation values
-        ILWR = [0 if 0 > val > -100 else val for val in ILWR]
-        # If values are less than -100, set to -999
-        ILWR = [val if val > -100 else -999 for val in ILWR]
-        ILWR_flag = True
-    except:
-        print("ILWR not found")
-    try:
-        print("Checking for RLWR")
-        RLWR = observations['outgoing_radiation_lw_set_1']
-        # Handle None values
-        RLWR = [-999 if val is None else val for val in RLWR]
-        # Removing negative radiation values
-        RLWR = [0 if 0 > val > -100 else val for val in RLWR]
-        # If values are less than -100, set to -999
-        RLWR = [val if val > -100 else -999 for val in RLWR]
-        RLWR_flag = True
-    except:
-        print("RLWR not found")
-
-    TSS_flag = False
-    try:
-         TSS = [temp + 273.15 for temp in observations['surface_temp_set_1']]
-         TSS = [-999 if val is None else val for val in TSS]
-         TSS_flag = True
-    except:
-        print("TSS not found")
-
-    # Replace NaNs with -999
-    TA = [-999 if val is None else val for val in TA]
-    RH = [-999 if val is None else val for val in RH]
-    VW = [-999 if val is None else val for val in VW]
-    DW = [-999 if val is None else val for val in DW]
-    HS = [-999 if val is None else val for val in HS]
-    TSG = [-999 if val is None else val for val in TSG]
-
-    # Print data out to SMET file
-    StationID = data['STATION'][0]['STID']
-    StationName = data['STATION'][0]['NAME']
-    latitude = float(data['STATION'][0]['LATITUDE'])
-    longitude = float(data['STATION'][0]['LONGITUDE'])
+    # Call mesowest API (in chunks for long windows) and transform the observations, see observation_blocks
+    workdir = tempfile.mkdtemp(prefix='mesowest_')
     try:
-        altitude = float(data['STATION'][0]['ELEV_DEM']) * 0.3048
-    except:
-        altitude = 0
-    UTM_zone = None  # Calculate UTM zone if needed
-    source = 'Utah Avalanche Center - Synoptic Data'
-    
-    fileID = open(f'{StationID}.smet', 'w')
-    
-    fileID.write('SMET 1.1 ASCII\n')
-    fileID.write('[HEADER]\n')
-    fileID.write(f'station_id       = {StationID}\n')
-    fileID.write(f'station_name     = {StationName}\n')
-    fileID.write(f'latitude         = {latitude}\n')
-    fileID.write(f'longitude        = {longitude}\n')
-    fileID.write(f'altitude         = {altitude}\n')
-    fileID.write('nodata           = -999\n')
-    fileID.write('tz               = 1\n')
-    fileID.write(f'source           = {source}\n')
-    
-    # Fields to include based on flags
-    fields = ['timestamp', 'TA', 'RH', 'TSG', 'HS', 'VW', 'DW']
-    if TSS_flag:
-        fields.append('TSS')
-    if ISWR_flag:
-        fields.append('ISWR')
-    if RSWR_flag:
-        fields.append('RSWR')
-    if ILWR_flag:
-        fields.append('ILWR')
-    if RLWR_flag:
-        fields.append('RLWR')
-
-    fileID.write(f'fields           = {" ".join(fields)}\n')
-    fileID.write('[DATA]\n')
-
-    date = []
-    # Try to write ISWR, RSWR, ILWR, RLWR, TSS depending on flags
-    try: 
-        for i in range(len(HS)):
-            date.append(datetime(years[i], months[i], days[i], hours[i], minutes[i], seconds[i]))
-            iso_date = date[i].isoformat()
-            line = f'{iso_date} {TA[i]:.2f} {RH[i]:.2f} {TSG[i]:.2f} {HS[i]:.2f} {VW[i]:.2f} {DW[i]:.2f}'
-            
-            if TSS_flag:
-                line += f' {TSS[i]:.2f}'
-            if ISWR_flag:
-                line += f' {ISWR[i]:.2f}'
-            if RSWR_flag:
-                line += f' {RSWR[i]:.2f}'
-            if ILWR_flag:
-                line += f' {ILWR[i]:.2f}'
-            if RLWR_flag:
-                line += f' {RLWR[i]:.2f}'
-            
-            fileID.write(line + '\n')
+        station, blocks, obs_fields, last_timestamp = observation_blocks(stid, start_time, current_time, data, workdir,
+                                                                         cachedir=cachedir, offline=offline)
+        if obs_end is not None and (last_timestamp is None or last_timestamp <= np.datetime64(obs_end[1])):
+            last_timestamp = None
+        elif last_timestamp is None:
+            # Nothing to build a file from
+            raise ValueError("No Mesowest observations for " + stid + " from " + start_time + " to " + current_time)
+
+        # Print out current time and station last obs time to user
+        if last_timestamp is not None:
+            station_last_obs_time = str(last_timestamp)[0:16]+':00'
+        else:
+            station_last_obs_time = obs_end[1][0:16]+':00'
+       
         
-        fileID.close()
-    except:
-        logging.info("Error writing data to file.")
-        fileID.close()
-
-
-    if forecast_bool == True:
+        #end_date = datetime.strptime(station_last_obs_time, '%y%m%d%H%M%S')
+        #print(datetime.strptime(station_last_obs_time, '%Y-%m-%dT%H:%M:%S'))
+
+        print("Station last obs time is: " + station_last_obs_time)
+        print("Current time is: " + current_time)
+        print("SMET Obs will be output to: " + station_last_obs_time)
+
+        # Print data out to SMET file
+        StationID = station['STID']
+        StationName = station['NAME']
+        latitude = float(station['LATITUDE'])
+        longitude = float(station['LONGITUDE'])
+        try:
+            altitude = float(station['ELEV_DEM']) * 0.3048
+        except:
+            altitude = 0
+        UTM_zone = None  # Calculate UTM zone if needed
+        source = 'Utah Avalanche Center - Synoptic Data'
         
-        print("Running in forecasting mode, appending HRRR forecast data")
-        # Maximum number of parallel processes if being run parallel
-        maxprocesses = 20
+        # Fields to include, the optional ones only if the station has them
+        fields = ['timestamp'] + obs_fields
+
+        if obs_end is not None and read_smet_header(smetfile)[0].get('fields') != fields:
+            # The station gained or lost a variable, the file has to be rebuilt with the new columns (the rows
+            # fetched again for the QC are rewritten even without new observations)
+            print("Fields of " + smetfile + " changed, rebuilding it from " + season_start_time)
+            return mesowest_to_smet(season_start_time, current_time, stid, make_input_plot, forecast_bool,
+                                    cachedir=cachedir, offline=offline, forecast=forecast, qc=qc)
+
+        if obs_end is not None:
+            # Drop the forecast rows of the previous run and the observations fetched again
+            os.truncate(smetfile, find_row_offset(smetfile, np.datetime64(rewrite_start), obs_end[0]))
+            fileID = open(smetfile, 'a')
+        else:
+            fileID = open(f'{StationID}.smet', 'w')
+            fileID.write(format_smet_header({'station_id': StationID, 'station_name': StationName, 'latitude': latitude,
+                                             'longitude': longitude, 'altitude': altitude, 'nodata': -999, 'tz': 1,
+                                             'source': source, 'fields': fields}))
+
+        # Rows are checked (observation_qc, unless qc is False) and written block by block, skipping the context
+        # rows already written
+        last = np.datetime64(rewrite_start) - np.timedelta64(1, 's') if obs_end is not None else None
+        report = {}
+        try: 
+            rows = unwritten_rows(blocks, obs_fields)
+            if qc:
+                rows = qc_blocks(rows, report=report)
+            for timestamps, columns in unwritten_rows(rows, obs_fields, last):
+                write_smet_rows(fileID, timestamps, [columns[field] for field in obs_fields])
+            fileID.close()
+        except:
+            logging.info("Error writing data to file.")
+            fileID.close()
+        if len(format_qc_report(report)) > 0:
+            print(format_qc_report(report))
+        write_smet_obs_end(f'{StationID}.smet')
+    finally:
+        shutil.rmtree(workdir)
 
-        # Site coordinates (currently Atwater based on google maps)
-        #!!! Need to double check, ... but should use vars above
-        sitelat = latitude
-        sitelon = longitude  #actual Atwater, yields HRRR grid point to east (2928 m elevation)
-        #sitelon = -111.660  # slightly down canyon, yields HRRR grid point to west (2825 m elevation)
+    finish_smet(StationID, start_time, station_last_obs_time, make_input_plot, forecast_bool, forecast)
 
-        forecast_start_time = datetime.strptime(station_last_obs_time, '%Y-%m-%dT%H:%M:%S')- timedelta(hours=1) #datetime.now(timezone.utc) - timedelta(hours=1) 
-        
-        try:
-            forecast_df = hrrr.get_hrrr_forecast(forecast_start_time,sitelat,sitelon,siteelev = altitude,mlthick = 300,maxprocesses = maxprocesses)
-            
-            #load csv for debugging
-            #forecast_df =  pd.read_csv('/Users/travismorrison/Documents/GitHub/UAC-Snowpack/hrrr-snowpack/hrrr_to_snowpack_2024031818.csv',header=0)
-    
-                    
-            #Need to correct date and add TSG (= 273.15), doesn't matter what col its added since we cherry pick cols
-            forecast_df.insert(0, "TSG", np.ones(len(forecast_df['INIT (YYYYMMDDHH UTC)']))*273.15)
-            #Fix date time based on forecast
-            forecast_df['INIT (YYYYMMDDHH UTC)'] =  [datetime.isoformat(datetime.strptime(station_last_obs_time, '%Y-%m-%dT%H:%M:%S') + timedelta(hours=x)) for x in range(len(forecast_df['INIT (YYYYMMDDHH UTC)']))] 
-            
-            #forecast_df['INIT (YYYYMMDDHH UTC)'] =  forecast_df['INIT (YYYYMMDDHH UTC)']
-            forecast_df['RH2m (%)'] = forecast_df['RH2m (%)']/100
-
-            # Selecting the specific columns
-            # Columns to be selected
-            columns_to_write = ['INIT (YYYYMMDDHH UTC)','T2m (K)', 'RH2m (%)','TSG' ,'TSFC (K)','Snowfall (cm)','Wind Speed 10m (m/s)','Wind Direction 10 m (deg)','Downward Short Wave (W/m2)'] # Is TSFC surface temp, or need to derive from LW??
-            df_selected = forecast_df[columns_to_write][1:].round(2)
-
-            # Write the selected columns to the file, appending it 
-            df_selected.to_csv(f'{StationID}.smet', mode='a', header=False, index=False, sep=' ')
-
-            #add forecast data to plotting arrays
-            np.append(date, df_selected['INIT (YYYYMMDDHH UTC)'].to_list())
-            np.append(VW,df_selected['Wind Speed 10m (m/s)'].to_list())
-            np.append(TA,df_selected['T2m (K)'].to_list())
-            np.append(RH,df_selected['RH2m (%)'].to_list())
-            np.append(TSG,df_selected['TSG'].to_list())
-            np.append(DW,df_selected['Wind Direction 10 m (deg)'].to_list())
-            np.append(ISWR,df_selected['Downward Short Wave (W/m2)'].to_list())
-            np.append(HS,df_selected['Snowfall (cm)'].to_list())
-        except:
-            forecast_df = hrrr.get_hrrr_forecast(forecast_start_time,sitelat,sitelon,siteelev = altitude,mlthick = 300,maxprocesses = maxprocesses)
-            
-            #load csv for debugging
-            #forecast_df =  pd.read_csv('/Users/travismorrison/Documents/GitHub/UAC-Snowpack/hrrr-snowpack/hrrr_to_snowpack_2024031818.csv',header=0)
-    
-                    
-            #Need to correct date and add TSG (= 273.15), doesn't matter what col its added since we cherry pick cols
-            forecast_df.insert(0, "TSG", np.ones(len(forecast_df['INIT (YYYYMMDDHH UTC)']))*273.15)
-            #Fix date time based on forecast
-            forecast_df['INIT (YYYYMMDDHH UTC)'] =  [datetime.isoformat(datetime.strptime(station_last_obs_time, '%Y-%m-%dT%H:%M:%S') + timedelta(hours=x)) for x in range(len(forecast_df['INIT (YYYYMMDDHH UTC)']))] 
-            
-            #forecast_df['INIT (YYYYMMDDHH UTC)'] =  forecast_df['INIT (YYYYMMDDHH UTC)']
-            forecast_df['RH2m (%)'] = forecast_df['RH2m (%)']/100
-
-            # Selecting the specific columns
-            # Columns to be selected
-            columns_to_write = ['INIT (YYYYMMDDHH UTC)','T2m (K)', 'RH2m (%)','TSG' ,'TSFC (K)','Snowfall (cm)','Wind Speed 10m (m/s)','Wind Direction 10 m (deg)','Downward Short Wave (W/m2)'] # Is TSFC surface temp, or need to derive from LW??
-            df_selected = forecast_df[columns_to_write][1:].round(2)
-
-            # Write the selected columns to the file, appending it 
-            df_selected.to_csv(f'{StationID}.smet', mode='a', header=False, index=False, sep=' ')
-
-            #add forecast data to plotting arrays
-            np.append(date, df_selected['INIT (YYYYMMDDHH UTC)'].to_list())
-            np.append(VW,df_selected['Wind Speed 10m (m/s)'].to_list())
-            np.append(TA,df_selected['T2m (K)'].to_list())
-            np.append(RH,df_selected['RH2m (%)'].to_list())
-            np.append(TSG,df_selected['TSG'].to_list())
-            np.append(DW,df_selected['Wind Direction 10 m (deg)'].to_list())
-            np.append(RSWR,(df_selected['Downward Short Wave (W/m2)'].to_list())*0.85) #convert to RSWR
-            np.append(HS,df_selected['Snowfall (cm)'].to_list())
-        else: 
-            print("Appending forecast failed")
 
-    # Write end datetime to a file for use in SNOWPACK workflow - Note that this handles errors associated 
-    # with the current time not matching the last obs from the Wx station
-    # !!! Need to move and read from *.smet to handle forecasting data being appended 
-    with open(f'{StationID}.smet') as f:
-        for line in f:
-            pass
-        last_line = line
-
-    filename = 'smet_end_datetime.dat'
-    with open(filename, 'w') as file:
+def write_smet_end_datetime(smetfile, filename='smet_end_datetime.dat'):
+    """
+    Write the time of the last row of a SMET file for the SNOWPACK workflow
+
+    The file is replaced in one step, so a reader never sees it half written
+    while the forecast is still being appended.
+    """
+    last_line = read_last_line(smetfile)
+    with open(filename + '.part', 'w') as file:
         file.write(f'end_year = {last_line[0:4]}\n')
         file.write(f'end_month = {last_line[5:7]}\n')
-        #file.write(f'end_mon_10 = {end_mon_10}\n')
         file.write(f'end_day = {last_line[8:10]}\n')
-        #file.write(f'end_10 = {end_10}\n')
         file.write(f'end_hour = {last_line[11:13]}\n')
         file.write(f'end_min = {last_line[14:16]}\n')
+    os.replace(filename + '.part', filename)
+
+
+class ForecastWriter:
+    """
+    Appends HRRR forecast rows to the SMET files of stations as the forecast hours arrive
+
+    Used as the on_hour callback of hrrr_snowpack_1_4.get_hrrr_forecast_sites,
+    every forecast hour is written as soon as it and the hours before it are
+    done, so {stid}.smet (and smet_end_datetime.dat with end_datetime) cover
+    the horizon reached so far while later hours are still running. Rows valid
+    at or before the last row written are skipped, so the whole table can be
+    given again at the end to catch up on anything not streamed.
+
+    Parameters
+    ----------
+    stids : list of string
+        stations with a {stid}.smet file written up to the last observation
+    end_datetime : boolean, optional
+        rewrite smet_end_datetime.dat after every forecast hour
+    """
+
+    def __init__(self, stids, end_datetime=False):
+        self.fields = {}
+        self.last = {}
+        self.rows = {}
+        for stid in stids:
+            self.fields[stid] = read_smet_header(f'{stid}.smet')[0]['fields'][1:]
+            self.last[stid] = np.datetime64(read_smet_obs_end(f'{stid}.smet')[1], 's')
+            self.rows[stid] = 0
+        self.end_datetime = end_datetime
+
+    def append(self, stid, forecast):
+        """
+        Append the rows of a forecast table valid after the last row written, returns their number
+        """
+        timestamps, columns = transform_forecast(forecast, self.fields[stid], self.last[stid])
+        if len(timestamps) > 0:
+            with open(f'{stid}.smet', 'a') as fileID:
+                write_smet_rows(fileID, timestamps, columns)
+            self.last[stid] = timestamps[-1]
+            self.rows[stid] += len(timestamps)
+            if self.end_datetime:
+                write_smet_end_datetime(f'{stid}.smet')
+        return len(timestamps)
+
+    def __call__(self, fhr, forecasts):
+        for stid, forecast in forecasts.items():
+            if stid in self.last:
+                self.append(stid, forecast)
+
+
+def fetch_forecasts(stids, maxprocesses=FORECAST_MAXPROCESSES, append=False):
+    """
+    HRRR forecasts for the SMET files of a list of stations, each cycle fetched and decoded once for all of them
+
+    The cycle of a station is the hour before its last observation, the sites
+    are taken from the SMET header. The forecast hours go through the HRRR
+    file cache and point forecast store, so a rerun for the same cycle does
+    not download or decode them again.
+
+    Parameters
+    ----------
+    stids : list of string
+        stations with a {stid}.smet file
+    maxprocesses : int, optional
+        parallel HRRR processes
+    append : boolean, optional
+        append each forecast hour to the SMET files as soon as it is done
+        (see ForecastWriter). Hours written before a cycle fails stay in the
+        files. smet_end_datetime.dat follows when there is a single station.
+
+    Returns
+    -------
+    forecasts : dict
+        station ID -> hrrr_snowpack_1_4.COLUMNS table
+    failures : dict
+        station ID -> error message for the stations without a forecast
+
+    """
+    # Imported here, only the forecast runs need the HRRR stack
+    import hrrr_snowpack_1_4 as hrrr
+
+    cycles = {}
+    for stid in stids:
+        header = read_smet_header(f'{stid}.smet')[0]
+        forecast_start_time = datetime.strptime(read_smet_obs_end(f'{stid}.smet')[1], '%Y-%m-%dT%H:%M:%S') \
+            - timedelta(hours=1)
+        site = hrrr.Site(stid, float(header['latitude']), float(header['longitude']), float(header['altitude']),
+                         FORECAST_MLTHICK)
+        cycles.setdefault(forecast_start_time.strftime('%Y%m%d%H'), []).append(site)
+
+    forecasts = {}
+    failures = {}
+    for cycle, sites in cycles.items():
+        writer = ForecastWriter([site.stid for site in sites], len(stids) == 1) if append else None
+        try:
+            forecasts.update(hrrr.get_hrrr_forecast_sites(datetime.strptime(cycle, '%Y%m%d%H'), sites, maxprocesses,
+                                                          on_hour=writer))
+        except Exception as e:
+            logging.exception("HRRR forecast " + cycle + " failed")
+            for site in sites:
+                failures[site.stid] = type(e).__name__+': '+str(e)
+        if writer is not None:
+            for site in sites:
+                if site.stid in forecasts:
+                    writer.append(site.stid, forecasts[site.stid])
+                print("Appended " + str(writer.rows[site.stid]) + " forecast hours to " + site.stid + ".smet")
+    return forecasts, failures
+
+
+def append_forecast(stid, forecast):
+    """
+    Append the forecast rows valid after the last observation to {stid}.smet
+
+    The HRRR columns are mapped to the fields of the file by FORECAST_TRANSFORMS,
+    the fields without a forecast are nodata.
+
+    Returns
+    -------
+    rows : int
+        forecast rows appended
+
+    """
+    rows = ForecastWriter([stid]).append(stid, forecast)
+    print("Appended " + str(rows) + " forecast hours to " + stid + ".smet")
+    return rows
+
+
+def finish_smet(stid, start_time, station_last_obs_time, make_input_plot, forecast_bool, forecast=None):
+    """
+    Function to append the forecast to {stid}.smet, write smet_end_datetime.dat and plot the input data
+
+    Parameters
+    ----------
+    stid : string
+        station ID, its SMET file has been written up to the last observation
+    start_time : string
+        start of the window in YYYYMMDDHHmm, for the plot name
+    station_last_obs_time : string
+        last observation, YYYY-MM-DDTHH:MM:SS
+    make_input_plot, forecast_bool : boolean
+        as in mesowest_to_smet
+    forecast : DataFrame, optional
+        HRRR forecast of the station already fetched (see fetch_forecasts). Default
+        is to fetch it and append each forecast hour as it is done.
+
+    Returns
+    -------
+    None.
+
+    """
+    if forecast_bool == True:
+        print("Running in forecasting mode, appending HRRR forecast data")
+        if forecast is None:
+            forecasts, failures = fetch_forecasts([stid], append=True)
+            if stid in failures:
+                print("Appending forecast failed")
+        else:
+            append_forecast(stid, forecast)
+
+    # Write end datetime to a file for use in SNOWPACK workflow - Note that this handles errors associated 
+    # with the current time not matching the last obs from the Wx station
+    write_smet_end_datetime(f'{stid}.smet')
 
     # Make time series plot of the input data
     if make_input_plot == True:
-        # need to append more dates for the plot
+        # Observations and forecast, read back from the file
+        _, date, input_columns = read_smet(f'{stid}.smet', as_frame=False, nodata_to_nan=False)
+        TA, RH, HS, VW = (input_columns[field] for field in ('TA', 'RH', 'HS', 'VW'))
+        TSS, ISWR = (input_columns.get(field) for field in ('TSS', 'ISWR'))
         import matplotlib.pyplot as plt
         from matplotlib.dates import DateFormatter, AutoDateLocator
         
@@ -410,6 +563,75 @@ def mesowest_to_smet(start_time, current_time,stid,make_input_plot,forecast_bool
         plt.tight_layout()
         plt.savefig('./figures/' + stid + ''+ start_time + '_' + station_last_obs_time + '_+48hr_timeseries.png')
         
+def mesowest_to_smet_stations(start_time, current_time, stids, make_input_plot=False, forecast_bool=False,
+                              incremental=False, stations_per_request=MESOWEST_STATIONS_PER_REQUEST,
+                              max_workers=MESOWEST_MAX_WORKERS, cachedir=MESOWEST_CACHE_DIR,
+                              offline=MESOWEST_OFFLINE, qc=True):
+    """
+    Function to build the snowpack input files of a list of stations
+
+    The stations are requested several at a time (multi-station query) with the
+    requests running concurrently, then every station's part of the response
+    goes through mesowest_to_smet to its own {stid}.smet. A station that fails
+    does not stop the others. The HRRR forecast of all the stations is then
+    fetched in one pass per cycle (fetch_forecasts) and each forecast hour is
+    appended to every file as soon as it is done.
+
+    Parameters
+    ----------
+    start_time : string
+        start time for data in YYYYMMDDHHmm. Time in UTC
+    current_time : string
+        end time for data in YYYYMMDDHHmm. Time in UTC.
+    stids : list of string
+        station IDs from Mesowest
+    make_input_plot, forecast_bool, incremental : boolean, optional
+        as in mesowest_to_smet. With incremental each station is requested from
+        the last observation in its SMET file.
+    stations_per_request : int, optional
+        stations asked for in one request
+    max_workers : int, optional
+        concurrent requests
+    cachedir, offline, qc : optional
+        as in mesowest_to_smet
+
+    Returns
+    -------
+    written : list of string
+        stations whose SMET file was written
+    failures : dict
+        station ID -> error message for the others
+
+    """
+    starts = {}
+    for stid in stids:
+        obs_end = read_smet_obs_end(f'{stid}.smet') if incremental else None
+        starts[stid] = start_time if obs_end is None else incremental_start(obs_end, start_time).strftime('%Y%m%d%H%M')
+    results, failures = fetch_stations(stids, starts, current_time, stations_per_request, max_workers,
+                                       cachedir=cachedir, offline=offline)
+
+    written = []
+    for stid in stids:
+        if stid not in results:
+            print("Fetching " + stid + " failed: " + failures[stid])
+            continue
+        try:
+            mesowest_to_smet(start_time, current_time, stid, False, False, incremental,
+                             data=results[stid], cachedir=cachedir, offline=offline, qc=qc)
+            written.append(stid)
+        except Exception as e:
+            logging.exception("Building the SMET file of " + stid + " failed")
+            failures[stid] = type(e).__name__+': '+str(e)
+
+    if forecast_bool == True or make_input_plot == True:
+        forecast_failures = fetch_forecasts(written, append=True)[1] if forecast_bool == True else {}
+        for stid in written:
+            if stid in forecast_failures:
+                print("Appending forecast to " + stid + ".smet failed: " + forecast_failures[stid])
+            finish_smet(stid, start_time, read_smet_obs_end(f'{stid}.smet')[1], make_input_plot, False)
+    return written, failures
+
+
 def get_current_time(write_current_time = True):
     """
     Function to get current time and print time to file for bash script to call snowpack
@@ -468,17 +690,27 @@ if __name__ == "__main__":
     make_input_plot = False
     stid = 'ATH20'#'ATH20'#'UKALF' #Defualt is atwater study plot
     forecast_bool = False
+    incremental = True # Append to an existing {stid}.smet instead of rebuilding the season
 
     
     # Set default values or use command-line arguments
     var1 = sys.argv[1] if len(sys.argv) > 1 else start_time
     var2 = sys.argv[2] if len(sys.argv) > 2 else current_time
-    var3 = sys.argv[3] if len(sys.argv) > 3 else stid
+    var3 = sys.argv[3] if len(sys.argv) > 3 else stid # Comma separated list for several stations
     var4 = sys.argv[4] if len(sys.argv) > 4 else make_input_plot
     var5 = sys.argv[5] if len(sys.argv) > 5 else forecast_bool
+    var6 = sys.argv[6].lower() in ('1', 'true', 'yes') if len(sys.argv) > 6 else incremental
+    var7 = sys.argv[7].lower() in ('1', 'true', 'yes') if len(sys.argv) > 7 else MESOWEST_OFFLINE # Replay from mesowest_cache, give the end time
+    var8 = sys.argv[8].lower() in ('1', 'true', 'yes') if len(sys.argv) > 8 else True # QC of the observations, false for the raw values
 
     # Call mesowest to smet converter
-    mesowest_to_smet(var1, var2, var3, var4, var5)
+    if ',' in var3:
+        written, failures = mesowest_to_smet_stations(var1, var2, var3.split(','), var4, var5, var6, offline=var7,
+                                                      qc=var8)
+        if len(failures) > 0:
+            sys.exit(1)
+    else:
+        mesowest_to_smet(var1, var2, var3, var4, var5, var6, offline=var7, qc=var8)
     
     
     
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Mesowest observations to SMET columns
+
+The OBSERVATIONS dict of a Mesowest timeseries response is loaded once into
+NumPy arrays and every SMET field is produced from it by one row of
+OBSERVATION_TRANSFORMS, applied to the whole column at once:
+
+    source    Mesowest variable, or None for a constant field
+    constant  value of a constant field
+    offset    added to the values (e.g. C to K)
+    divisor   the values are divided by it (e.g. % to fraction, mm to m)
+    valid_min values at or below it are missing
+    clip_min  values below it (and above valid_min) are set to it
+    optional  the field is left out when the station does not report it
+
+Missing values (None in the JSON) and values outside the valid range are
+written as NODATA.  The table reproduces the list comprehensions
+mesowest_to_smet used before, so the SMET output is unchanged.
+
+FORECAST_TRANSFORMS does the same for the HRRR forecast rows appended after
+the observations (hrrr_snowpack_1_4.COLUMNS tables), field by field, so the
+forecast lines up with whatever fields the station's file has.
+"""
+import sys
+import time
+import numpy as np
+
+# SMET nodata value
+NODATA = -999
+
+# SMET fields in file order and how to compute them from the Mesowest variables
+OBSERVATION_TRANSFORMS = {
+    'TA': {'source': 'air_temp_set_1', 'offset': 273.15},
+    'RH': {'source': 'relative_humidity_set_1', 'divisor': 100.0},
+    'TSG': {'source': None, 'constant': 273.15},  # Ground surface temperature assumed to be 0°C
+    'HS': {'source': 'snow_depth_set_1', 'divisor': 1000.0},
+    'VW': {'source': 'wind_speed_set_1'},
+    'DW': {'source': 'wind_direction_set_1'},
+    'TSS': {'source': 'surface_temp_set_1', 'offset': 273.15, 'optional': True},
+    'ISWR': {'source': 'solar_radiation_set_1', 'valid_min': -100, 'clip_min': 0, 'optional': True},
+    'RSWR': {'source': 'outgoing_radiation_sw_set_1', 'valid_min': -100, 'clip_min': 0, 'optional': True},
+    'ILWR': {'source': 'incoming_radiation_lw_set_1', 'valid_min': -100, 'clip_min': 0, 'optional': True},
+    'RLWR': {'source': 'outgoing_radiation_lw_set_1', 'valid_min': -100, 'clip_min': 0, 'optional': True},
+}
+
+# SMET fields of the forecast rows from the HRRR columns, fields without a row (HS) are written as nodata
+FORECAST_TRANSFORMS = {
+    'TA': {'source': 'T2m (K)'},
+    'RH': {'source': 'RH2m (%)', 'divisor': 100.0},
+    'TSG': {'source': None, 'constant': 273.15},
+    'VW': {'source': 'Wind Speed 10m (m/s)'},
+    'DW': {'source': 'Wind Direction 10 m (deg)'},
+    'TSS': {'source': 'TSFC (K)'},
+    'ISWR': {'source': 'Downward Short Wave (W/m2)', 'clip_min': 0},
+    'RSWR': {'source': 'Upward Short Wave (W/m2)', 'clip_min': 0},
+    'ILWR': {'source': 'Downward Long Wave (W/m2)', 'clip_min': 0},
+    'RLWR': {'source': 'Upward Long Wave (W/m2)', 'clip_min': 0},
+}
+
+
+def parse_timestamps(date_time):
+    """
+    Mesowest date_time strings (YYYY-MM-DDTHH:MM:SSZ) to a datetime64[s] array, in one pass
+
+    Parameters
+    ----------
+    date_time : list of string
+        OBSERVATIONS['date_time']
+
+    Returns
+    -------
+    timestamps : array of datetime64[s]
+
+    """
+    # The U19 cast drops the trailing Z
+    return np.asarray(date_time, dtype='U19').astype('datetime64[s]')
+
+
+def load_observations(observations):
+    """
+    Mesowest OBSERVATIONS dict to NumPy arrays
+
+    Parameters
+    ----------
+    observations : dict
+        variable name -> list of values, as in the API response
+
+    Returns
+    -------
+    arrays : dict
+        'date_time' as datetime64[s], every other variable as float64 with NaN
+        for missing values
+
+    """
+    arrays = {}
+    for name, values in observations.items():
+        if name == 'date_time':
+            arrays[name] = parse_timestamps(values)
+        else:
+            try:
+                arrays[name] = np.asarray(values, dtype=float)
+            except (TypeError, ValueError):
+                # Not a numeric variable (e.g. a qc flag string), not used for SMET
+                continue
+    return arrays
+
+
+def apply_transform(values, transform, nodata=NODATA):
+    """
+    One row of OBSERVATION_TRANSFORMS applied to a float array, missing values set to nodata
+    """
+    if 'offset' in transform:
+        values = values + transform['offset']
+    if 'divisor' in transform:
+        values = values / transform['divisor']
+    missing = np.isnan(values)
+    if 'valid_min' in transform:
+        missing |= values <= transform['valid_min']
+    if 'clip_min' in transform:
+        values = np.where(values < transform['clip_min'], transform['clip_min'], values)
+    return np.where(missing, nodata, values)
+
+
+def transform_observations(observations, transforms=OBSERVATION_TRANSFORMS, nodata=NODATA, all_optional=False):
+    """
+    SMET columns of a Mesowest OBSERVATIONS dict
+
+    Parameters
+    ----------
+    observations : dict
+        OBSERVATIONS of the API response, or the arrays of load_observations
+    transforms : dict, optional
+        field -> transform, see OBSERVATION_TRANSFORMS
+    nodata : float, optional
+        value written for missing data
+    all_optional : boolean, optional
+        leave out every field whose variable is missing, without a message (e.g.
+        for one chunk of a longer window)
+
+    Returns
+    -------
+    timestamps : array of datetime64[s]
+    columns : dict
+        SMET field -> float64 array, in the order of transforms, without the
+        optional fields the station does not report
+
+    Raises
+    ------
+    KeyError
+        if a required variable is not in the observations
+
+    """
+    if not isinstance(observations.get('date_time'), np.ndarray):
+        observations = load_observations(observations)
+    timestamps = observations['date_time']
+    columns = {}
+    for field, transform in transforms.items():
+        source = transform['source']
+        if source is None:
+            columns[field] = np.full(len(timestamps), float(transform['constant']))
+        elif source in observations:
+            columns[field] = apply_transform(observations[source], transform, nodata)
+        elif all_optional:
+            continue
+        elif transform.get('optional', False):
+            print(field + " not found")
+        else:
+            raise KeyError(source)
+    return timestamps, columns
+
+
+def forecast_valid_times(forecast):
+    """
+    Valid times (INIT + FHR) of the rows of an HRRR forecast table, as datetime64[s]
+    """
+    init = [str(cycle)[0:4]+'-'+str(cycle)[4:6]+'-'+str(cycle)[6:8]+'T'+str(cycle)[8:10]
+            for cycle in forecast['INIT (YYYYMMDDHH UTC)']]
+    return np.array(init, dtype='datetime64[h]').astype('datetime64[s]') + np.asarray(forecast['FHR'], dtype=int)*np.timedelta64(1, 'h')
+
+
+def transform_forecast(forecast, fields, after=None, transforms=FORECAST_TRANSFORMS, nodata=NODATA):
+    """
+    SMET rows of an HRRR forecast table for the fields of a station's file
+
+    Parameters
+    ----------
+    forecast : DataFrame or dict
+        hrrr_snowpack_1_4.COLUMNS table, one row per forecast hour
+    fields : list of string
+        SMET fields (without timestamp) in file order
+    after : datetime64, optional
+        keep only the rows valid after it, e.g. the last observation
+    transforms : dict, optional
+        field -> transform, see FORECAST_TRANSFORMS
+    nodata : float, optional
+        value written for missing data and for fields without a transform
+
+    Returns
+    -------
+    timestamps : array of datetime64[s]
+        valid times of the rows
+    columns : list of array
+        values of fields, in file order
+
+    """
+    timestamps = forecast_valid_times(forecast)
+    keep = np.ones(len(timestamps), dtype=bool) if after is None else timestamps > np.datetime64(after, 's')
+    timestamps = timestamps[keep]
+    columns = []
+    for field in fields:
+        transform = transforms.get(field)
+        if transform is None:
+            columns.append(np.full(len(timestamps), float(nodata)))
+        elif transform['source'] is None:
+            columns.append(np.full(len(timestamps), float(transform['constant'])))
+        else:
+            columns.append(apply_transform(np.asarray(forecast[transform['source']], dtype=float)[keep], transform,
+                                           nodata))
+    return timestamps, columns
+
+
+# Time the transforms on a synthetic hourly record:  python mesowest_transform.py [years]
+if __name__ == "__main__":
+
+    years = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    n = int(years*365*24)
+    rng = np.random.default_rng(0)
+    start = np.datetime64('2020-10-05T00:00:00')
+    observations = {'date_time': [str(t)+'Z' for t in start + np.arange(n)*np.timedelta64(1, 'h')]}
+    for transform in OBSERVATION_TRANSFORMS.values():
+        if transform['source'] is not None:
+            values = rng.normal(0., 100., n).round(2).tolist()
+            observations[transform['source']] = [None if i % 97 == 0 else v for i, v in enumerate(values)]
+
+    start = time.time()
+    timestamps, columns = transform_observations(observations)
+    print(str(n)+' hourly observations of '+str(len(columns))+' fields transformed in '
+          + str(round(time.time() - start, 3))+' s')
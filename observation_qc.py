@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Quality control of Mesowest observations before they go to SMET
+
+Each field of QC_RULES goes through, in this order:
+
+    despike   single values jumping by more than this and coming back are
+              replaced by the mean of their neighbours (station_corrections)
+    max_rate  values changing by more than this per hour from the previous
+              row are set missing
+    max_gap   runs of at most this many missing rows (hours for hourly
+              stations) between two valid values are filled by linear
+              interpolation in time; longer runs stay nodata
+
+Missing runs are found by run-length detection on the nodata mask and all
+steps are whole-array operations, so a season of several stations is checked
+in milliseconds.  Every step only looks a few rows around each value (at
+most qc_context rows), which lets qc_blocks check a long record block by
+block and give the same result as checking it at once.
+"""
+import sys
+import time
+import numpy as np
+from mesowest_transform import NODATA
+from station_corrections import apply_correction
+from pipeline_timing import stage
+
+# QC of each SMET field; values in SMET units (K, 1, m, W/m2), rates per hour
+QC_RULES = {
+    'TA': {'max_gap': 3, 'max_rate': 10.},
+    'RH': {'max_gap': 3},
+    'HS': {'max_gap': 6, 'despike': 0.2, 'max_rate': 0.15},
+    'ISWR': {'max_gap': 6},
+}
+
+QC_ACTIONS = ('despiked', 'rate_limited', 'filled')
+
+
+def qc_context(rules=QC_RULES):
+    """
+    Rows on each side a QC result depends on: the gap, plus one row each for max_rate and despike, plus one
+    """
+    return max([rule.get('max_gap', 0) for rule in rules.values()] + [0]) + 3
+
+
+def missing_runs(missing):
+    """
+    Start (included) and end (excluded) index of each run of True in a boolean array
+    """
+    edges = np.diff(np.concatenate(([0], missing.astype(np.int8), [0])))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def qc_series(timestamps, values, rule, nodata=NODATA):
+    """
+    QC of one field
+
+    Parameters
+    ----------
+    timestamps : array of datetime64[s]
+        increasing times of the rows
+    values : array
+        values of the field, missing as nodata or NaN
+    rule : dict
+        row of QC_RULES
+    nodata : float, optional
+        value written for missing data
+
+    Returns
+    -------
+    values : array of float
+        checked copy of the values
+    flags : dict
+        action -> boolean array of the values it changed, see QC_ACTIONS
+
+    """
+    values = np.array(values, dtype=float)
+    n = len(values)
+    flags = {}
+    if 'despike' in rule:
+        before = values.copy()
+        apply_correction(values, np.ones(n, dtype=bool), {'action': 'despike', 'value': rule['despike']}, nodata)
+        flags['despiked'] = values != before
+    if 'max_rate' in rule and n > 1:
+        valid = (values != nodata) & ~np.isnan(values)
+        hours = np.diff(timestamps).astype('timedelta64[s]').astype(float)/3600.
+        limited = np.zeros(n, dtype=bool)
+        limited[1:] = valid[1:] & valid[:-1] & (np.abs(np.diff(values)) > rule['max_rate']*hours)
+        values[limited] = nodata
+        flags['rate_limited'] = limited
+    if 'max_gap' in rule:
+        missing = (values == nodata) | np.isnan(values)
+        starts, ends = missing_runs(missing)
+        fillable = (ends - starts <= rule['max_gap']) & (starts > 0) & (ends < n)
+        # Rows of the fillable runs, from +1 at their start and -1 at their end
+        edges = np.zeros(n+1, dtype=int)
+        np.add.at(edges, starts[fillable], 1)
+        np.add.at(edges, ends[fillable], -1)
+        filled = np.cumsum(edges[:-1]) > 0
+        if filled.any():
+            seconds = timestamps.astype('datetime64[s]').astype('int64')
+            values[filled] = np.interp(seconds[filled], seconds[~missing], values[~missing])
+        flags['filled'] = filled
+    return values, flags
+
+
+def qc_observations(timestamps, columns, rules=QC_RULES, nodata=NODATA):
+    """
+    QC of SMET columns
+
+    Parameters
+    ----------
+    timestamps : array of datetime64[s]
+        increasing times of the rows
+    columns : dict
+        field -> values, not modified
+    rules : dict, optional
+        field -> rule, see QC_RULES. Fields without a rule are returned as given.
+    nodata : float, optional
+        value written for missing data
+
+    Returns
+    -------
+    columns : dict
+        field -> values after QC
+    flags : dict
+        field -> action -> boolean array of the values changed
+
+    """
+    timestamps = np.asarray(timestamps, dtype='datetime64[s]')
+    columns = dict(columns)
+    flags = {}
+    for field, rule in rules.items():
+        if field in columns:
+            columns[field], flags[field] = qc_series(timestamps, columns[field], rule, nodata)
+    return columns, flags
+
+
+def qc_blocks(blocks, rules=QC_RULES, nodata=NODATA, report=None):
+    """
+    QC of a record given in time ordered blocks, with the same result as qc_observations on the whole record
+
+    The last rows of each block are held back until the next block arrives,
+    and the raw rows around them are checked again with it, so values near
+    block borders see their neighbours on both sides.
+
+    Parameters
+    ----------
+    blocks : iterable
+        (timestamps, columns) with increasing, not repeated timestamps and the
+        same fields in every block
+    rules : dict, optional
+        see QC_RULES
+    nodata : float, optional
+        value written for missing data
+    report : dict, optional
+        field -> action -> number of values changed, counts are added to it
+
+    Yields
+    ------
+    timestamps, columns : array, dict
+        checked rows, in order
+
+    """
+    context = qc_context(rules)
+    carry = None
+    emitted = 0  # Rows of carry already yielded
+    for timestamps, columns in blocks:
+        if carry is not None:
+            timestamps = np.concatenate((carry[0], timestamps))
+            columns = {field: np.concatenate((carry[1][field], values)) for field, values in columns.items()}
+        if len(timestamps) == 0:
+            continue
+        with stage('qc'):
+            checked, flags = qc_observations(timestamps, columns, rules, nodata)
+        stop = max(emitted, len(timestamps) - context)
+        if stop > emitted:
+            yield _qc_rows(timestamps, checked, flags, emitted, stop, report)
+        # Raw rows kept for the next block: the ones held back and the context before them
+        keep = max(0, stop - context)
+        carry = (timestamps[keep:], {field: values[keep:] for field, values in columns.items()})
+        emitted = stop - keep
+    if carry is not None and len(carry[0]) > emitted:
+        with stage('qc'):
+            checked, flags = qc_observations(carry[0], carry[1], rules, nodata)
+        yield _qc_rows(carry[0], checked, flags, emitted, len(carry[0]), report)
+
+
+def _qc_rows(timestamps, columns, flags, start, stop, report):
+    if report is not None:
+        for field, actions in flags.items():
+            for action, changed in actions.items():
+                counts = report.setdefault(field, {})
+                counts[action] = counts.get(action, 0) + int(np.count_nonzero(changed[start:stop]))
+    return timestamps[start:stop], {field: values[start:stop] for field, values in columns.items()}
+
+
+def format_qc_report(report):
+    """
+    One line per field with the values each QC step changed, '' if nothing changed
+    """
+    lines = []
+    for field, counts in report.items():
+        changed = [action+' '+str(count) for action, count in counts.items() if count > 0]
+        if len(changed) > 0:
+            lines.append('QC ' + field + ': ' + ', '.join(changed))
+    return '\n'.join(lines)
+
+
+# Time the QC on synthetic hourly records:  python observation_qc.py [years] [stations]
+if __name__ == "__main__":
+
+    years = float(sys.argv[1]) if len(sys.argv) > 1 else 1
+    stations = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    n = int(years*365*24)
+    rng = np.random.default_rng(0)
+    timestamps = np.datetime64('2024-10-05T00:00:00') + np.arange(n)*np.timedelta64(1, 'h')
+    records = []
+    for i in range(stations):
+        columns = {'TA': 270. + 5.*rng.standard_normal(n), 'RH': rng.uniform(0.2, 1., n),
+                   'HS': np.cumsum(rng.normal(0., 0.01, n)) + 1., 'ISWR': rng.uniform(0., 800., n)}
+        for values in columns.values():
+            values[rng.random(n) < 0.02] = NODATA
+        records.append(columns)
+
+    start = time.time()
+    for columns in records:
+        qc_observations(timestamps, columns)
+    print(str(stations)+' stations of '+str(n)+' hourly rows checked in '+str(round(1000*(time.time() - start), 1))+' ms')
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Offline end-to-end benchmarks of the HRRR and Mesowest pipelines
+#
+# Runs processhrrr, get_hrrr_forecast, get_hrrr_forecast_sites and mesowest_to_smet(_stations) against
+# the local stand-ins of offline_fixtures.py: synthetic HRRR-shaped GRIB2+idx files served by
+# LocalS3Server and season-length Mesowest responses from LocalMesowestServer, so everything runs on a
+# laptop without network.  The size of a run is set by a scale (forecast hours, HRRR sites, Mesowest
+# stations, season length, see BENCHMARK_SCALES).  Every benchmark is run repeat times from an empty
+# HRRR cache, point store and Mesowest cache and the best time is kept, together with the per-stage
+# totals of pipeline_timing.  The results are appended as JSON lines to BENCHMARK_RESULTS and compared
+# to the times stored in BENCHMARK_BASELINE: a benchmark more than BENCHMARK_TOLERANCE slower is
+# reported as a regression.
+#
+#   python offline_benchmark.py [--scale small|medium|large] [--repeat 3] [--save-baseline]
+#
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import platform
+import argparse
+import tempfile
+import subprocess
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+import numpy as np
+# The HRRR stack goes first, eccodes (offline_fixtures) after it
+import hrrr_snowpack_1_4 as hrrr
+import hrrr_fetch
+import mesowest_fetch
+import pipeline_timing
+from pipeline_timing import summarize_timing_log
+from mesowest_to_smet_forecast import mesowest_to_smet, mesowest_to_smet_stations
+from offline_fixtures import LocalS3Server, LocalMesowestServer, write_hrrr_cycle
+
+# Results file (JSON lines, one per benchmark run) and baseline file (benchmark@scale -> seconds)
+BENCHMARK_RESULTS = os.environ.get('BENCHMARK_RESULTS', './benchmark_results.jsonl')
+BENCHMARK_BASELINE = os.environ.get('BENCHMARK_BASELINE', './benchmark_baseline.json')
+
+# Fraction a benchmark may be slower than its baseline before it is a regression
+BENCHMARK_TOLERANCE = float(os.environ.get('BENCHMARK_TOLERANCE', 0.25))
+
+# Size of a run: forecast hours of the cycle (19 or 49), HRRR sites, Mesowest stations and season days
+BENCHMARK_SCALES = {
+    'small': {'fhrs': 19, 'sites': 3, 'stations': 2, 'season_days': 30, 'maxprocesses': 2},
+    'medium': {'fhrs': 19, 'sites': 20, 'stations': 10, 'season_days': 120, 'maxprocesses': 4},
+    'large': {'fhrs': 49, 'sites': 100, 'stations': 30, 'season_days': 240, 'maxprocesses': 8},
+}
+
+# Synthetic cycles, an hour with an 18 hour and one with a 48 hour forecast (see hrrr_cycle)
+BENCHMARK_CYCLES = {19: datetime(2024, 3, 18, 3), 49: datetime(2024, 3, 18, 0)}
+
+# Start of the synthetic Mesowest season
+SEASON_START = datetime(2024, 10, 5)
+
+BENCHMARKS = ('processhrrr', 'get_hrrr_forecast', 'get_hrrr_forecast_sites', 'mesowest_to_smet',
+              'mesowest_to_smet_stations', 'mesowest_to_smet_incremental')
+
+
+def benchmark_sites(n, seed=0):
+    """n sites spread over the fixture grid (see offline_fixtures.FIXTURE_GRID)."""
+    rng = np.random.default_rng(seed)
+    return [hrrr.Site('SITE'+str(i).zfill(3), round(rng.uniform(40.2, 40.9), 4), round(rng.uniform(-111.95, -111.35), 4),
+                      round(rng.uniform(1400., 3200.), 1), 300) for i in range(n)]
+
+
+def git_commit():
+    """Commit of the working tree, None outside a git checkout."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@contextmanager
+def stand_ins(root, fhrs, latency=0.):
+    """Local S3 and Mesowest stand-ins, with the synthetic HRRR cycle of fhrs forecast hours written below root.
+
+    Yields:
+        tuple: (LocalS3Server, LocalMesowestServer)
+    """
+    cycle = BENCHMARK_CYCLES[fhrs]
+    write_hrrr_cycle(root, cycle.strftime('%Y%m%d%H'), range(fhrs))
+    endpoint, api_url = hrrr_fetch.HRRR_S3_ENDPOINT_URL, mesowest_fetch.MESOWEST_API_URL
+    with LocalS3Server(root, latency) as s3, LocalMesowestServer(latency=latency) as mesowest:
+        hrrr_fetch.HRRR_S3_ENDPOINT_URL = s3.endpoint_url
+        mesowest_fetch.MESOWEST_API_URL = mesowest.api_url
+        try:
+            yield s3, mesowest
+        finally:
+            hrrr_fetch.HRRR_S3_ENDPOINT_URL, mesowest_fetch.MESOWEST_API_URL = endpoint, api_url
+
+
+def run_benchmark(name, func, repeat, workdir, units, setup=None):
+    """Best of repeat runs of func, each in a fresh working directory.
+
+    Args:
+        name (str): benchmark name
+        func (callable): the work, run with the working directory as current directory
+        repeat (int): number of runs
+        workdir (str): parent of the working directories
+        units (float): work done per run (e.g. forecast hours), for the throughput
+        setup (callable, optional): run before func in the same directory, not timed
+
+    Returns:
+        dict: name, best and all times (s), units per second and the per-stage totals of the best run
+    """
+    times = []
+    best = None
+    cwd = os.getcwd()
+    timinglog = pipeline_timing.TIMING_LOG
+    for i in range(repeat):
+        rundir = os.path.join(workdir, name+'_'+str(i))
+        os.makedirs(os.path.join(rundir, 'hrrr_scratch'))
+        os.chdir(rundir)
+        try:
+            if setup is not None:
+                setup()
+            pipeline_timing.TIMING_LOG = os.path.join(rundir, 'timing.jsonl')
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+        finally:
+            pipeline_timing.TIMING_LOG = timinglog
+            os.chdir(cwd)
+        if times[-1] == min(times):
+            logfile = os.path.join(rundir, 'timing.jsonl')
+            best = summarize_timing_log(logfile) if os.path.exists(logfile) else {}
+    return {'benchmark': name, 'seconds': round(min(times), 4), 'runs': [round(t, 4) for t in times],
+            'per_second': round(units/min(times), 3), 'units': units, 'timing': best}
+
+
+def run_benchmarks(scale='small', repeat=3, latency=0., benchmarks=None, **overrides):
+    """Run the offline benchmarks at a scale.
+
+    Args:
+        scale (str, optional): key of BENCHMARK_SCALES. Defaults to 'small'.
+        repeat (int, optional): runs per benchmark, the best is kept. Defaults to 3.
+        latency (float, optional): delay (s) the stand-ins add to every request. Defaults to 0.
+        benchmarks (list, optional): names of the benchmarks to run, some of BENCHMARKS. Defaults to all.
+        **overrides: values replacing the ones of the scale, e.g. stations=5
+
+    Returns:
+        list: one result per benchmark, see run_benchmark, with the scale parameters
+    """
+    params = dict(BENCHMARK_SCALES[scale], **overrides)
+    if params['fhrs'] not in BENCHMARK_CYCLES:
+        raise ValueError('fhrs must be one of '+str(sorted(BENCHMARK_CYCLES)))
+    cycle = BENCHMARK_CYCLES[params['fhrs']]
+    sites = benchmark_sites(params['sites'])
+    stids = ['STN'+str(i).zfill(3) for i in range(params['stations'])]
+    start = SEASON_START.strftime('%Y%m%d%H%M')
+    end = (SEASON_START + timedelta(days=params['season_days'])).strftime('%Y%m%d%H%M')
+    later = (SEASON_START + timedelta(days=params['season_days'] + 1)).strftime('%Y%m%d%H%M')
+    yr, mn, dy, hr = cycle.strftime('%Y'), cycle.strftime('%m'), cycle.strftime('%d'), cycle.strftime('%H')
+    site = sites[0]
+
+    # A season already built (setup), then one more day appended
+    def season():
+        mesowest_to_smet(start, end, stids[0], False, False, cachedir=None)
+
+    # name -> (work, units of work per run, setup)
+    work = {
+        'processhrrr': (lambda: hrrr.processhrrr(yr, mn, dy, hr, 1, site.lat, site.lon, site.elev, site.mlthick,
+                                                 './hrrr_scratch/', cachedir=None), 1, None),
+        'get_hrrr_forecast': (lambda: hrrr.get_hrrr_forecast(cycle, site.lat, site.lon, site.elev, site.mlthick,
+                                                             params['maxprocesses'], cachedir=None, storedir=None),
+                              params['fhrs'], None),
+        'get_hrrr_forecast_sites': (lambda: hrrr.get_hrrr_forecast_sites(cycle, sites, params['maxprocesses'],
+                                                                         csvdir=None, cachedir=None, storedir=None),
+                                    params['fhrs']*params['sites'], None),
+        'mesowest_to_smet': (season, params['season_days']*24, None),
+        'mesowest_to_smet_stations': (lambda: mesowest_to_smet_stations(start, end, stids, cachedir=None),
+                                      params['season_days']*24*params['stations'], None),
+        'mesowest_to_smet_incremental': (lambda: mesowest_to_smet(start, later, stids[0], False, False, True,
+                                                                  cachedir=None), 24, season),
+    }
+    unknown = set(benchmarks or []) - set(work)
+    if unknown:
+        raise ValueError('Unknown benchmarks '+str(sorted(unknown))+', expected some of '+str(BENCHMARKS))
+
+    results = []
+    root = tempfile.mkdtemp(prefix='benchmark_')
+    try:
+        with stand_ins(os.path.join(root, 's3'), params['fhrs'], latency):
+            for name in BENCHMARKS:
+                if benchmarks is not None and name not in benchmarks:
+                    continue
+                func, units, setup = work[name]
+                result = run_benchmark(name, func, repeat, root, units, setup)
+                result.update({'scale': scale, 'params': params, 'latency': latency})
+                results.append(result)
+                print(name+' ('+scale+'): '+str(result['seconds'])+' s, '+str(result['per_second'])+' per s')
+    finally:
+        shutil.rmtree(root)
+    return results
+
+
+def write_results(results, resultsfile=None):
+    """Append the results to resultsfile (default BENCHMARK_RESULTS) with the time, host and commit of the run."""
+    run = {'time': datetime.now(timezone.utc).isoformat(timespec='seconds'), 'host': socket.gethostname(),
+           'python': platform.python_version(), 'commit': git_commit()}
+    with open(resultsfile or BENCHMARK_RESULTS, 'a') as f:
+        for result in results:
+            f.write(json.dumps(dict(run, **result), default=str)+'\n')
+
+
+def baseline_key(result):
+    return result['benchmark']+'@'+result['scale']
+
+
+def save_baseline(results, baselinefile=None):
+    """Store the times of the results as the baseline, keeping the other entries of the file."""
+    baselinefile = baselinefile or BENCHMARK_BASELINE
+    baseline = {}
+    if os.path.exists(baselinefile):
+        with open(baselinefile) as f:
+            baseline = json.load(f)
+    baseline.update({baseline_key(result): result['seconds'] for result in results})
+    with open(baselinefile, 'w') as f:
+        json.dump(baseline, f, indent=1, sort_keys=True)
+
+
+def compare_to_baseline(results, baselinefile=None, tolerance=None):
+    """Regressions of the results against the baseline.
+
+    Returns:
+        list: (benchmark@scale, seconds, baseline seconds) of every benchmark more than tolerance (default
+        BENCHMARK_TOLERANCE) slower than its baseline; benchmarks without a baseline are skipped
+    """
+    baselinefile = baselinefile or BENCHMARK_BASELINE
+    tolerance = BENCHMARK_TOLERANCE if tolerance is None else tolerance
+    if not os.path.exists(baselinefile):
+        return []
+    with open(baselinefile) as f:
+        baseline = json.load(f)
+    regressions = []
+    for result in results:
+        key = baseline_key(result)
+        if key in baseline and result['seconds'] > baseline[key]*(1. + tolerance):
+            regressions.append((key, result['seconds'], baseline[key]))
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the HRRR and Mesowest pipelines')
+    parser.add_argument('--scale', default='small', choices=sorted(BENCHMARK_SCALES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0., help='delay (s) of every stand-in request')
+    parser.add_argument('--benchmark', action='append', help='run only this benchmark, can be repeated')
+    for name in ('fhrs', 'sites', 'stations', 'season_days', 'maxprocesses'):
+        parser.add_argument('--'+name.replace('_', '-'), type=int, dest=name, help='override the scale')
+    parser.add_argument('--results', default=BENCHMARK_RESULTS)
+    parser.add_argument('--baseline', default=BENCHMARK_BASELINE)
+    parser.add_argument('--tolerance', type=float, default=BENCHMARK_TOLERANCE)
+    parser.add_argument('--save-baseline', action='store_true', help='store these times as the baseline')
+    args = parser.parse_args()
+
+    overrides = {name: getattr(args, name) for name in ('fhrs', 'sites', 'stations', 'season_days', 'maxprocesses')
+                 if getattr(args, name) is not None}
+    results = run_benchmarks(args.scale, args.repeat, args.latency, args.benchmark, **overrides)
+    write_results(results, args.results)
+    regressions = compare_to_baseline(results, args.baseline, args.tolerance)
+    if args.save_baseline:
+        save_baseline(results, args.baseline)
+        print('Baseline saved to '+args.baseline)
+    for key, seconds, baseline in regressions:
+        print('REGRESSION '+key+': '+str(seconds)+' s, baseline '+str(baseline)+' s')
+    sys.exit(1 if regressions and not args.save_baseline else 0)
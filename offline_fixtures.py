@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Offline stand-ins for the external services used by the SNOWPACK workflow
+#
+# write_hrrr_grib/write_hrrr_idx build small synthetic HRRR-shaped wrfprs files (Lambert conformal
+# grid, the same parameters, levels and step ranges as the real product plus a few fields we do
+# not read) and LocalS3Server serves a directory tree over the S3 REST API so that the boto3 code
+# paths can be exercised without network access.  LocalMesowestServer answers Mesowest timeseries
+# requests with synthetic hourly observations (mesowest_observations) for any window and station.
+#
+import os
+import re
+import json
+import zlib
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import eccodes
+
+# Synthetic grid, a small Lambert conformal patch over the Wasatch with HRRR projection parameters
+FIXTURE_GRID = {
+    'Nx': 50,
+    'Ny': 40,
+    'latitudeOfFirstGridPointInDegrees': 40.0,
+    'longitudeOfFirstGridPointInDegrees': 247.6,
+    'LaDInDegrees': 38.5,
+    'LoVInDegrees': 262.5,
+    'Latin1InDegrees': 38.5,
+    'Latin2InDegrees': 38.5,
+    'DxInMetres': 3000,
+    'DyInMetres': 3000,
+}
+
+# HRRR pressure levels (hPa)
+FIXTURE_LEVELS = tuple(range(1000, 49, -25))
+
+# (wgrib2 name, discipline, parameterCategory, parameterNumber)
+WGRIB2_PARAMS = {
+    'TMP': (0, 0, 0),
+    'DPT': (0, 0, 6),
+    'RH': (0, 1, 1),
+    'APCP': (0, 1, 8),
+    'UGRD': (0, 2, 2),
+    'VGRD': (0, 2, 3),
+    'VVEL': (0, 2, 8),
+    'PRES': (0, 3, 0),
+    'HGT': (0, 3, 5),
+    'DSWRF': (0, 4, 7),
+    'USWRF': (0, 4, 8),
+    'DLWRF': (0, 5, 3),
+    'ULWRF': (0, 5, 4),
+    'REFC': (0, 16, 196),
+}
+WGRIB2_NAMES = {param: name for name, param in WGRIB2_PARAMS.items()}
+
+
+# Standard-atmosphere height (m) of a pressure level (hPa)
+def _stdheight(press):
+    return 44330.8*(1.0 - (np.asarray(press)/1013.25)**0.190263)
+
+
+# Write one GRIB2 message to an open file
+def _write_message(f, name, typeoflevel, level, values, yyyymmddhh, fhr, accum=None, grid=FIXTURE_GRID):
+    h = eccodes.codes_grib_new_from_samples('GRIB2')
+    try:
+        eccodes.codes_set(h, 'centre', 'kwbc')
+        eccodes.codes_set(h, 'gridType', 'lambert')
+        eccodes.codes_set(h, 'shapeOfTheEarth', 6)
+        eccodes.codes_set(h, 'jScansPositively', 1)
+        for key, val in grid.items():
+            eccodes.codes_set(h, key, val)
+        eccodes.codes_set(h, 'latitudeOfSouthernPoleInDegrees', -90)
+        eccodes.codes_set(h, 'longitudeOfSouthernPoleInDegrees', 0)
+        eccodes.codes_set(h, 'dataDate', int(yyyymmddhh[:8]))
+        eccodes.codes_set(h, 'dataTime', int(yyyymmddhh[8:10])*100)
+        if accum is not None:
+            eccodes.codes_set(h, 'productDefinitionTemplateNumber', 8)
+        discipline, category, number = WGRIB2_PARAMS[name]
+        eccodes.codes_set(h, 'discipline', discipline)
+        eccodes.codes_set(h, 'parameterCategory', category)
+        eccodes.codes_set(h, 'parameterNumber', number)
+        eccodes.codes_set(h, 'typeOfLevel', typeoflevel)
+        eccodes.codes_set(h, 'level', level)
+        if accum is not None:
+            eccodes.codes_set(h, 'typeOfStatisticalProcessing', 1)
+            eccodes.codes_set(h, 'stepRange', str(accum[0])+'-'+str(accum[1]))
+        else:
+            eccodes.codes_set(h, 'step', fhr)
+        eccodes.codes_set(h, 'packingType', 'grid_simple')
+        eccodes.codes_set_values(h, np.asarray(values, dtype=float).ravel())
+        eccodes.codes_write(h, f)
+    finally:
+        eccodes.codes_release(h)
+
+
+def write_hrrr_grib(path, yyyymmddhh, fhr, grid=FIXTURE_GRID, levels=FIXTURE_LEVELS, seed=None):
+    """Write a synthetic HRRR wrfprs file for cycle yyyymmddhh and forecast hour fhr.
+
+    Fields are smooth and physically plausible (heights increase with decreasing pressure,
+    temperature follows a lapse rate with a sub-freezing top) so that the interpolation and
+    wet-bulb code paths have something meaningful to work on.
+    """
+    rng = np.random.default_rng(seed if seed is not None else int(fhr))
+    ny, nx = grid['Ny'], grid['Nx']
+    jj, ii = np.meshgrid(np.linspace(0, 1, ny), np.linspace(0, 1, nx), indexing='ij')
+    noise = lambda scale: scale*rng.standard_normal((ny, nx))
+
+    orog = 1500.0 + 1200.0*np.sin(np.pi*ii)*np.sin(np.pi*jj) + noise(20.0)
+    t0 = 288.0 - 1.5*fhr/48.0 - 3.0*jj                  # sea-level temperature
+    psfc = 101325.0*(1.0 - orog/44330.8)**5.255
+    tsfc = t0 - 0.0065*orog + noise(0.5)
+    cosz = max(np.cos(np.pi*((int(yyyymmddhh[8:10]) + int(fhr)) % 24 - 19)/12.0), 0.0)
+
+    surface = [
+        ('HGT', 'surface', 0, orog),
+        ('UGRD', 'heightAboveGround', 10, 3.0 + noise(1.0)),
+        ('VGRD', 'heightAboveGround', 10, -2.0 + noise(1.0)),
+        ('TMP', 'heightAboveGround', 2, tsfc + 0.5),
+        ('RH', 'heightAboveGround', 2, np.clip(60.0 + 20.0*jj + noise(3.0), 1.0, 100.0)),
+        ('TMP', 'heightAboveGround', 80, tsfc),                  # not read by processhrrr
+        ('TMP', 'surface', 0, tsfc),
+        ('PRES', 'surface', 0, psfc),
+        ('DSWRF', 'surface', 0, np.full((ny, nx), 800.0*cosz)),
+        ('USWRF', 'surface', 0, np.full((ny, nx), 600.0*cosz)),
+        ('DLWRF', 'surface', 0, 250.0 + noise(5.0)),
+        ('ULWRF', 'surface', 0, 300.0 + noise(5.0)),
+        ('REFC', 'entireAtmosphere', 0, np.clip(noise(10.0), 0.0, None)),   # not read
+    ]
+
+    with open(path, 'wb') as f:
+        for name, typeoflevel, level, values in surface:
+            _write_message(f, name, typeoflevel, level, values, yyyymmddhh, fhr, grid=grid)
+        for press in levels:
+            height = _stdheight(press) + noise(5.0)
+            temp = t0 - 0.0065*np.minimum(height, 11000.0) + noise(0.3)
+            for name, values in [('HGT', height),
+                                 ('TMP', temp),
+                                 ('RH', np.full((ny, nx), 70.0)),            # not read
+                                 ('DPT', temp - 2.0 - 4.0*ii),
+                                 ('VVEL', noise(0.1)),                        # not read
+                                 ('UGRD', 5.0 + height/1000.0 + noise(0.5)),
+                                 ('VGRD', 1.0 + noise(0.5))]:
+                _write_message(f, name, 'isobaricInhPa', press, values, yyyymmddhh, fhr, grid=grid)
+        # Hourly and run-total precipitation, as in the real product
+        precip = np.clip(0.5 + noise(0.5), 0.0, None)
+        _write_message(f, 'APCP', 'surface', 0, precip, yyyymmddhh, fhr, accum=(max(int(fhr)-1, 0), int(fhr)), grid=grid)
+        if int(fhr) > 1:
+            _write_message(f, 'APCP', 'surface', 0, precip*fhr, yyyymmddhh, fhr, accum=(0, int(fhr)), grid=grid)
+
+
+def write_hrrr_idx(gribpath, idxpath=None):
+    """Write the wgrib2 style inventory for a GRIB2 file (defaults to gribpath + '.idx')."""
+    idxpath = idxpath or gribpath+'.idx'
+    lines = []
+    with open(gribpath, 'rb') as f:
+        num = 0
+        while True:
+            h = eccodes.codes_grib_new_from_file(f)
+            if h is None:
+                break
+            try:
+                num += 1
+                offset = int(eccodes.codes_get(h, 'offset'))
+                date = '%08d%02d' % (eccodes.codes_get(h, 'dataDate'), eccodes.codes_get(h, 'dataTime')//100)
+                name = WGRIB2_NAMES[(eccodes.codes_get(h, 'discipline'), eccodes.codes_get(h, 'parameterCategory'),
+                                     eccodes.codes_get(h, 'parameterNumber'))]
+                typeoflevel = eccodes.codes_get(h, 'typeOfLevel')
+                level = eccodes.codes_get(h, 'level')
+                if typeoflevel == 'isobaricInhPa':
+                    levelstr = str(level)+' mb'
+                elif typeoflevel == 'heightAboveGround':
+                    levelstr = str(level)+' m above ground'
+                elif typeoflevel == 'entireAtmosphere':
+                    levelstr = 'entire atmosphere'
+                else:
+                    levelstr = typeoflevel
+                if eccodes.codes_get(h, 'stepType') == 'accum':
+                    start, end = eccodes.codes_get(h, 'startStep'), eccodes.codes_get(h, 'endStep')
+                    fcst = '0-0 day acc fcst' if end == 0 else str(start)+'-'+str(end)+' hour acc fcst'
+                else:
+                    step = eccodes.codes_get(h, 'step')
+                    fcst = 'anl' if step == 0 else str(step)+' hour fcst'
+                lines.append(str(num)+':'+str(offset)+':d='+date+':'+name+':'+levelstr+':'+fcst+':')
+            finally:
+                eccodes.codes_release(h)
+    with open(idxpath, 'w') as f:
+        f.write('\n'.join(lines)+'\n')
+    return idxpath
+
+
+def write_hrrr_cycle(root, yyyymmddhh, fhrs, bucket='noaa-hrrr-bdp-pds', **kwargs):
+    """Write GRIB+idx fixtures for the given forecast hours in the AWS key layout under root/bucket."""
+    yr, mn, dy, hr = yyyymmddhh[0:4], yyyymmddhh[4:6], yyyymmddhh[6:8], yyyymmddhh[8:10]
+    keydir = os.path.join(root, bucket, 'hrrr.'+yr+mn+dy, 'conus')
+    os.makedirs(keydir, exist_ok=True)
+    paths = []
+    for fhr in fhrs:
+        path = os.path.join(keydir, 'hrrr.t'+hr+'z.wrfprsf'+str(fhr).zfill(2)+'.grib2')
+        write_hrrr_grib(path, yyyymmddhh, fhr, **kwargs)
+        write_hrrr_idx(path)
+        paths.append(path)
+    return paths
+
+
+class _S3Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def _resolve(self):
+        path = os.path.normpath(os.path.join(self.server.root, self.path.split('?')[0].lstrip('/')))
+        if not path.startswith(self.server.root) or not os.path.isfile(path):
+            return None
+        return path
+
+    def _not_found(self):
+        body = b'<?xml version="1.0" encoding="UTF-8"?><Error><Code>NoSuchKey</Code><Message>The specified key does not exist.</Message></Error>'
+        self.send_response(404)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        time.sleep(self.server.latency)
+        self.server.count('HEAD', 0)
+        path = self._resolve()
+        if path is None:
+            return self._not_found()
+        self.send_response(200)
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        path = self._resolve()
+        if path is None:
+            self.server.count('GET', 0)
+            return self._not_found()
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes '+str(start)+'-'+str(end)+'/'+str(size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        with open(path, 'rb') as f:
+            f.seek(start)
+            self.wfile.write(f.read(end - start + 1))
+        self.server.count('GET', end - start + 1)
+
+
+class LocalS3Server(ThreadingHTTPServer):
+    """Minimal S3 stand-in serving files below root as s3://<first dir>/<rest of path>.
+
+    Supports GET (with Range) and HEAD, answers 404/NoSuchKey for missing keys and keeps
+    request and byte counters.  Use as a context manager; ``endpoint_url`` goes to boto3.
+    ``latency`` (s) is added to every request to mimic the round trip to AWS.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, root, latency=0.):
+        super().__init__(('127.0.0.1', 0), _S3Handler)
+        self.root = os.path.abspath(root)
+        self.latency = latency
+        self.requests = {'GET': 0, 'HEAD': 0}
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+
+    @property
+    def endpoint_url(self):
+        return 'http://127.0.0.1:'+str(self.server_address[1])
+
+    def count(self, method, nbytes):
+        with self._lock:
+            self.requests[method] += 1
+            self.bytes_sent += nbytes
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+def mesowest_observations(stid, start, end):
+    """Synthetic hourly Mesowest OBSERVATIONS of a station between two datetimes (inclusive).
+
+    The values depend only on the station and the hour, so overlapping windows agree.  Every
+    53rd hour has no snow depth and solar radiation dips slightly below 0 at night, to exercise
+    the nodata and clipping rules.
+    """
+    first = np.datetime64(start.replace(minute=0, second=0), 'h')
+    if first < np.datetime64(start, 's'):
+        first += np.timedelta64(1, 'h')
+    hours = np.arange(first, np.datetime64(end, 'h') + np.timedelta64(1, 'h'), np.timedelta64(1, 'h'))
+    h = hours.astype('int64').astype(float)
+    phase = zlib.crc32(stid.encode()) % 1000
+    noise = np.modf(np.abs(np.sin(h*12.9898 + phase)*43758.5453))[0] - 0.5
+    day = np.sin(2*np.pi*(h % 24 - 9)/24)
+    depth = np.round(500. + 1500.*np.clip(np.sin(2*np.pi*(h/24 - 260)/365), 0, None) + 20*noise, 1)
+    return {
+        'date_time': [t+'Z' for t in np.datetime_as_string(hours, unit='s').tolist()],
+        'air_temp_set_1': np.round(-5. + 8.*day + 2.*noise, 2).tolist(),
+        'relative_humidity_set_1': np.round(60. - 25.*day + 10.*noise, 1).tolist(),
+        'wind_speed_set_1': np.round(3. + 2.*noise + 1.5*(h % 7 == 0), 2).tolist(),
+        'wind_direction_set_1': np.round((250. + 60.*noise + h) % 360, 1).tolist(),
+        'snow_depth_set_1': [None if i % 53 == 0 else v for i, v in zip(h.astype(int), depth.tolist())],
+        'surface_temp_set_1': np.round(-8. + 10.*day + 2.*noise, 2).tolist(),
+        'solar_radiation_set_1': np.round(np.where(day > 0, 800.*day, -2.*np.abs(noise)), 1).tolist(),
+    }
+
+
+class _MesowestHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        query = parse_qs(urlparse(self.path).query)
+        stids = query.get('stid', [''])[0].split(',')
+        self.server.count(stids)
+        if self.server.take_failure():
+            return self._send_json(503, {'SUMMARY': {'RESPONSE_CODE': -1, 'RESPONSE_MESSAGE': 'Service unavailable'}})
+        start = datetime.strptime(query['start'][0], '%Y%m%d%H%M')
+        end = datetime.strptime(query['end'][0], '%Y%m%d%H%M')
+        stations = []
+        for stid in stids:
+            if self.server.stations is not None and stid not in self.server.stations:
+                continue
+            station = {'STID': stid, 'NAME': stid+' Test Station', 'LATITUDE': '40.59', 'LONGITUDE': '-111.64',
+                       'ELEV_DEM': '8805.0'}
+            if self.server.stations is not None:
+                station.update(self.server.stations[stid])
+            station['OBSERVATIONS'] = mesowest_observations(stid, start, end)
+            stations.append(station)
+        if len(stations) == 0:
+            return self._send_json(200, {'SUMMARY': {'RESPONSE_CODE': 2, 'RESPONSE_MESSAGE': 'No stations found'}})
+        self._send_json(200, {'STATION': stations, 'SUMMARY': {'RESPONSE_CODE': 1, 'NUMBER_OF_OBJECTS': len(stations)}})
+
+
+class LocalMesowestServer(ThreadingHTTPServer):
+    """Mesowest timeseries API stand-in.
+
+    Answers /v2/stations/timeseries?stid=A,B&start=...&end=... with mesowest_observations for every
+    station, or only for the stations in ``stations`` (STID -> metadata overriding the defaults)
+    if given.  ``latency`` (s) is added to every request and the first ``failures`` requests get a
+    503.  Keeps the number of requests and of stations asked for.  Use as a context manager and
+    point mesowest_fetch.MESOWEST_API_URL to ``api_url``.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, stations=None, latency=0., failures=0):
+        super().__init__(('127.0.0.1', 0), _MesowestHandler)
+        self.stations = stations
+        self.latency = latency
+        self.failures = failures
+        self.requests = 0
+        self.stations_requested = 0
+        self._lock = threading.Lock()
+
+    @property
+    def api_url(self):
+        return 'http://127.0.0.1:'+str(self.server_address[1])+'/v2/stations/timeseries'
+
+    def count(self, stids):
+        with self._lock:
+            self.requests += 1
+            self.stations_requested += len(stids)
+
+    def take_failure(self):
+        with self._lock:
+            if self.failures > 0:
+                self.failures -= 1
+                return True
+            return False
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Stage timing of the HRRR and Mesowest pipelines
+#
+# The work is marked up with stage('name') blocks (S3 GETs, GRIB decode, derived fields, wet-bulb,
+# SLR, CSV/SMET writes, Mesowest fetch and transform, ...) which add their duration and the bytes
+# they moved to the unit of work running in the thread.  A unit (one forecast hour fetched or decoded
+# by a worker, one station written, one HRRR cycle) is a timed('event', ...) block and writes one JSON
+# line with its stage totals, wall time, process id and memory to TIMING_LOG when that is set.  The
+# memory of a unit is the resident set at its end and how much it grew in the unit, sampled, and how
+# much the unit raised the high-water mark of the process (ru_maxrss only ever grows, on its own it
+# would be the peak of everything the process ran before).
+# Stage blocks may nest, an outer stage includes the time of the inner ones.  Stages outside any unit
+# are kept in the process totals (process_stages).  Either unit can also be run under cProfile or
+# pyinstrument (TIMING_PROFILE) to look inside a stage.
+#
+#   TIMING_LOG=timing.jsonl python hrrr_snowpack_1_4.py ...
+#   python pipeline_timing.py timing.jsonl
+#
+import os
+import sys
+import json
+import time
+import socket
+import functools
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# JSON lines file the units of work are written to, None to not write them
+TIMING_LOG = os.environ.get('TIMING_LOG')
+
+# Profiler run around every unit of work ('cprofile' or 'pyinstrument'), None for none
+TIMING_PROFILE = os.environ.get('TIMING_PROFILE')
+TIMING_PROFILE_DIR = os.environ.get('TIMING_PROFILE_DIR', './profiles/')
+PROFILERS = ('cprofile', 'pyinstrument')
+
+_local = threading.local()
+_lock = threading.Lock()
+
+
+class StageTimer:
+    """Seconds, calls and bytes per stage."""
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, name, seconds=0., nbytes=0, calls=1):
+        with _lock:
+            totals = self.stages.setdefault(name, {'seconds': 0., 'calls': 0, 'bytes': 0})
+            totals['seconds'] += seconds
+            totals['calls'] += calls
+            totals['bytes'] += nbytes
+
+    def merge(self, other):
+        for name, totals in other.stages.items():
+            self.add(name, totals['seconds'], totals['bytes'], totals['calls'])
+
+    def as_dict(self):
+        return {name: dict(totals, seconds=round(totals['seconds'], 6)) for name, totals in self.stages.items()}
+
+
+# Totals of the stages run outside any unit of work, and of the units once they finish
+_process = StageTimer()
+
+
+def _current():
+    timers = getattr(_local, 'timers', None)
+    return timers[-1] if timers else _process
+
+
+@contextmanager
+def stage(name, nbytes=0):
+    """Time a block as stage name of the current unit of work.
+
+    Args:
+        name (str): stage, e.g. 's3_get' or 'wet_bulb'
+        nbytes (int, optional): bytes moved, more can be added with add_bytes. Defaults to 0.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _current().add(name, time.perf_counter() - start, nbytes)
+
+
+def add_bytes(name, nbytes):
+    """Count nbytes moved by stage name, e.g. once a download's size is known."""
+    _current().add(name, nbytes=nbytes, calls=0)
+
+
+def process_stages():
+    """Stage totals of this process, see StageTimer.as_dict."""
+    return _process.as_dict()
+
+
+def max_rss_mb():
+    """High-water mark of the resident memory of this process so far (MB), None without the resource module."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return maxrss/(1024.*1024. if sys.platform == 'darwin' else 1024.)
+
+
+def rss_mb():
+    """Current resident memory of this process (MB), None where it can not be read."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/(1024.*1024.)
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        # Optional dependency, used where there is no /proc (macOS)
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss/(1024.*1024.)
+
+
+def _difference(end, start):
+    return None if end is None or start is None else round(end - start, 1)
+
+
+def emit(record, logfile=None):
+    """Append a record as one JSON line to logfile (default TIMING_LOG), nothing if neither is set.
+
+    The line goes out in a single write to a file opened for appending, so the lines of
+    concurrent worker processes do not interleave.
+    """
+    logfile = logfile or TIMING_LOG
+    if logfile is None:
+        return
+    line = (json.dumps(record, default=str) + '\n').encode()
+    fd = os.open(logfile, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def _profiled(profile, name):
+    if profile is None:
+        yield
+        return
+    if profile not in PROFILERS:
+        raise ValueError('profile must be one of '+str(PROFILERS))
+    os.makedirs(TIMING_PROFILE_DIR, exist_ok=True)
+    path = os.path.join(TIMING_PROFILE_DIR, name+'_'+str(os.getpid()))
+    if profile == 'cprofile':
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path+'.prof')
+    else:
+        # Optional dependency, only needed when asked for
+        from pyinstrument import Profiler
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open(path+'.txt', 'w') as f:
+                f.write(profiler.output_text())
+
+
+@contextmanager
+def timed(event, logfile=None, profile=None, **fields):
+    """Run a block as a unit of work and write its JSON line.
+
+    The line has the event, fields, start time (UTC), wall seconds, host, process id, the stages
+    timed in the block, the memory and, if the block raised, the error.  The memory is rss_mb, the
+    resident set at the end of the block, rss_growth_mb, how much it changed in the block, and
+    maxrss_growth_mb, how much the block raised the high-water mark of the process (0 if it stayed
+    below the peak of earlier work).  Memory freed within the block is only seen in the latter.
+
+    Args:
+        event (str): kind of unit, e.g. 'hrrr_decode'
+        logfile (str, optional): JSON lines file. Defaults to TIMING_LOG.
+        profile (str, optional): profiler to run around the block, one of PROFILERS, written to
+            TIMING_PROFILE_DIR as <event>_<fields>_<pid>.prof (or .txt).  Defaults to TIMING_PROFILE.
+        **fields: identify the unit, e.g. cycle='2024031803', fhr=5
+
+    Yields:
+        dict: the record, more fields can be added to it in the block
+    """
+    record = {'event': event}
+    record.update(fields)
+    timer = StageTimer()
+    timers = getattr(_local, 'timers', None)
+    if timers is None:
+        timers = _local.timers = []
+    timers.append(timer)
+    started = datetime.now(timezone.utc)
+    rss_start, maxrss_start = rss_mb(), max_rss_mb()
+    start = time.perf_counter()
+    name = '_'.join([event] + [str(value) for value in fields.values()])
+    try:
+        with _profiled(profile or TIMING_PROFILE, name):
+            yield record
+    except Exception as e:
+        record['error'] = type(e).__name__+': '+str(e)
+        raise
+    finally:
+        timers.pop()
+        # The unit's stages also count for the enclosing one
+        (timers[-1] if timers else _process).merge(timer)
+        seconds = time.perf_counter() - start
+        rss_end = rss_mb()
+        record.update({'start': started.isoformat(timespec='milliseconds'), 'seconds': round(seconds, 6),
+                       'host': socket.gethostname(), 'pid': os.getpid(),
+                       'rss_mb': None if rss_end is None else round(rss_end, 1),
+                       'rss_growth_mb': _difference(rss_end, rss_start),
+                       'maxrss_growth_mb': _difference(max_rss_mb(), maxrss_start), 'stages': timer.as_dict()})
+        emit(record, logfile)
+
+
+def timed_unit(event, fields):
+    """Decorator running every call of a function as a timed unit of work.
+
+    Args:
+        event (str): kind of unit, see timed
+        fields (callable): called with the arguments of the function, returns the fields of the unit
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(event, **fields(*args, **kwargs)):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def read_timing_log(logfile):
+    """Records of a JSON lines file written by timed."""
+    with open(logfile) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize_timing_log(logfile):
+    """Totals per event and stage of a JSON lines file.
+
+    Returns:
+        dict: event -> {'units', 'seconds', 'max_rss_mb', 'max_rss_growth_mb', 'max_maxrss_growth_mb',
+            'stages': stage -> {'seconds', 'calls', 'bytes'}}, the max_ over the units of the memory
+            fields of timed
+    """
+    memory = {'max_rss_mb': 'rss_mb', 'max_rss_growth_mb': 'rss_growth_mb', 'max_maxrss_growth_mb': 'maxrss_growth_mb'}
+    summary = {}
+    for record in read_timing_log(logfile):
+        event = summary.setdefault(record['event'], dict({'units': 0, 'seconds': 0., 'stages': {}},
+                                                         **dict.fromkeys(memory)))
+        event['units'] += 1
+        event['seconds'] += record['seconds']
+        for key, field in memory.items():
+            if record.get(field) is not None:
+                event[key] = record[field] if event[key] is None else max(event[key], record[field])
+        for name, totals in record['stages'].items():
+            stagetotals = event['stages'].setdefault(name, {'seconds': 0., 'calls': 0, 'bytes': 0})
+            for key in stagetotals:
+                stagetotals[key] += totals[key]
+    return summary
+
+
+# Where the time of a run went:  python pipeline_timing.py timing.jsonl
+if __name__ == "__main__":
+
+    for event, totals in summarize_timing_log(sys.argv[1]).items():
+        print(event+': '+str(totals['units'])+' units, '+str(round(totals['seconds'], 2))+' s, RSS at the end of a unit '
+              + 'up to '+str(totals['max_rss_mb'])+' MB, grown in a unit by up to '+str(totals['max_rss_growth_mb'])
+              + ' MB, process peak raised by a unit by up to '+str(totals['max_maxrss_growth_mb'])+' MB')
+        for name, stagetotals in sorted(totals['stages'].items(), key=lambda item: -item[1]['seconds']):
+            print('    '+name.ljust(20)+str(round(stagetotals['seconds'], 3)).rjust(10)+' s'
+                  + str(stagetotals['calls']).rjust(8)+' calls'+str(round(stagetotals['bytes']/1e6, 2)).rjust(10)+' MB')
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SMET file reading and writing
+
+SMET 1.1 ASCII files are a short key = value header followed by one
+space-separated row per timestamp.  The writer formats whole columns in one
+string operation per block of rows instead of one f-string per value, and the
+reader parses the data block with pandas.  The header and the last timestamp
+are read without touching the rest of the file (the header from the start,
+the last row by seeking back from the end), so their cost does not grow with
+the length of the season.
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from pipeline_timing import stage, add_bytes
+
+# Rows formatted per string operation, bounds the memory of the writer
+SMET_WRITE_BLOCK = 8760
+
+# Header keys are padded to this width, as in the files written so far
+SMET_KEY_WIDTH = 16
+
+
+def format_smet_header(header):
+    """
+    SMET header lines from a dict, including the SMET and [HEADER] lines and the [DATA] line
+
+    Parameters
+    ----------
+    header : dict
+        key -> value in file order, 'fields' may be a list of field names
+
+    Returns
+    -------
+    text : string
+
+    """
+    lines = ['SMET 1.1 ASCII\n', '[HEADER]\n']
+    for key, value in header.items():
+        if key == 'fields' and not isinstance(value, str):
+            value = ' '.join(value)
+        lines.append(f'{key:<{SMET_KEY_WIDTH}} = {value}\n')
+    lines.append('[DATA]\n')
+    return ''.join(lines)
+
+
+def format_smet_rows(timestamps, columns, decimals=2):
+    """
+    SMET data rows, one string operation for the whole block
+
+    Parameters
+    ----------
+    timestamps : array
+        datetime64 or ISO strings (YYYY-MM-DDTHH:MM:SS)
+    columns : list of array
+        values of the fields after the timestamp, in file order
+    decimals : int, optional
+        digits after the decimal point
+
+    Returns
+    -------
+    text : string
+
+    """
+    timestamps = np.asarray(timestamps)
+    if np.issubdtype(timestamps.dtype, np.datetime64):
+        timestamps = np.datetime_as_string(timestamps, unit='s')
+    row = '%s' + (' %.' + str(int(decimals)) + 'f')*len(columns) + '\n'
+    values = [np.asarray(values, dtype=float).tolist() for values in columns]
+    return ''.join(map(row.__mod__, zip(timestamps.tolist(), *values)))
+
+
+def write_smet_rows(fileID, timestamps, columns, decimals=2, block=SMET_WRITE_BLOCK):
+    """
+    Write SMET data rows to an open file, in blocks of rows
+
+    Parameters
+    ----------
+    fileID : file
+        text file open for writing or appending
+    timestamps : array
+        datetime64 or ISO strings
+    columns : list of array
+        values of the fields after the timestamp, in file order
+    decimals : int, optional
+        digits after the decimal point
+    block : int, optional
+        rows formatted at a time
+
+    Returns
+    -------
+    None.
+
+    """
+    for start in range(0, len(timestamps), block):
+        with stage('smet_write'):
+            text = format_smet_rows(timestamps[start:start+block], [values[start:start+block] for values in columns],
+                                    decimals)
+            fileID.write(text)
+        add_bytes('smet_write', len(text))
+
+
+def write_smet(filename, header, timestamps, columns, decimals=2):
+    """
+    Write a SMET file
+
+    Parameters
+    ----------
+    filename : string
+        file to (over)write
+    header : dict
+        key -> value in file order, see format_smet_header. 'fields' defaults to
+        timestamp and the keys of columns.
+    timestamps : array
+        datetime64 or ISO strings
+    columns : dict
+        field -> values, in file order
+    decimals : int, optional
+        digits after the decimal point
+
+    Returns
+    -------
+    None.
+
+    """
+    if 'fields' not in header:
+        header = dict(header, fields=['timestamp'] + list(columns))
+    with open(filename, 'w') as fileID:
+        fileID.write(format_smet_header(header))
+        write_smet_rows(fileID, timestamps, list(columns.values()), decimals)
+
+
+def read_smet_header(filename):
+    """
+    Header of a SMET file, read up to the [DATA] line only
+
+    Parameters
+    ----------
+    filename : string
+        SMET file
+
+    Returns
+    -------
+    header : dict
+        key -> value as strings, except 'fields' which is a list
+    data_offset : int
+        byte offset of the first data row
+
+    """
+    header = {}
+    with open(filename, 'rb') as f:
+        for line in f:
+            line = line.decode().strip()
+            if line.startswith('[DATA]'):
+                if 'fields' in header:
+                    header['fields'] = header['fields'].split()
+                return header, f.tell()
+            if '=' in line:
+                key, value = line.split('=', 1)
+                header[key.strip()] = value.strip()
+    raise ValueError(filename + ' has no [DATA] section')
+
+
+def read_smet(filename, as_frame=True, nodata_to_nan=True):
+    """
+    Read a SMET file
+
+    Parameters
+    ----------
+    filename : string
+        SMET file
+    as_frame : boolean, optional
+        return a DataFrame, otherwise the timestamps and a dict of arrays
+    nodata_to_nan : boolean, optional
+        replace the nodata value of the header with NaN
+
+    Returns
+    -------
+    header : dict
+        see read_smet_header
+    data : DataFrame
+        'timestamp' as datetime64 and one float column per field, if as_frame
+    timestamps, columns : array of datetime64[s], dict
+        otherwise
+
+    """
+    header, data_offset = read_smet_header(filename)
+    fields = header['fields']
+    with open(filename, 'rb') as f:
+        f.seek(data_offset)
+        df = pd.read_csv(f, sep=' ', header=None, names=fields, dtype={field: float for field in fields[1:]})
+    timestamps = df[fields[0]].to_numpy(dtype='datetime64[s]')
+    if nodata_to_nan and 'nodata' in header:
+        df[fields[1:]] = df[fields[1:]].mask(df[fields[1:]] == float(header['nodata']))
+    if as_frame:
+        df[fields[0]] = timestamps
+        return header, df
+    return header, timestamps, {field: df[field].to_numpy() for field in fields[1:]}
+
+
+def read_last_line(filename, end=None, blocksize=4096):
+    """
+    Last non-empty line of a text file, read backwards from the end in blocks
+    so the cost does not grow with the length of the file
+
+    Parameters
+    ----------
+    filename : string
+        file to read
+    end : int, optional
+        byte offset to treat as the end of the file. Default is the file size.
+    blocksize : int, optional
+        bytes read per step
+
+    Returns
+    -------
+    line : string
+        last line without the newline, '' for an empty file
+
+    """
+    with open(filename, 'rb') as f:
+        pos = f.seek(0, os.SEEK_END) if end is None else end
+        data = b''
+        while pos > 0:
+            step = min(blocksize, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+            if data.rstrip(b'\n').count(b'\n') > 0:
+                break
+    return data.rstrip(b'\n').rsplit(b'\n', 1)[-1].decode()
+
+
+def read_last_timestamp(filename, end=None):
+    """
+    Timestamp of the last row of a SMET file (or of the last row before byte offset end)
+
+    Returns
+    -------
+    timestamp : datetime64[s] or None
+        None if the file has no data rows
+
+    """
+    line = read_last_line(filename, end)
+    try:
+        return np.datetime64(line[0:19], 's')
+    except ValueError:
+        return None
+
+
+def find_row_offset(filename, timestamp, end=None, blocksize=4096):
+    """
+    Byte offset of the first data row at or after timestamp, searched back from the end of the file
+
+    Parameters
+    ----------
+    filename : string
+        SMET file
+    timestamp : datetime64
+        time of the row
+    end : int, optional
+        byte offset to treat as the end of the file. Default is the file size.
+    blocksize : int, optional
+        bytes read per step
+
+    Returns
+    -------
+    offset : int
+        offset of the row, end if all rows are before timestamp
+
+    """
+    data_offset = read_smet_header(filename)[1]
+    target = str(np.datetime64(timestamp, 's')).encode()
+    with open(filename, 'rb') as f:
+        end = f.seek(0, os.SEEK_END) if end is None else end
+        pos = end
+        # Back until the first complete row of the data read is before timestamp
+        while pos > data_offset:
+            pos = max(data_offset, pos - blocksize)
+            f.seek(pos)
+            data = f.read(end - pos)
+            first = 0 if pos == data_offset else data.find(b'\n') + 1
+            if first > 0 and data[first:first+19] < target:
+                break
+        if pos >= end:
+            return end
+        offset = pos + first
+        for line in data[first:].split(b'\n'):
+            if line[0:19] >= target:
+                return offset
+            offset += len(line) + 1
+    return end
+
+
+def read_smet_obs_end(smetfile):
+    """
+    Where the observations of a SMET file end, from the sidecar file written by write_smet_obs_end
+
+    Forecast rows are appended after the observations, so the last line of the
+    SMET file is not necessarily the last observation.  The sidecar records the
+    byte offset after the last observation row and its timestamp.
+
+    Parameters
+    ----------
+    smetfile : string
+        SMET file
+
+    Returns
+    -------
+    obs_end : tuple or None
+        (offset, last_obs_time) with last_obs_time as YYYY-MM-DDTHH:MM:SS, None if
+        the sidecar is missing or does not match the file
+
+    """
+    sidecar = smetfile + '.obsend'
+    if not os.path.exists(smetfile) or not os.path.exists(sidecar):
+        return None
+    values = {}
+    with open(sidecar) as f:
+        for line in f:
+            if '=' in line:
+                key, value = line.split('=', 1)
+                values[key.strip()] = value.strip()
+    try:
+        offset = int(values['obs_end_offset'])
+        last_obs_time = values['last_obs_time']
+    except (KeyError, ValueError):
+        return None
+    if offset > os.path.getsize(smetfile) or read_last_line(smetfile, offset)[0:19] != last_obs_time:
+        return None
+    return offset, last_obs_time
+
+
+def write_smet_obs_end(smetfile):
+    """
+    Record the current end of a SMET file as the end of its observations, see read_smet_obs_end
+    """
+    offset = os.path.getsize(smetfile)
+    with open(smetfile + '.obsend', 'w') as file:
+        file.write(f'obs_end_offset = {offset}\n')
+        file.write(f'last_obs_time = {read_last_line(smetfile, offset)[0:19]}\n')
+
+
+def benchmark_smet_io(hours=(720, 5088, 43800, 175200), nfields=9, seed=0):
+    """
+    Seconds taken by the row-by-row f-string writer, write_smet, read_smet, the header and
+    the last timestamp for hourly files of each length
+
+    The default lengths are a month, a season (Oct 5 to Jun 1), 5 and 20 years.
+
+    Returns
+    -------
+    results : list of dict
+
+    """
+    rng = np.random.default_rng(seed)
+    tmpdir = tempfile.mkdtemp()
+    filename = os.path.join(tmpdir, 'TEST.smet')
+    header = {'station_id': 'TEST', 'nodata': -999, 'tz': 1}
+    results = []
+    try:
+        for n in hours:
+            timestamps = np.datetime64('2024-10-05T00:00:00') + np.arange(n)*np.timedelta64(1, 'h')
+            columns = {'F'+str(i): rng.normal(0., 300., n) for i in range(nfields)}
+            result = {'hours': n}
+
+            start = time.time()
+            iso_dates = np.datetime_as_string(timestamps, unit='s')
+            with open(filename, 'w') as fileID:
+                fileID.write(format_smet_header(dict(header, fields=['timestamp'] + list(columns))))
+                for i in range(n):
+                    fileID.write(iso_dates[i] + ''.join(f' {values[i]:.2f}' for values in columns.values()) + '\n')
+            result['write_rows'] = time.time() - start
+
+            start = time.time()
+            write_smet(filename, header, timestamps, columns)
+            result['write'] = time.time() - start
+            start = time.time()
+            read_smet(filename)
+            result['read'] = time.time() - start
+            start = time.time()
+            read_smet_header(filename)
+            read_last_timestamp(filename)
+            result['header_last'] = time.time() - start
+            results.append(result)
+    finally:
+        shutil.rmtree(tmpdir)
+    return results
+
+
+# Throughput against the length of the file:  python smet_io.py [hours ...]
+if __name__ == "__main__":
+
+    hours = [int(arg) for arg in sys.argv[1:]] or (720, 5088, 43800, 175200)
+    print(f'{"hours":>8} {"rows (s)":>9} {"write (s)":>9} {"read (s)":>9} {"hdr+last (ms)":>13} {"write rows/s":>12}')
+    for result in benchmark_smet_io(hours):
+        print(f'{result["hours"]:>8} {result["write_rows"]:>9.3f} {result["write"]:>9.3f} {result["read"]:>9.3f} '
+              f'{1000*result["header_last"]:>13.3f} {result["hours"]/result["write"]:>12.0f}')
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Station corrections of SMET columns
+
+Known problems of a station's record (a sensor reading snow before the season,
+a jump after maintenance, ...) are listed in STATION_CORRECTIONS by field and
+time range, not by array position, so they hit the same observations whatever
+window is requested.  Each row is applied to the whole column at once as a
+masked array operation:
+
+    field     SMET field to correct
+    action    'zero'     set every value in the range to value (default 0)
+              'hold'     repeat the last value before the range
+              'offset'   add value to the values in the range
+              'clip'     limit the values in the range to [min, max]
+              'despike'  replace single values that jump by more than value
+                         and come back by the mean of their neighbours
+    start     first timestamp of the range (included), None for no limit
+    end       last timestamp of the range (included), None for no limit
+    value     see action
+    min, max  see clip
+
+The rows of '*' apply to every station and come first.  Values equal to
+nodata are left alone by offset, clip and despike.
+"""
+import sys
+import time
+import numpy as np
+from mesowest_transform import NODATA
+
+# Corrections per station ID, in the order they are applied
+STATION_CORRECTIONS = {
+    '*': [
+        # Negative solar radiation at night
+        {'field': 'ISWR', 'action': 'clip', 'min': 0},
+    ],
+    'ATH20': [
+        # Snow depth sensor reading before the first snow of 2024-25
+        {'field': 'HS', 'action': 'zero', 'start': '2024-10-05T00:00:00', 'end': '2024-10-23T17:00:00'},
+        {'field': 'HS', 'action': 'hold', 'start': '2025-03-28T20:00:00', 'end': '2025-03-28T20:00:00'},
+        {'field': 'HS', 'action': 'offset', 'value': -2, 'start': '2025-03-28T21:00:00', 'end': '2025-03-31T13:00:00'},
+        {'field': 'HS', 'action': 'hold', 'start': '2025-04-03T03:00:00', 'end': '2025-04-03T03:00:00'},
+    ],
+}
+
+CORRECTION_ACTIONS = ('zero', 'hold', 'offset', 'clip', 'despike')
+
+
+def station_corrections(stid, table=STATION_CORRECTIONS):
+    """
+    Corrections of a station, the ones for every station ('*') first
+    """
+    return table.get('*', []) + table.get(stid, [])
+
+
+def correction_mask(timestamps, correction):
+    """
+    Timestamps in the range of a correction, as a boolean array
+    """
+    mask = np.ones(len(timestamps), dtype=bool)
+    if correction.get('start') is not None:
+        mask &= timestamps >= np.datetime64(correction['start'], 's')
+    if correction.get('end') is not None:
+        mask &= timestamps <= np.datetime64(correction['end'], 's')
+    return mask
+
+
+def apply_correction(values, mask, correction, nodata=NODATA):
+    """
+    One correction applied to a float array in place
+
+    Returns
+    -------
+    changed : int
+        number of values changed
+
+    """
+    action = correction['action']
+    before = values.copy()
+    valid = mask & (values != nodata) & ~np.isnan(values)
+    if action == 'zero':
+        values[mask] = correction.get('value', 0.)
+    elif action == 'hold':
+        # Index of the last value outside the range at or before each position
+        last = np.maximum.accumulate(np.where(mask, -1, np.arange(len(values))))
+        held = mask & (last >= 0)
+        values[held] = values[last[held]]
+    elif action == 'offset':
+        values[valid] += correction['value']
+    elif action == 'clip':
+        values[valid] = np.clip(values[valid], correction.get('min'), correction.get('max'))
+    elif action == 'despike':
+        centre = values[1:-1]
+        up = centre - values[:-2]
+        down = centre - values[2:]
+        spike = valid[1:-1] & valid[:-2] & valid[2:] & (np.abs(up) > correction['value']) \
+            & (np.abs(down) > correction['value']) & (np.sign(up) == np.sign(down))
+        centre[spike] = 0.5*(values[:-2][spike] + values[2:][spike])
+    else:
+        raise ValueError('Unknown correction ' + str(action) + ', expected one of ' + str(CORRECTION_ACTIONS))
+    return int(np.count_nonzero((values != before) & ~(np.isnan(values) & np.isnan(before))))
+
+
+def apply_corrections(timestamps, columns, corrections, nodata=NODATA, verbose=True):
+    """
+    Corrections applied to SMET columns
+
+    Parameters
+    ----------
+    timestamps : array
+        datetime64 (or ISO strings) of the rows
+    columns : dict
+        field -> values, not modified
+    corrections : list of dict
+        rows of STATION_CORRECTIONS, see station_corrections
+    nodata : float, optional
+        value of missing data
+    verbose : boolean, optional
+        print the number of values each correction changed
+
+    Returns
+    -------
+    columns : dict
+        field -> float64 array, a copy of the corrected fields and the other
+        fields as given
+
+    """
+    timestamps = np.asarray(timestamps, dtype='datetime64[s]')
+    columns = dict(columns)
+    copied = set()
+    for correction in corrections:
+        field = correction['field']
+        if field not in columns:
+            continue
+        if field not in copied:
+            columns[field] = np.array(columns[field], dtype=float)
+            copied.add(field)
+        changed = apply_correction(columns[field], correction_mask(timestamps, correction), correction, nodata)
+        if verbose and changed > 0:
+            print('Corrected ' + str(changed) + ' ' + field + ' values (' + correction['action'] + ')')
+    return columns
+
+
+# Time the corrections on a synthetic hourly record:  python station_corrections.py [years]
+if __name__ == "__main__":
+
+    years = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    n = int(years*365*24)
+    rng = np.random.default_rng(0)
+    timestamps = np.datetime64('2024-10-05T00:00:00') + np.arange(n)*np.timedelta64(1, 'h')
+    columns = {'HS': rng.normal(1., 0.5, n), 'ISWR': rng.normal(100., 200., n)}
+    corrections = station_corrections('ATH20') + [{'field': 'HS', 'action': 'despike', 'value': 0.5}]
+
+    start = time.time()
+    apply_corrections(timestamps, columns, corrections, verbose=False)
+    print(str(n)+' hourly values, '+str(len(corrections))+' corrections applied in '
+          + str(round(time.time() - start, 4))+' s')
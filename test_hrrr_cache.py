@@ -0,0 +1,71 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+from hrrr_cache import HRRRCache
+
+
+class TestHRRRCache(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.root, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def make_file(self, name, nbytes):
+        path = os.path.join(self.root, name)
+        with open(path, 'wb') as f:
+            f.write(b'x'*nbytes)
+        return path
+
+    def test_key_depends_on_every_component(self):
+        key = HRRRCache.key('2024031818', 3, 'wrfprs', ['a', 'b'])
+        self.assertEqual(key, HRRRCache.key('2024031818', '3', 'wrfprs', ['a', 'b']))
+        self.assertNotEqual(key, HRRRCache.key('2024031812', 3, 'wrfprs', ['a', 'b']))
+        self.assertNotEqual(key, HRRRCache.key('2024031818', 4, 'wrfprs', ['a', 'b']))
+        self.assertNotEqual(key, HRRRCache.key('2024031818', 3, 'wrfsfc', ['a', 'b']))
+        self.assertNotEqual(key, HRRRCache.key('2024031818', 3, 'wrfprs', 'all'))
+
+    def test_put_get_hit_miss(self):
+        cache = HRRRCache(self.cachedir, max_bytes=1000)
+        key = HRRRCache.key('2024031818', 3)
+        self.assertIsNone(cache.get(key))
+        src = self.make_file('a.grib2', 100)
+        path = cache.put(key, src)
+        self.assertFalse(os.path.exists(src))
+        self.assertEqual(cache.get(key), path)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(os.listdir(self.cachedir), [os.path.basename(path)])
+        self.assertIn('1 hits, 1 misses', cache.report())
+
+    def test_lru_eviction(self):
+        cache = HRRRCache(self.cachedir, max_bytes=250)
+        keys = [HRRRCache.key('2024031818', fhr) for fhr in range(3)]
+        with patch('hrrr_cache.EVICT_MIN_AGE', 0.0):
+            for i, key in enumerate(keys[:2]):
+                cache.put(key, self.make_file(str(i), 100))
+                os.utime(cache.path(key), (time.time() - 100 + i, time.time() - 100 + i))
+            # Reading the oldest entry makes the other one least recently used
+            cache.get(keys[0])
+            cache.put(keys[2], self.make_file('2', 100))
+        self.assertTrue(cache.contains(keys[0]))
+        self.assertFalse(cache.contains(keys[1]))
+        self.assertTrue(cache.contains(keys[2]))
+        self.assertEqual(cache.evictions, 1)
+        self.assertLessEqual(cache.usage(), 250)
+        self.assertIn('1 evictions, 2 files', cache.report())
+        self.assertNotIn('evictions', HRRRCache(self.cachedir).report(evictions=False))
+
+    def test_recently_used_files_are_kept(self):
+        cache = HRRRCache(self.cachedir, max_bytes=150)
+        cache.put(HRRRCache.key('2024031818', 0), self.make_file('0', 100))
+        cache.put(HRRRCache.key('2024031818', 1), self.make_file('1', 100))
+        self.assertEqual(cache.evictions, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
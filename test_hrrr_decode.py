@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+import numpy as np
+import hrrr_snowpack_1_4 as hrrr
+from hrrr_decode import HRRR_FIELDS, HRRR_PRESS_FIELDS, decode_hrrr, open_hrrr_cfgrib, compare_decode_timing
+from offline_fixtures import LocalS3Server, write_hrrr_cycle
+
+LEVELS = (1000, 900, 800, 700, 600, 500, 400, 300)
+
+
+class TestDecodeHRRR(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.root = tempfile.mkdtemp()
+        cls.paths = write_hrrr_cycle(cls.root, '2024031818', [0, 3], levels=LEVELS)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.root)
+
+    def test_matches_cfgrib_path(self):
+        for path, fhr in zip(self.paths, [0, 3]):
+            decoded = decode_hrrr(path, fhr)
+            reference = open_hrrr_cfgrib(path, fhr)
+            names = [name for name, shortnames, typeoflevel in HRRR_FIELDS]
+            names += [name for name, shortname in HRRR_PRESS_FIELDS]
+            for name in names + ['hourlyprecip', 'latitude', 'longitude', 'isobaricInhPa']:
+                np.testing.assert_array_equal(decoded[name], reference[name].values, err_msg=name)
+
+    def test_sample_gridpoints(self):
+        y, x = np.array([3, 17, 30]), np.array([5, 40, 2])
+        full = decode_hrrr(self.paths[1], 3)
+        grids = []
+        sampled = decode_hrrr(self.paths[1], 3, gridpoints=lambda grid: grids.append(grid) or (y, x))
+        self.assertEqual(grids, [full['grid']])
+        np.testing.assert_array_equal(sampled['gridpoints'][0], y)
+        for name in ['orog', 't2m', 'hourlyprecip', 'latitude', 'longitude']:
+            np.testing.assert_array_equal(sampled[name], full[name][y, x], err_msg=name)
+        for name, shortname in HRRR_PRESS_FIELDS:
+            np.testing.assert_array_equal(sampled[name], full[name][:, y, x], err_msg=name)
+        # Sampled latitudes/longitudes are reused for the next file on the same grid
+        np.testing.assert_array_equal(decode_hrrr(self.paths[0], 0, gridpoints=lambda grid: (y, x))['latitude'],
+                                      full['latitude'][y, x])
+
+    def test_missing_field(self):
+        with self.assertRaises(KeyError):
+            decode_hrrr(self.paths[1], 7)
+
+    def test_compare_decode_timing(self):
+        results = compare_decode_timing(self.paths[1], 3, repeat=1)
+        self.assertEqual(set(results['cfgrib']), {'open', 'merge', 'load', 'total'})
+        self.assertEqual(set(results['eccodes']), {'decode', 'total'})
+
+    def test_processhrrr_from_local_s3(self):
+        scratchdir = os.path.join(self.root, 'scratch')+'/'
+        os.makedirs(scratchdir, exist_ok=True)
+        with LocalS3Server(self.root) as server, patch('hrrr_fetch.HRRR_S3_ENDPOINT_URL', server.endpoint_url):
+            output = hrrr.processhrrr('2024', '03', '18', '18', 3, 40.59, -111.64, 2668.0, 300, scratchdir, cachedir=None)
+
+        reference = open_hrrr_cfgrib(self.paths[1], 3)
+        # Great-circle nearest grid point
+        lat, lon = np.radians(reference.latitude.values), np.radians(reference.longitude.values - 360.)
+        distance = np.sin((lat - np.radians(40.59))/2)**2 + \
+            np.cos(lat)*np.cos(np.radians(40.59))*np.sin((lon - np.radians(-111.64))/2)**2
+        y, x = np.unravel_index(np.argmin(distance), distance.shape)
+        self.assertEqual(output[0:2], ('2024031818', 3))
+        self.assertEqual(output[2], np.round(reference.latitude.values[y, x], 3))
+        self.assertEqual(output[4], np.round(reference.orog.values[y, x], 3))
+        self.assertEqual(output[7], np.round(reference.t2m.values[y, x], 3))
+        self.assertEqual(output[15], np.round(reference.hourlyprecip.values[y, x], 3))
+        self.assertGreater(output[16], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import os
+import shutil
+import tempfile
+import unittest
+import filecmp
+import eccodes
+from botocore.exceptions import ClientError
+from offline_fixtures import LocalS3Server, write_hrrr_cycle
+from hrrr_fetch import (HRRR_BUCKET, hrrr_object_key, make_s3_client, parse_idx, hrrr_idx_patterns,
+                        idx_byte_ranges, fetch_hrrr_subset, fetch_hrrr_file, is_not_found, worker_s3_client)
+
+LEVELS = (1000, 900, 800, 700, 600, 500, 400, 300)
+
+
+def grib_inventory(path):
+    inventory = []
+    with open(path, 'rb') as f:
+        while True:
+            h = eccodes.codes_grib_new_from_file(f)
+            if h is None:
+                break
+            inventory.append((eccodes.codes_get(h, 'shortName'), eccodes.codes_get(h, 'typeOfLevel'),
+                              eccodes.codes_get(h, 'stepRange')))
+            eccodes.codes_release(h)
+    return inventory
+
+
+class TestIdxParsing(unittest.TestCase):
+
+    IDX = ('1:0:d=2024031818:HGT:surface:3 hour fcst:\n'
+           '2:100:d=2024031818:TMP:surface:3 hour fcst:\n'
+           '3:250:d=2024031818:REFC:entire atmosphere:3 hour fcst:\n'
+           '4:400:d=2024031818:TMP:500 mb:3 hour fcst:\n'
+           '5:500:d=2024031818:APCP:surface:0-3 hour acc fcst:\n'
+           '6:600:d=2024031818:APCP:surface:2-3 hour acc fcst:\n')
+
+    def test_parse_idx(self):
+        entries = parse_idx(self.IDX)
+        self.assertEqual(entries[0], (0, 99, ':HGT:surface:3 hour fcst:'))
+        self.assertEqual(entries[-1], (600, None, ':APCP:surface:2-3 hour acc fcst:'))
+
+    def test_byte_ranges_coalesce_and_select_step_range(self):
+        ranges = idx_byte_ranges(parse_idx(self.IDX), hrrr_idx_patterns(3))
+        self.assertEqual(ranges, [(0, 249), (400, 499), (600, None)])
+
+    def test_analysis_hour_patterns(self):
+        idx = ('1:0:d=2024031818:TMP:surface:anl:\n'
+               '2:100:d=2024031818:APCP:surface:0-0 day acc fcst:\n')
+        self.assertEqual(idx_byte_ranges(parse_idx(idx), hrrr_idx_patterns(0)), [(0, None)])
+
+
+class TestFetchSubset(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.root = tempfile.mkdtemp()
+        write_hrrr_cycle(cls.root, '2024031818', [0, 3], levels=LEVELS)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.root)
+
+    def test_fetch_subset_from_local_s3(self):
+        localfile = os.path.join(self.root, 'subset.grib2')
+        key = hrrr_object_key('2024', '03', '18', '18', 3)
+        with LocalS3Server(self.root) as server:
+            s3 = make_s3_client(server.endpoint_url)
+            nbytes = fetch_hrrr_subset(s3, HRRR_BUCKET, key, localfile, 3)
+            self.assertEqual(server.requests['HEAD'], 0)
+
+        self.assertEqual(nbytes, os.path.getsize(localfile))
+        self.assertLess(nbytes, os.path.getsize(os.path.join(self.root, HRRR_BUCKET, key)))
+        inventory = grib_inventory(localfile)
+        # 11 single level fields, 5 isobaric fields on every level and the hourly precipitation
+        self.assertEqual(len(inventory), 11 + 5*len(LEVELS) + 1)
+        self.assertIn(('tp', 'surface', '2-3'), inventory)
+        self.assertNotIn(('tp', 'surface', '0-3'), inventory)
+        self.assertNotIn(('w', 'isobaricInhPa', '3'), inventory)
+
+    def test_fetch_subset_analysis_hour(self):
+        localfile = os.path.join(self.root, 'subset00.grib2')
+        key = hrrr_object_key('2024', '03', '18', '18', 0)
+        with LocalS3Server(self.root) as server:
+            fetch_hrrr_subset(make_s3_client(server.endpoint_url), HRRR_BUCKET, key, localfile, 0)
+        self.assertIn(('tp', 'surface', '0'), grib_inventory(localfile))
+
+    def test_missing_forecast_hour(self):
+        key = hrrr_object_key('2024', '03', '18', '18', 5)
+        with LocalS3Server(self.root) as server:
+            with self.assertRaises(Exception):
+                fetch_hrrr_subset(make_s3_client(server.endpoint_url), HRRR_BUCKET, key,
+                                  os.path.join(self.root, 'missing.grib2'), 5)
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'missing.grib2')))
+
+    def test_fetch_whole_file_without_head(self):
+        key = hrrr_object_key('2024', '03', '18', '18', 3)
+        serverfile = os.path.join(self.root, HRRR_BUCKET, key)
+        for chunksize in (10000, 1 << 30):
+            localfile = os.path.join(self.root, 'whole'+str(chunksize)+'.grib2')
+            with LocalS3Server(self.root) as server:
+                nbytes = fetch_hrrr_file(make_s3_client(server.endpoint_url), HRRR_BUCKET, key, localfile, chunksize,
+                                         max_concurrency=4)
+                self.assertEqual(server.requests['HEAD'], 0)
+                self.assertEqual(server.requests['GET'], -(-os.path.getsize(serverfile)//chunksize))
+            self.assertEqual(nbytes, os.path.getsize(serverfile))
+            self.assertTrue(filecmp.cmp(localfile, serverfile, shallow=False))
+
+    def test_missing_whole_file(self):
+        key = hrrr_object_key('2024', '03', '18', '18', 5)
+        with LocalS3Server(self.root) as server:
+            with self.assertRaises(ClientError) as context:
+                fetch_hrrr_file(make_s3_client(server.endpoint_url), HRRR_BUCKET, key,
+                                os.path.join(self.root, 'missing.grib2'))
+            self.assertEqual(server.requests, {'GET': 1, 'HEAD': 0})
+        self.assertTrue(is_not_found(context.exception))
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'missing.grib2')))
+
+    def test_worker_s3_client_is_reused(self):
+        self.assertIs(worker_s3_client(), worker_s3_client())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+import hrrr_grid
+from hrrr_grid import HRRR_GRID, latlon_to_gridyx, gridyx_to_latlon, nearest_gridpoint, cached_gridpoint
+from hrrr_decode import decode_hrrr
+from offline_fixtures import FIXTURE_GRID, write_hrrr_grib
+
+
+class TestLambertGrid(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.root = tempfile.mkdtemp()
+        path = os.path.join(cls.root, 'grid.grib2')
+        write_hrrr_grib(path, '2024031818', 0, levels=(1000,))
+        hrrrdata = decode_hrrr(path, 0)
+        cls.grid, cls.lats, cls.lons = hrrrdata['grid'], hrrrdata['latitude'], hrrrdata['longitude']
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.root)
+
+    def test_matches_eccodes_grid(self):
+        fy, fx = latlon_to_gridyx(self.lats, self.lons, self.grid)
+        y, x = np.indices(self.lats.shape)
+        np.testing.assert_allclose(fy, y, atol=1e-6)
+        np.testing.assert_allclose(fx, x, atol=1e-6)
+        lat, lon = gridyx_to_latlon(y, x, self.grid)
+        np.testing.assert_allclose(lat, self.lats, atol=1e-9)
+        np.testing.assert_allclose(lon, self.lons, atol=1e-9)
+
+    def test_hrrr_corners(self):
+        np.testing.assert_allclose(latlon_to_gridyx(21.138123, -122.719528), (0, 0), atol=1e-3)
+        np.testing.assert_allclose(gridyx_to_latlon(1058, 1798), (47.842195, 299.082807), atol=1e-5)
+
+    def test_nearest_gridpoint(self):
+        self.assertEqual(nearest_gridpoint(self.lats[17, 23] + 0.001, self.lons[17, 23] - 360.001, self.grid), (17, 23))
+        with self.assertRaises(ValueError):
+            nearest_gridpoint(45.0, -100.0, FIXTURE_GRID | {'radius': 6371229.0})
+
+    def test_cached_gridpoint_persists(self):
+        cachefile = os.path.join(self.root, 'site_index.json')
+        point = cached_gridpoint(40.59, -111.64, HRRR_GRID, cachefile)
+        self.assertTrue(os.path.exists(cachefile))
+        hrrr_grid._site_index.clear()
+        with mock.patch('hrrr_grid.nearest_gridpoint') as nearest:
+            self.assertEqual(cached_gridpoint(40.59, -111.64, HRRR_GRID, cachefile), point)
+            nearest.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
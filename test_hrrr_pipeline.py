@@ -0,0 +1,63 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+from hrrr_fetch import HRRRNotAvailable
+from hrrr_pipeline import run_pipeline
+
+
+# Fetch stage: writes fhr to a file, failing the first attempts[fhr] calls
+def fetch(fhr, workdir, attempts, counts):
+    counts[fhr] = counts.get(fhr, 0) + 1
+    if counts[fhr] <= attempts.get(fhr, 0):
+        raise HRRRNotAvailable('F'+str(fhr).zfill(2)+' not available')
+    path = os.path.join(workdir, str(fhr))
+    with open(path, 'w') as f:
+        f.write(str(fhr))
+    return path
+
+
+# Decode stage: runs in a worker process
+def decode(path, scale):
+    with open(path) as f:
+        value = int(f.read())
+    if value == 3:
+        raise KeyError('bad file')
+    time.sleep(0.05)
+    return value*scale
+
+
+class TestRunPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_results_failures_and_retries(self):
+        counts = {}
+        attempts = {1: 2, 5: 10}
+        items = [((fhr, self.workdir, attempts, counts), (10,)) for fhr in range(8)]
+        finished = []
+        with patch('hrrr_pipeline.time.sleep', wraps=time.sleep) as sleep:
+            results, failures, stats = run_pipeline(fetch, decode, items, lambda item: item[0][0], fetchworkers=3,
+                                                    decodeworkers=2, queuesize=1, retries=2, backoff=0.01,
+                                                    on_result=lambda fhr, value: finished.append((fhr, value)))
+        self.assertEqual(results, {fhr: fhr*10 for fhr in (0, 1, 2, 4, 6, 7)})
+        # Each result handed over once, as it finished
+        self.assertEqual(sorted(finished), sorted(results.items()))
+        self.assertEqual(failures, {3: "KeyError: 'bad file'", 5: 'HRRRNotAvailable: F05 not available'})
+        self.assertEqual(counts, {0: 1, 1: 3, 2: 1, 3: 1, 4: 1, 5: 3, 6: 1, 7: 1})
+        self.assertIn(((0.01,), {}), [(call.args, call.kwargs) for call in sleep.call_args_list])
+        self.assertGreater(stats['decode'], 0.05*6)
+        self.assertGreater(stats['fhr_per_min'], 0)
+
+    def test_no_items(self):
+        self.assertEqual(run_pipeline(fetch, decode, [], lambda item: item[0][0])[:2], ({}, {}))
+
+
+if __name__ == '__main__':
+    unittest.main()
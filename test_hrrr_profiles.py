@@ -0,0 +1,119 @@
+import unittest
+import numpy as np
+from hrrr_snowpack_1_4 import valheight, calcwbzlevel
+from hrrr_profiles import (WETBULB_TOLERANCE, interp_heights, wbz_heights, wet_bulb_profiles,
+                           compare_wetbulb_timing)
+
+
+# Scalar reference, NaN where the original function raises
+def reference(func, *args):
+    try:
+        return func(*args)
+    except (ValueError, IndexError):
+        return np.nan
+
+
+class TestInterpHeights(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        # (site, hour, level) profiles with heights increasing upward
+        self.zvals = (1200. + np.cumsum(rng.uniform(300., 900., (4, 6, 8)), axis=-1)).astype(np.float32)
+        self.vals = rng.uniform(240., 290., (4, 6, 8)).astype(np.float32)
+
+    def check(self, heights):
+        result = interp_heights(self.vals, self.zvals, heights)
+        self.assertEqual(result.shape, heights.shape)
+        for index in np.ndindex(heights.shape):
+            expected = reference(valheight, self.vals[index[:-1]], self.zvals[index[:-1]], float(heights[index]))
+            np.testing.assert_equal(result[index], expected, err_msg=str(index))
+            if not np.isnan(expected):
+                self.assertEqual(result[index].dtype, expected.dtype)
+
+    def test_matches_valheight(self):
+        elev = np.linspace(1500., 3200., 4)[:, np.newaxis, np.newaxis]*np.ones((4, 6, 1))
+        self.check(elev + np.array([500., 1000., 2000.]))
+
+    def test_exact_level_match(self):
+        heights = np.stack([self.zvals[..., 2], self.zvals[..., 0], self.zvals[..., 7]], axis=-1).astype(float)
+        self.check(heights)
+        np.testing.assert_array_equal(interp_heights(self.vals, self.zvals, heights)[..., 0], self.vals[..., 2])
+
+    def test_below_and_above_profile(self):
+        # Below the lowest level wraps around like valheight, above the top level is NaN
+        heights = np.stack([self.zvals[..., 0] - 100., self.zvals[..., 7] + 100.], axis=-1).astype(float)
+        self.check(heights)
+        self.assertTrue(np.isnan(interp_heights(self.vals, self.zvals, heights)[..., 1]).all())
+
+    def test_single_profile(self):
+        self.assertEqual(interp_heights(self.vals[0, 0], self.zvals[0, 0], [2500.]).shape, (1,))
+
+
+class TestWBZHeights(unittest.TestCase):
+
+    def check(self, twvals, zvals):
+        result = wbz_heights(twvals, zvals)
+        self.assertEqual(result.shape, twvals.shape[:-1])
+        for index in np.ndindex(result.shape):
+            np.testing.assert_equal(result[index], reference(calcwbzlevel, twvals[index], zvals[index]),
+                                    err_msg=str(index))
+
+    def test_matches_calcwbzlevel(self):
+        rng = np.random.default_rng(2)
+        zvals = (1200. + np.cumsum(rng.uniform(300., 900., (5, 7, 10)), axis=-1)).astype(np.float32)
+        surface = rng.uniform(-15., 15., (5, 7, 1))
+        # Cooling with height plus noise, so some columns cross zero more than once
+        twvals = surface - 0.006*(zvals - zvals[..., :1]) + rng.normal(0., 1.5, zvals.shape)
+        twvals[..., -1] = -40.
+        self.check(twvals, zvals)
+
+    def test_edge_cases(self):
+        zvals = np.array([[1500., 2200., 3000., 3900.]]*4, dtype=np.float32)
+        twvals = np.array([[-1., -3., -8., -20.],      # entirely below freezing
+                           [2., 0., -3., -9.],         # exactly zero on a level
+                           [0., 0., 0., 0.],           # entirely at zero
+                           [4., 2., 1., 0.5]])         # above zero at the top, calcwbzlevel raises
+        self.check(twvals, zvals)
+        result = wbz_heights(twvals, zvals)
+        self.assertEqual(result[0], 0)
+        self.assertEqual(result[1], 2200.)
+        self.assertTrue(np.isnan(result[3]))
+
+
+class TestWetBulbProfiles(unittest.TestCase):
+
+    def test_matches_metpy(self):
+        rng = np.random.default_rng(3)
+        pressure = np.arange(1000., 75., -25.)
+        temperature = np.linspace(305., 210., pressure.size) + rng.normal(0., 3., (2, 3, pressure.size))
+        dewpoint = temperature - rng.uniform(0., 30., temperature.shape)
+        # Saturated levels
+        dewpoint[0, 0] = temperature[0, 0]
+        numpy = wet_bulb_profiles(pressure, temperature, dewpoint)
+        metpy = wet_bulb_profiles(pressure, temperature, dewpoint, backend='metpy')
+        self.assertEqual(numpy.shape, temperature.shape)
+        np.testing.assert_allclose(numpy, metpy, rtol=0, atol=WETBULB_TOLERANCE)
+        np.testing.assert_allclose(numpy[0, 0], temperature[0, 0], rtol=0, atol=WETBULB_TOLERANCE)
+        self.assertTrue((numpy <= temperature + WETBULB_TOLERANCE).all())
+        self.assertTrue((numpy >= dewpoint - WETBULB_TOLERANCE).all())
+
+    def test_float32_profiles(self):
+        pressure = np.array([850., 700., 500.])
+        temperature = np.array([[271.3, 262.1, 248.0]], dtype=np.float32)
+        dewpoint = np.array([[268.2, 255.4, 230.7]], dtype=np.float32)
+        np.testing.assert_allclose(wet_bulb_profiles(pressure, temperature, dewpoint),
+                                   wet_bulb_profiles(pressure, temperature, dewpoint, backend='metpy'),
+                                   rtol=0, atol=WETBULB_TOLERANCE)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            wet_bulb_profiles([850.], [[270.]], [[265.]], backend='cython')
+
+    def test_compare_wetbulb_timing(self):
+        results = compare_wetbulb_timing(nprofiles=2, nlevels=5)
+        self.assertEqual(set(results), {'numpy', 'metpy', 'maxdiff'})
+        self.assertLess(results['maxdiff'], WETBULB_TOLERANCE)
+
+
+if __name__ == '__main__':
+    unittest.main()
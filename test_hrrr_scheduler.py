@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+from hrrr_fetch import HRRRNotAvailable
+from hrrr_scheduler import run_forecast_hours
+
+
+# Fails the first attempts[fhr] calls for fhr, attempts are counted in markerdir since calls run in other processes
+def flaky(fhr, markerdir, attempts):
+    marker = os.path.join(markerdir, str(fhr))
+    with open(marker, 'a') as f:
+        f.write('x')
+    if os.path.getsize(marker) <= attempts.get(fhr, 0):
+        raise HRRRNotAvailable('F'+str(fhr).zfill(2)+' not available')
+    return fhr*10
+
+
+class TestRunForecastHours(unittest.TestCase):
+
+    def setUp(self):
+        self.markerdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.markerdir)
+
+    def test_retries_with_backoff(self):
+        attempts = {1: 1, 3: 2}
+        items = [(fhr, self.markerdir, attempts) for fhr in range(5)]
+        with patch('hrrr_scheduler.time.sleep') as sleep:
+            results, failures = run_forecast_hours(flaky, items, lambda item: item[0], 3, retries=3, backoff=2.)
+        self.assertEqual(results, {fhr: fhr*10 for fhr in range(5)})
+        self.assertEqual(failures, {})
+        self.assertEqual([call.args[0] for call in sleep.call_args_list], [2., 4.])
+        # Hours that succeed are not rerun
+        self.assertEqual(os.path.getsize(os.path.join(self.markerdir, '0')), 1)
+        self.assertEqual(os.path.getsize(os.path.join(self.markerdir, '3')), 3)
+
+    def test_partial_results(self):
+        attempts = {2: 10}
+        items = [(fhr, self.markerdir, attempts) for fhr in range(4)]
+        finished = []
+        with patch('hrrr_scheduler.time.sleep'):
+            results, failures = run_forecast_hours(flaky, items, lambda item: item[0], 2, retries=2, backoff=0.,
+                                                   on_result=lambda fhr, value: finished.append((fhr, value)))
+        self.assertEqual(results, {0: 0, 1: 10, 3: 30})
+        self.assertEqual(finished, [(0, 0), (1, 10), (3, 30)])
+        self.assertEqual(failures, {2: 'HRRRNotAvailable: F02 not available'})
+        self.assertEqual(os.path.getsize(os.path.join(self.markerdir, '2')), 3)
+
+    def test_no_items(self):
+        self.assertEqual(run_forecast_hours(flaky, [], lambda item: item[0], 2), ({}, {}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+import warnings
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestRegressor
+from hrrr_slr import (HRRR_SLR_MODEL_DIR, SLR_KEYS_FILE, SLR_SCALER_FILE, SLR_MODEL_FILE, SLR_FEATURES, SLRPredictor,
+                      get_slr_predictor)
+
+
+class TestSLRPredictor(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        warnings.filterwarnings('ignore')
+        cls.modeldir = tempfile.mkdtemp()
+        for name in (SLR_KEYS_FILE, SLR_SCALER_FILE):
+            shutil.copy(os.path.join(HRRR_SLR_MODEL_DIR, name), cls.modeldir)
+        scaler = np.load(os.path.join(cls.modeldir, SLR_SCALER_FILE), allow_pickle=True)[()]
+        rng = np.random.default_rng(4)
+        cls.features = pd.DataFrame(scaler.mean_ + scaler.scale_*rng.normal(size=(40, 6)), columns=SLR_FEATURES)
+        model = RandomForestRegressor(n_estimators=5, random_state=0)
+        model.fit(pd.DataFrame(scaler.transform(cls.features), columns=SLR_FEATURES), rng.uniform(5., 20., 40))
+        with open(os.path.join(cls.modeldir, SLR_MODEL_FILE), 'wb') as f:
+            pickle.dump(model, f)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.modeldir)
+
+    def test_batch_matches_single_row(self):
+        predictor = SLRPredictor(self.modeldir)
+        self.assertTrue(predictor.available)
+        slr = predictor.predict(self.features)
+        # The per-call recipe processhrrr had commented out
+        keys = np.load(os.path.join(self.modeldir, SLR_KEYS_FILE), allow_pickle=True)
+        scaler = np.load(os.path.join(self.modeldir, SLR_SCALER_FILE), allow_pickle=True)[()]
+        model = np.load(os.path.join(self.modeldir, SLR_MODEL_FILE), allow_pickle=True)
+        for i in range(len(self.features)):
+            slrdf = self.features.iloc[[i]][list(keys)]
+            data_norm = pd.DataFrame(scaler.transform(slrdf), index=slrdf.index, columns=slrdf.keys())
+            self.assertEqual(slr[i], float(model.predict(data_norm)[0]))
+
+    def test_missing_features_and_model(self):
+        features = self.features.iloc[:3].copy()
+        features.loc[1, 'T2K'] = np.nan
+        slr = SLRPredictor(self.modeldir).predict(features)
+        self.assertEqual(slr[1], 0)
+        self.assertTrue((slr[[0, 2]] > 0).all())
+
+        emptydir = tempfile.mkdtemp()
+        try:
+            predictor = SLRPredictor(emptydir)
+            self.assertFalse(predictor.available)
+            np.testing.assert_array_equal(predictor.predict(self.features), np.zeros(len(self.features)))
+        finally:
+            shutil.rmtree(emptydir)
+
+    def test_loaded_once_per_process(self):
+        self.assertIs(get_slr_predictor(self.modeldir), get_slr_predictor(self.modeldir))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,236 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from unittest.mock import patch, MagicMock
+import numpy as np
+import pandas as pd
+import hrrr_snowpack_1_4 as hrrr
+from hrrr_fetch import HRRRNotAvailable
+from offline_fixtures import LocalS3Server, write_hrrr_cycle
+from pipeline_timing import read_timing_log
+
+LEVELS = (1000, 900, 800, 700, 600, 500, 400, 300)
+SITES = [hrrr.Site('ATH20', 40.59123, -111.637711, 2668.0, 300),
+         hrrr.Site('LOW', 40.30, -111.90, 1500.0, 300),
+         hrrr.Site('NORTH', 40.85, -111.50, 2200.0, 200)]
+
+
+class TestHRRRSnowpack(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.root = tempfile.mkdtemp()
+        write_hrrr_cycle(cls.root, '2024031803', range(19), levels=LEVELS)
+        # Cycle still being published: F05 is late and F18 is not out yet
+        write_hrrr_cycle(cls.root, '2024031804', [fhr for fhr in range(18) if fhr != 5], levels=LEVELS)
+        cls.server = LocalS3Server(cls.root).__enter__()
+        cls.endpoint = patch('hrrr_fetch.HRRR_S3_ENDPOINT_URL', cls.server.endpoint_url)
+        cls.endpoint.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.endpoint.stop()
+        cls.server.__exit__(None, None, None)
+        shutil.rmtree(cls.root)
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.workdir = tempfile.mkdtemp()
+        os.chdir(self.workdir)
+        os.makedirs('./hrrr_scratch/')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.workdir)
+
+    def test_processhrrr_sites_matches_single_site(self):
+        rows = hrrr.processhrrr_sites('2024', '03', '18', '03', 5, SITES, './hrrr_scratch/')
+        self.assertEqual(len(rows), len(SITES))
+        for site, row in zip(SITES, rows):
+            single = hrrr.processhrrr('2024', '03', '18', '03', 5, site.lat, site.lon, site.elev, site.mlthick,
+                                      './hrrr_scratch/')
+            np.testing.assert_equal(row, single)
+        # Different sites sample different grid points
+        self.assertEqual(len(set(row[2:4] for row in rows)), len(SITES))
+
+    def test_processhrrr_sites_slr(self):
+        predictor = MagicMock()
+        predictor.predict.side_effect = lambda features: np.full(len(features), 12.)
+        with patch('hrrr_snowpack_1_4.get_slr_predictor', return_value=predictor):
+            rows = hrrr.processhrrr_sites('2024', '03', '18', '03', 5, SITES, './hrrr_scratch/', cachedir=None)
+        # One batched prediction for all sites
+        predictor.predict.assert_called_once()
+        self.assertEqual(list(predictor.predict.call_args.args[0].columns),
+                         ['T05K', 'T1K', 'T2K', 'SPD05K', 'SPD1K', 'SPD2K'])
+        for site, row in zip(SITES, rows):
+            precip, wbz, slr, snow = row[15:19]
+            if wbz <= site.elev:
+                expected = 12.
+            elif wbz < site.elev + site.mlthick:
+                expected = np.round(12.*(site.elev + site.mlthick - wbz)/site.mlthick, 1)
+                expected = expected if expected >= 3 else 0
+            else:
+                expected = 0
+            self.assertAlmostEqual(slr, expected)
+            self.assertAlmostEqual(snow, np.round(precip*expected/10, 1))
+
+    def test_get_hrrr_forecast_sites(self):
+        start = datetime(2024, 3, 18, 3)
+        gets = self.server.requests['GET']
+        sitedfs = hrrr.get_hrrr_forecast_sites(start, SITES, maxprocesses=4, cachedir=None, storedir=None)
+        # One idx and one (coalesced) set of ranged GETs per forecast hour, independent of the number of sites
+        fetches = self.server.requests['GET'] - gets
+        self.assertEqual(sorted(sitedfs), sorted(site.stid for site in SITES))
+        for site in SITES:
+            self.assertEqual(list(sitedfs[site.stid].columns), hrrr.COLUMNS)
+            self.assertEqual(list(sitedfs[site.stid]['FHR']), list(range(19)))
+            self.assertTrue(os.path.exists('hrrr_to_snowpack_'+site.stid+'_2024031803.csv'))
+
+        gets = self.server.requests['GET']
+        hrrr.get_hrrr_forecast_sites(start, SITES[:1], maxprocesses=4, csvdir=None, cachedir=None, storedir=None)
+        self.assertEqual(self.server.requests['GET'] - gets, fetches)
+
+        longdf = hrrr.get_hrrr_forecast_sites(start, SITES, maxprocesses=4, long_format=True, csvdir=None, cachedir=None,
+                                              storedir=None)
+        self.assertEqual(len(longdf), 19*len(SITES))
+        pd.testing.assert_frame_equal(longdf[longdf['Station ID'] == 'LOW'][hrrr.COLUMNS].reset_index(drop=True),
+                                      sitedfs['LOW'])
+
+    def test_pipeline_matches_pool(self):
+        start = datetime(2024, 3, 18, 3)
+        pool = hrrr.get_hrrr_forecast_sites(start, SITES, maxprocesses=4, csvdir=None, cachedir=None, storedir=None,
+                                            pipeline=False)
+        with patch('hrrr_snowpack_1_4.make_s3_client', wraps=hrrr.make_s3_client) as make_s3_client:
+            pipeline = hrrr.get_hrrr_forecast_sites(start, SITES, maxprocesses=2, csvdir=None, cachedir=None,
+                                                    storedir=None, fetchworkers=3)
+        # One client shared by all fetch threads
+        make_s3_client.assert_called_once_with(max_pool_connections=3)
+        for site in SITES:
+            pd.testing.assert_frame_equal(pool[site.stid], pipeline[site.stid])
+
+    def test_on_hour(self):
+        start = datetime(2024, 3, 18, 3)
+        for pipeline in (True, False):
+            hours = []
+            sitedfs = hrrr.get_hrrr_forecast_sites(start, SITES, maxprocesses=4, csvdir=None, cachedir=None,
+                                                   storedir=None, pipeline=pipeline,
+                                                   on_hour=lambda fhr, tables: hours.append((fhr, tables)))
+            # Every forecast hour once, in order, with the rows of the final tables
+            self.assertEqual([fhr for fhr, tables in hours], list(range(19)))
+            for site in SITES:
+                streamed = pd.concat([tables[site.stid] for fhr, tables in hours], ignore_index=True)
+                pd.testing.assert_frame_equal(streamed, sitedfs[site.stid], check_dtype=False)
+
+    def test_timing_log(self):
+        start = datetime(2024, 3, 18, 3)
+        with patch('pipeline_timing.TIMING_LOG', 'timing.jsonl'):
+            hrrr.get_hrrr_forecast_sites(start, SITES, maxprocesses=2, cachedir=None, storedir=None)
+        records = read_timing_log('timing.jsonl')
+        # A fetch and a decode line per forecast hour, from the threads and processes that ran them
+        for event in ('hrrr_fetch', 'hrrr_decode'):
+            self.assertEqual(sorted(record['fhr'] for record in records if record['event'] == event), list(range(19)))
+        decodes = [record for record in records if record['event'] == 'hrrr_decode']
+        self.assertNotIn(os.getpid(), [record['pid'] for record in decodes])
+        for name in ('grib_decode', 'neighbor_lookup', 'derived', 'wet_bulb', 'slr'):
+            self.assertTrue(all(record['stages'][name]['calls'] > 0 for record in decodes))
+        fetch = [record for record in records if record['event'] == 'hrrr_fetch'][0]
+        self.assertGreater(fetch['stages']['s3_get']['bytes'], 0)
+        forecast = records[-1]
+        self.assertEqual((forecast['event'], forecast['cycle'], forecast['sites']), ('hrrr_forecast', '2024031803', 3))
+        self.assertEqual(forecast['stages']['csv_write']['calls'], 3)
+
+    def test_whole_file_download(self):
+        start = datetime(2024, 3, 18, 3)
+        byterange = hrrr.get_hrrr_forecast_sites(start, SITES[:1], maxprocesses=4, csvdir=None, cachedir=None,
+                                                 storedir=None, pipeline=False)
+        heads = self.server.requests['HEAD']
+        whole = hrrr.get_hrrr_forecast_sites(start, SITES[:1], maxprocesses=4, byterange=False, csvdir=None,
+                                             cachedir=None, storedir=None, pipeline=False)
+        self.assertEqual(self.server.requests['HEAD'], heads)
+        pd.testing.assert_frame_equal(byterange['ATH20'], whole['ATH20'])
+
+        with self.assertRaises(HRRRNotAvailable):
+            hrrr.fetchhrrr('2024', '03', '18', '03', 19, './hrrr_scratch/', byterange=False, cachedir=None)
+
+    def test_rerun_uses_cache(self):
+        start = datetime(2024, 3, 18, 3)
+        first = hrrr.get_hrrr_forecast_sites(start, SITES, maxprocesses=4, csvdir=None, cachedir='./hrrr_cache/',
+                                             storedir=None)
+        gets = self.server.requests['GET']
+        second = hrrr.get_hrrr_forecast_sites(start, SITES, maxprocesses=4, csvdir=None, cachedir='./hrrr_cache/',
+                                              storedir=None)
+        self.assertEqual(self.server.requests['GET'], gets)
+        for site in SITES:
+            pd.testing.assert_frame_equal(first[site.stid], second[site.stid])
+
+    def test_rerun_uses_store(self):
+        start = datetime(2024, 3, 18, 3)
+        gets = self.server.requests['GET']
+        first = hrrr.get_hrrr_forecast_sites(start, SITES, maxprocesses=4, csvdir=None, cachedir=None,
+                                             storedir='./hrrr_store/')
+        fetches = self.server.requests['GET'] - gets
+        gets = self.server.requests['GET']
+        with patch('hrrr_snowpack_1_4.processhrrr_sites') as processhrrr_sites:
+            second = hrrr.get_hrrr_forecast_sites(start, SITES[::-1], maxprocesses=4, csvdir=None, cachedir=None,
+                                                  storedir='./hrrr_store/')
+        processhrrr_sites.assert_not_called()
+        self.assertEqual(self.server.requests['GET'], gets)
+        for site in SITES:
+            pd.testing.assert_frame_equal(first[site.stid], second[site.stid])
+
+        # Only the forecast hours missing from the store are recomputed
+        os.remove('./hrrr_store/cycle=2024031803/fhr=07.parquet')
+        third = hrrr.get_hrrr_forecast_sites(start, SITES, maxprocesses=4, csvdir=None, cachedir=None,
+                                             storedir='./hrrr_store/')
+        self.assertGreater(self.server.requests['GET'] - gets, 0)
+        self.assertLess(self.server.requests['GET'] - gets, fetches/10)
+        for site in SITES:
+            pd.testing.assert_frame_equal(first[site.stid], third[site.stid])
+
+    def test_missing_forecast_hours(self):
+        start = datetime(2024, 3, 18, 4)
+        sitedfs = hrrr.get_hrrr_forecast_sites(start, SITES, maxprocesses=4, csvdir=None, cachedir=None,
+                                               storedir='./hrrr_store/', retries=1, backoff=0.)
+        # F05 comes from the previous cycle's forecast valid at the same time, nothing is valid at F18
+        previous = hrrr.processhrrr_sites('2024', '03', '18', '03', 6, SITES, './hrrr_scratch/', cachedir=None)
+        for i, site in enumerate(SITES):
+            sitedf = sitedfs[site.stid]
+            self.assertEqual(sitedf.attrs['hrrr_gaps'], {5: '2024031803F06', 18: 'nodata'})
+            self.assertEqual(len(sitedf), 19)
+            self.assertEqual(list(sitedf['FHR'][:5]), list(range(5)))
+            self.assertEqual(tuple(sitedf.iloc[5][:2]), ('2024031803', 6))
+            np.testing.assert_allclose(sitedf.iloc[5][2:].astype(float), np.array(previous[i][2:], dtype=float))
+            self.assertEqual(tuple(sitedf.iloc[18][:2]), ('2024031804', 18))
+            self.assertTrue(sitedf.iloc[18][2:].isna().all())
+            self.assertFalse(sitedf.iloc[:18].drop(index=5)[hrrr.COLUMNS[2:]].isna().any().any())
+
+        # Finished hours were checkpointed, gaps were not
+        store = hrrr.PointStore('./hrrr_store/')
+        self.assertEqual(store.fhrs('2024031804'), [fhr for fhr in range(18) if fhr != 5])
+        self.assertEqual(store.fhrs('2024031803'), [6])
+
+        gets = self.server.requests['GET']
+        sitedf = hrrr.get_hrrr_forecast_sites(start, SITES[:1], maxprocesses=4, csvdir=None, cachedir=None,
+                                              storedir='./hrrr_store/', retries=0, gap_policy='nodata')['ATH20']
+        self.assertEqual(sitedf.attrs['hrrr_gaps'], {5: 'nodata', 18: 'nodata'})
+        self.assertTrue(sitedf.iloc[5][2:].isna().all())
+        # Only the two missing idx files were requested
+        self.assertEqual(self.server.requests['GET'] - gets, 2)
+
+        with self.assertRaises(HRRRNotAvailable):
+            hrrr.get_hrrr_forecast_sites(start, SITES, maxprocesses=4, csvdir=None, cachedir=None,
+                                         storedir='./hrrr_store/', retries=0, gap_policy='raise')
+
+    def test_get_hrrr_forecast_single_site(self):
+        site = SITES[0]
+        sitedf = hrrr.get_hrrr_forecast(datetime(2024, 3, 18, 3), site.lat, site.lon, site.elev, site.mlthick,
+                                        maxprocesses=4)
+        self.assertEqual(len(sitedf), 19)
+        csvdf = pd.read_csv('hrrr_to_snowpack_2024031803.csv', dtype={'INIT (YYYYMMDDHH UTC)': str})
+        pd.testing.assert_frame_equal(csvdf, sitedf, check_dtype=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+import unittest
+import pandas as pd
+from collections import namedtuple
+from hrrr_store import PointStore, SITE_COLUMNS, load_point_forecast
+
+Site = namedtuple('Site', ['stid', 'lat', 'lon', 'elev', 'mlthick'])
+COLUMNS = ['INIT', 'FHR', 'T2M']
+SITES = [Site('A', 40.0, -111.0, 2000.0, 300), Site('B', 41.0, -112.0, 1500.0, 200)]
+
+
+class TestPointStore(unittest.TestCase):
+
+    def setUp(self):
+        self.storedir = tempfile.mkdtemp()
+        self.store = PointStore(self.storedir)
+
+    def tearDown(self):
+        shutil.rmtree(self.storedir)
+
+    def test_write_read_hour(self):
+        self.assertIsNone(self.store.read_hour('2024031803', 0, SITES))
+        self.store.write('2024031803', 0, SITES, [('2024031803', 0, 270.5), ('2024031803', 0, 280.25)], COLUMNS)
+        self.assertTrue(os.path.exists(os.path.join(self.storedir, 'cycle=2024031803', 'fhr=00.parquet')))
+        self.assertTrue(self.store.has('2024031803', 0, SITES))
+        df = self.store.read_hour('2024031803', 0, SITES[::-1])
+        self.assertEqual(list(df['Station ID']), ['B', 'A'])
+        self.assertEqual(list(df['T2M']), [280.25, 270.5])
+        self.assertEqual(list(df.columns), SITE_COLUMNS + COLUMNS)
+        # Same name, different location is a different site
+        self.assertFalse(self.store.has('2024031803', 0, [Site('A', 40.5, -111.0, 2000.0, 300)]))
+
+    def test_write_merges_sites(self):
+        self.store.write('2024031803', 1, SITES[:1], [('2024031803', 1, 1.0)], COLUMNS)
+        self.assertFalse(self.store.has('2024031803', 1, SITES))
+        self.store.write('2024031803', 1, SITES, [('2024031803', 1, 2.0), ('2024031803', 1, 3.0)], COLUMNS)
+        df = self.store.read_hour('2024031803', 1)
+        self.assertEqual(len(df), 2)
+        self.assertEqual(list(df.sort_values('Station ID')['T2M']), [2.0, 3.0])
+
+    def test_load_point_forecast(self):
+        self.assertIsNone(load_point_forecast('2024031803', 'A', self.storedir))
+        for fhr in (2, 0, 1):
+            self.store.write('2024031803', fhr, SITES, [('2024031803', fhr, float(fhr)), ('2024031803', fhr, -1.)],
+                             COLUMNS)
+        self.assertEqual(self.store.fhrs('2024031803'), [0, 1, 2])
+        df = load_point_forecast('2024031803', 'A', self.storedir)
+        self.assertEqual(list(df.columns), COLUMNS)
+        pd.testing.assert_series_equal(df['T2M'], pd.Series([0., 1., 2.], name='T2M'))
+        self.assertEqual(len(self.store.read('2024031803')), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+import mesowest_fetch
+from mesowest_cache import MesowestCache, MesowestNotCached, MESOWEST_CACHE_FINAL_AFTER
+from mesowest_fetch import MesowestError, MESOWEST_NO_DATA, fetch_timeseries, fetch_stations
+from mesowest_to_smet_forecast import mesowest_to_smet
+from offline_fixtures import LocalMesowestServer
+
+
+class TestMesowestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        self.server = LocalMesowestServer().__enter__()
+        self.addCleanup(self.server.__exit__)
+        patcher = patch.object(mesowest_fetch, 'MESOWEST_API_URL', self.server.api_url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def test_key(self):
+        self.assertEqual(MesowestCache.key(['A', 'B'], '202410050000', '202410060000'),
+                         MesowestCache.key('B,A', '20241005000000', '202410060000'))
+        self.assertNotEqual(MesowestCache.key('A', '202410050000', '202410060000'),
+                            MesowestCache.key('A', '202410050000', '202410060100'))
+
+    def test_rerun_past_window(self):
+        mesowest_to_smet('202410050000', '202501050000', 'ATH20', False, False)
+        fetch_stations(['ATH20'], '202410050000', '202501050000')
+        with open('ATH20.smet') as f:
+            first = f.read()
+        requests = self.server.requests
+        self.assertGreater(requests, 0)
+        mesowest_to_smet('202410050000', '202501050000', 'ATH20', False, False)
+        fetch_stations(['ATH20'], '202410050000', '202501050000')
+        self.assertEqual(self.server.requests, requests)
+        with open('ATH20.smet') as f:
+            self.assertEqual(f.read(), first)
+        # Compressed on disk
+        files = os.listdir('mesowest_cache')
+        self.assertTrue(all(name.endswith('.json.gz') for name in files))
+
+    def test_offline_replay(self):
+        mesowest_to_smet('202410050000', '202501050000', 'ATH20', False, False)
+        with open('ATH20.smet') as f:
+            online = f.read()
+        os.remove('ATH20.smet')
+        with patch.object(mesowest_fetch, 'MESOWEST_API_URL', 'http://127.0.0.1:9/nothing'):
+            mesowest_to_smet('202410050000', '202501050000', 'ATH20', False, False, offline=True)
+            with open('ATH20.smet') as f:
+                self.assertEqual(f.read(), online)
+            with self.assertRaises(MesowestNotCached):
+                fetch_timeseries('ATH20', '202410050000', '202410060000', offline=True)
+            # Without the cache nothing can be replayed
+            with self.assertRaises(MesowestNotCached):
+                fetch_timeseries('ATH20', '202410050000', '202501050000', cachedir=None, offline=True)
+
+    def test_open_window_ttl(self):
+        end = datetime.now(timezone.utc).strftime('%Y%m%d%H%M')
+        start = (datetime.now(timezone.utc) - timedelta(hours=6)).strftime('%Y%m%d%H%M')
+        fetch_timeseries('ATH20', start, end)
+        fetch_timeseries('ATH20', start, end)
+        self.assertEqual(self.server.requests, 1)
+        # Expired after the TTL, still served offline
+        cache = MesowestCache()
+        path = cache.path(cache.key('ATH20', start, end))
+        old = time.time() - cache.ttl - 1
+        os.utime(path, (old, old))
+        self.assertIsNotNone(cache.get('ATH20', start, end, offline=True))
+        self.assertIsNone(cache.get('ATH20', start, end))
+        fetch_timeseries('ATH20', start, end)
+        self.assertEqual(self.server.requests, 2)
+
+    def test_error_not_cached(self):
+        # No stations found: an error, not an empty timeseries to serve forever
+        self.server.stations = {}
+        with self.assertRaises(MesowestError) as raised:
+            fetch_timeseries('ATH20', '202410050000', '202410060000')
+        self.assertEqual(raised.exception.response_code, MESOWEST_NO_DATA)
+        self.assertEqual(os.listdir('mesowest_cache'), [])
+        with self.assertRaises(MesowestNotCached):
+            fetch_timeseries('ATH20', '202410050000', '202410060000', offline=True)
+        # The next call goes back to the API
+        self.server.stations = None
+        data = fetch_timeseries('ATH20', '202410050000', '202410060000')
+        self.assertEqual(data['STATION'][0]['STID'], 'ATH20')
+        fetch_timeseries('ATH20', '202410050000', '202410060000')
+        self.assertEqual(self.server.requests, 2)
+
+    def test_is_final(self):
+        fetched = datetime(2025, 1, 10, tzinfo=timezone.utc).timestamp()
+        self.assertTrue(MesowestCache.is_final('202501050000', fetched))
+        self.assertFalse(MesowestCache.is_final('202501100000', fetched))
+        end = datetime.fromtimestamp(fetched - MESOWEST_CACHE_FINAL_AFTER + 60, timezone.utc).strftime('%Y%m%d%H%M')
+        self.assertFalse(MesowestCache.is_final(end, fetched))
+
+
+if __name__ == '__main__':
+    unittest.main()
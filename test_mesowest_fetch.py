@@ -0,0 +1,161 @@
+import io
+import os
+import time
+import shutil
+import tracemalloc
+from datetime import datetime, timedelta
+import tempfile
+import unittest
+from unittest.mock import patch
+import mesowest_fetch
+from mesowest_fetch import (MesowestError, make_session, fetch_timeseries, fetch_stations, split_stations,
+                            split_window, iter_timeseries_chunks)
+from mesowest_to_smet_forecast import mesowest_to_smet, mesowest_to_smet_stations
+from offline_fixtures import LocalMesowestServer
+
+
+class TestMesowestFetch(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def serve(self, **kwargs):
+        server = LocalMesowestServer(**kwargs).__enter__()
+        self.addCleanup(server.__exit__)
+        patcher = patch.object(mesowest_fetch, 'MESOWEST_API_URL', server.api_url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return server
+
+    def test_multi_station_query(self):
+        server = self.serve()
+        stids = ['ST'+str(i).zfill(2) for i in range(25)]
+        results, failures = fetch_stations(stids, '202410050000', '202410060000', stations_per_request=10)
+        self.assertEqual(failures, {})
+        self.assertEqual(sorted(results), stids)
+        self.assertEqual((server.requests, server.stations_requested), (3, 25))
+        single = split_stations(fetch_timeseries('ST07', '202410050000', '202410060000'))['ST07']
+        self.assertEqual(results['ST07']['STATION'], single['STATION'])
+        self.assertEqual(len(results['ST07']['STATION'][0]['OBSERVATIONS']['date_time']), 25)
+
+    def test_smet_per_station(self):
+        self.serve()
+        stids = ['ATH20', 'UKALF', 'ST003']
+        written, failures = mesowest_to_smet_stations('202410050000', '202410120000', stids, stations_per_request=2)
+        self.assertEqual((written, failures), (stids, {}))
+        files = {}
+        for stid in stids:
+            with open(stid+'.smet') as f:
+                files[stid] = f.read()
+        self.assertEqual(len(set(files.values())), 3)
+        # Same file as one station at a time
+        mesowest_to_smet('202410050000', '202410120000', 'UKALF', False, False)
+        with open('UKALF.smet') as f:
+            self.assertEqual(f.read(), files['UKALF'])
+
+    def test_concurrent_requests(self):
+        latency = 0.3
+        self.serve(latency=latency)
+        stids = ['ST'+str(i).zfill(2) for i in range(12)]
+        start = time.time()
+        results, failures = fetch_stations(stids, '202410050000', '202410050600', stations_per_request=1,
+                                           max_workers=12)
+        self.assertEqual(len(results), 12)
+        self.assertLess(time.time() - start, 12*latency/3)
+
+    def test_retries_and_failures(self):
+        server = self.serve(stations={'ATH20': {'NAME': 'Atwater Study Plot'}}, failures=2)
+        session = make_session(retries=2, backoff=0.)
+        results, failures = fetch_stations(['ATH20', 'NOPE1'], '202410050000', '202410050600', session=session)
+        self.assertEqual(list(results), ['ATH20'])
+        self.assertEqual(results['ATH20']['STATION'][0]['NAME'], 'Atwater Study Plot')
+        self.assertIn('NOPE1', failures)
+        self.assertEqual(server.requests, 3)
+
+        # Out of retries, the stations come back as failures instead of raising
+        server.failures = 3
+        results, failures = fetch_stations(['ATH20'], '202410050000', '202410050600', session=session)
+        self.assertEqual(results, {})
+        self.assertIn('503', failures['ATH20'])
+
+    def test_incremental_starts(self):
+        server = self.serve()
+        mesowest_to_smet_stations('202410050000', '202410060000', ['ATH20', 'UKALF'])
+        mesowest_to_smet('202410050000', '202410070000', 'UKALF', False, False)
+        requests = server.requests
+        # The stations have different last observations, one request each from there on
+        written, failures = mesowest_to_smet_stations('202410050000', '202410080000', ['ATH20', 'UKALF'],
+                                                      incremental=True)
+        self.assertEqual(server.requests - requests, 2)
+        with open('ATH20.smet') as f:
+            incremental = f.read()
+        mesowest_to_smet('202410050000', '202410080000', 'ATH20', False, False)
+        with open('ATH20.smet') as f:
+            self.assertEqual(incremental, f.read())
+
+    def test_split_window(self):
+        self.assertEqual(split_window('202410050000', '202410050000', 1), [('202410050000', '202410050000')])
+        windows = split_window('20241005000000', '202411050030', 10)
+        self.assertEqual(windows, [('202410050000', '202410142359'), ('202410150000', '202410242359'),
+                                   ('202410250000', '202411032359'), ('202411040000', '202411050030')])
+
+    def test_chunks_in_order(self):
+        server = self.serve(latency=0.05)
+        chunks = list(iter_timeseries_chunks('ATH20', '202410050000', '202412312300', chunk_days=7, max_workers=4))
+        self.assertEqual(server.requests, 13)
+        dates = [t for chunk in chunks for t in chunk['STATION'][0]['OBSERVATIONS']['date_time']]
+        whole = fetch_timeseries('ATH20', '202410050000', '202412312300')['STATION'][0]['OBSERVATIONS']['date_time']
+        self.assertEqual(dates, whole)
+
+    def test_chunks_without_data(self):
+        self.serve(stations={})
+        with patch('sys.stdout', new_callable=io.StringIO) as out:
+            chunks = list(iter_timeseries_chunks('ATH20', '202410050000', '202410200000', chunk_days=7))
+        self.assertEqual(chunks, [None, None, None])
+        self.assertIn('ATH20 from 202410120000 to 202410182359, chunk skipped (No stations found', out.getvalue())
+        with self.assertRaises(ValueError):
+            mesowest_to_smet('202410050000', '202412050000', 'ATH20', False, False)
+        # Any other error is not skipped
+        with patch('mesowest_fetch.fetch_timeseries', side_effect=MesowestError('Invalid token', 200)):
+            with self.assertRaises(MesowestError):
+                list(iter_timeseries_chunks('ATH20', '202410050000', '202410200000', chunk_days=7))
+
+    def test_chunked_smet(self):
+        server = self.serve()
+        # One request for the whole window
+        data = fetch_timeseries('ATH20', '202410050000', '202504010000')
+        mesowest_to_smet('202410050000', '202504010000', 'ATH20', False, False, data=data)
+        with open('ATH20.smet') as f:
+            whole = f.read()
+        # Default chunks of 31 days, starting an hour early so the observation at each border is fetched twice
+        def overlapping(start, end, days):
+            windows = split_window(start, end, days)
+            return windows[:1] + [((datetime.strptime(a, '%Y%m%d%H%M') - timedelta(hours=1)).strftime('%Y%m%d%H%M'), b)
+                                  for a, b in windows[1:]]
+        requests = server.requests
+        with patch('mesowest_fetch.split_window', side_effect=overlapping):
+            mesowest_to_smet('202410050000', '202504010000', 'ATH20', False, False)
+        self.assertEqual(server.requests - requests, 6)
+        with open('ATH20.smet') as f:
+            self.assertEqual(f.read(), whole)
+
+    def test_chunked_memory_bounded(self):
+        self.serve()
+        peaks = []
+        for end in ('202504050000', '202704050000'):
+            tracemalloc.start()
+            mesowest_to_smet('202410050000', end, 'ATH20', False, False)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        # Four times the window, about the same peak
+        self.assertLess(peaks[1], 1.5*peaks[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
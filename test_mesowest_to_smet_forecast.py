@@ -1,15 +1,34 @@
+# Imported first, eccodes has to come after the other HRRR dependencies
+import hrrr_snowpack_1_4
+import os
+import shutil
+import tempfile
 import unittest
-from unittest.mock import patch, mock_open
+from unittest.mock import patch, MagicMock
 import requests
 import json
-from datetime import datetime
-from mesowest_to_smet_forecast import mesowest_to_smet
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+import mesowest_fetch
+from mesowest_fetch import MESOWEST_CONNECT_TIMEOUT, MESOWEST_TIMEOUT
+from mesowest_to_smet_forecast import QC_CONTEXT_HOURS, mesowest_to_smet, mesowest_to_smet_stations
+from offline_fixtures import LocalMesowestServer
+from smet_io import read_smet, read_smet_obs_end, read_last_line
 
 class TestMesowestToSmet(unittest.TestCase):
 
-    @patch('mesowest_to_smet_forecast.requests.get')
-    @patch('builtins.open', new_callable=mock_open)
-    def test_mesowest_to_smet(self, mock_file, mock_get):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    @patch('mesowest_fetch.requests.Session.get')
+    def test_mesowest_to_smet(self, mock_get):
         # Mock response from Mesowest API
         mock_response = {
             "STATION": [
@@ -45,26 +64,279 @@ class TestMesowestToSmet(unittest.TestCase):
 
         # Check if the correct API URL was called
         mock_get.assert_called_once_with(
-            f'http://api.mesowest.net/v2/stations/timeseries?stid={stid}&token=3d5845d69f0e47aca3f810de0bb6fd3f&start={start_time}&end={current_time}'
+            f'http://api.mesowest.net/v2/stations/timeseries?stid={stid}&token=3d5845d69f0e47aca3f810de0bb6fd3f&start={start_time}&end={current_time}',
+            timeout=(MESOWEST_CONNECT_TIMEOUT, MESOWEST_TIMEOUT)
         )
 
         # Check if the SMET file was written correctly
-        mock_file.assert_called_once_with('TEST.smet', 'w')
-        handle = mock_file()
-        handle.write.assert_any_call('SMET 1.1 ASCII\n')
-        handle.write.assert_any_call('[HEADER]\n')
-        handle.write.assert_any_call('station_id       = TEST\n')
-        handle.write.assert_any_call('station_name     = Test Station\n')
-        handle.write.assert_any_call('latitude         = 40.0\n')
-        handle.write.assert_any_call('longitude        = -111.0\n')
-        handle.write.assert_any_call('altitude         = 1524.0\n')  # Elevation converted to meters
-        handle.write.assert_any_call('nodata           = -999\n')
-        handle.write.assert_any_call('tz               = 1\n')
-        handle.write.assert_any_call('source           = University of Utah EFD Lab\n')
-        handle.write.assert_any_call('fields           = timestamp TA RH TSG TSS HS VW DW ISWR\n')
-        handle.write.assert_any_call('[DATA]\n')
-        handle.write.assert_any_call('2024-07-20T00:00:00 293.15 0.50 273.15 288.15 0.10 5.00 180.00 200.00\n')
-        handle.write.assert_any_call('2024-07-20T01:00:00 294.15 0.55 273.15 289.15 0.11 6.00 190.00 210.00\n')
+        with open('TEST.smet') as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines, [
+            'SMET 1.1 ASCII',
+            '[HEADER]',
+            'station_id       = TEST',
+            'station_name     = Test Station',
+            'latitude         = 40.0',
+            'longitude        = -111.0',
+            'altitude         = 1524.0',  # Elevation converted to meters
+            'nodata           = -999',
+            'tz               = 1',
+            'source           = Utah Avalanche Center - Synoptic Data',
+            'fields           = timestamp TA RH TSG HS VW DW TSS ISWR',
+            '[DATA]',
+            '2024-07-20T00:00:00 293.15 0.50 273.15 0.10 5.00 180.00 288.15 200.00',
+            '2024-07-20T01:00:00 294.15 0.55 273.15 0.11 6.00 190.00 289.15 210.00',
+        ])
+        with open('smet_end_datetime.dat') as f:
+            self.assertEqual(f.read(), 'end_year = 2024\nend_month = 07\nend_day = 20\nend_hour = 01\nend_min = 00\n')
+
+
+class TestIncrementalMesowestToSmet(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        self.times = [datetime(2024, 10, 5) + timedelta(hours=i) for i in range(72)]
+        self.overrides = {}  # (variable, index) -> value replacing the one below
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    # Mesowest stand-in, observations of the season between the start and end of the url
+    def fake_get(self, url, timeout=None):
+        query = dict(item.split('=') for item in url.split('?')[1].split('&'))
+        start = datetime.strptime(query['start'], '%Y%m%d%H%M')
+        end = datetime.strptime(query['end'], '%Y%m%d%H%M')
+        index = [i for i, time in enumerate(self.times) if start <= time <= end]
+        observations = {
+            "date_time": [self.times[i].strftime('%Y-%m-%dT%H:%M:%SZ') for i in index],
+            "air_temp_set_1": [-5.0 + 0.1*i for i in index],
+            "surface_temp_set_1": [-8.0 + 0.1*i for i in index],
+            "relative_humidity_set_1": [80.0 - 0.2*i for i in index],
+            "wind_speed_set_1": [2.0 + 0.01*i for i in index],
+            "wind_direction_set_1": [float(i % 360) for i in index],
+            "snow_depth_set_1": [500.0 + i for i in index],
+            "solar_radiation_set_1": [(-3.0 if i % 24 > 12 else 100.0 + i) for i in index],
+        }
+        for (variable, i), value in self.overrides.items():
+            if i in index:
+                observations[variable][index.index(i)] = value
+        response = MagicMock()
+        response.json.return_value = {"STATION": [{"STID": "TEST", "NAME": "Test Station", "LATITUDE": 40.0,
+                                                   "LONGITUDE": -111.0, "ELEV_DEM": 5000,
+                                                   "OBSERVATIONS": observations}]}
+        return response
+
+    def test_incremental_matches_full_build(self):
+        with patch('mesowest_fetch.requests.Session.get', side_effect=self.fake_get) as mock_get:
+            mesowest_to_smet('202410050000', '202410072300', 'TEST', False, False)
+            with open('TEST.smet') as f:
+                full = f.read()
+            os.remove('TEST.smet')
+
+            mesowest_to_smet('202410050000', '202410060000', 'TEST', False, False, True)
+            # A forecast appended by that run, dropped by the next one
+            with open('TEST.smet', 'a') as f:
+                f.write('2024-10-06T01:00:00 270.00 0.90 273.15 265.00 0.00 5.00 270.00\n')
+            mesowest_to_smet('202410050000', '202410072300', 'TEST', False, False, True)
+            with open('TEST.smet') as f:
+                self.assertEqual(f.read(), full)
+
+            # The last run only asked for the hours from its last observation on, the ones written again and the
+            # ones QC of those looks back at
+            start = datetime(2024, 10, 6) - timedelta(hours=2*QC_CONTEXT_HOURS)
+            self.assertIn('start='+start.strftime('%Y%m%d%H%M')+'&end=202410072300', mock_get.call_args.args[0])
+            with open('smet_end_datetime.dat') as f:
+                self.assertIn('end_hour = 23\n', f.read())
+
+            # Nothing new, the file stays the same
+            mesowest_to_smet('202410050000', '202410072300', 'TEST', False, False, True)
+            start = datetime(2024, 10, 7, 23) - timedelta(hours=2*QC_CONTEXT_HOURS)
+            self.assertIn('start='+start.strftime('%Y%m%d%H%M')+'&end=202410072300', mock_get.call_args.args[0])
+            with open('TEST.smet') as f:
+                self.assertEqual(f.read(), full)
+
+    def test_incremental_qc_context(self):
+        # The first row written again by the last run: a missing snow depth and a temperature jump, or a snow
+        # depth spike. Its QC has to see the rows before it, as in a full build.
+        first = datetime(2024, 10, 6) - timedelta(hours=QC_CONTEXT_HOURS)
+        i = self.times.index(first)
+        cases = [{('snow_depth_set_1', i): None, ('air_temp_set_1', i): 20.0}, {('snow_depth_set_1', i): 1500.0}]
+        for overrides in cases:
+            self.overrides = overrides
+            with patch('mesowest_fetch.requests.Session.get', side_effect=self.fake_get):
+                mesowest_to_smet('202410050000', '202410072300', 'TEST', False, False, cachedir=None)
+                with open('TEST.smet') as f:
+                    full = f.read()
+                os.remove('TEST.smet')
+                mesowest_to_smet('202410050000', '202410060000', 'TEST', False, False, True, cachedir=None)
+                mesowest_to_smet('202410050000', '202410072300', 'TEST', False, False, True, cachedir=None)
+            with open('TEST.smet') as f:
+                self.assertEqual(f.read(), full)
+            header, smet = read_smet('TEST.smet')
+            row = smet[smet['timestamp'] == np.datetime64(first)].iloc[0]
+            self.assertAlmostEqual(row['HS'], 0.515, delta=0.006)
+            self.assertLess(row['TA'], 273.15)
+            # Same with the stations requested together
+            os.remove('TEST.smet')
+            with patch('mesowest_fetch.requests.Session.get', side_effect=self.fake_get):
+                mesowest_to_smet_stations('202410050000', '202410060000', ['TEST'], incremental=True, cachedir=None)
+                mesowest_to_smet_stations('202410050000', '202410072300', ['TEST'], incremental=True, cachedir=None)
+            with open('TEST.smet') as f:
+                self.assertEqual(f.read(), full)
+
+    def test_without_qc(self):
+        i = self.times.index(datetime(2024, 10, 5, 15))
+        self.overrides = {('snow_depth_set_1', i): None, ('air_temp_set_1', i): 20.0}
+        with patch('mesowest_fetch.requests.Session.get', side_effect=self.fake_get):
+            mesowest_to_smet('202410050000', '202410072300', 'TEST', False, False, cachedir=None, qc=False)
+            # The values as received
+            header, smet = read_smet('TEST.smet', nodata_to_nan=False)
+            self.assertEqual((smet['HS'][i], smet['TA'][i]), (-999., 293.15))
+            with open('TEST.smet') as f:
+                raw = f.read()
+            self.assertEqual(mesowest_to_smet_stations('202410050000', '202410072300', ['TEST'], cachedir=None,
+                                                       qc=False), (['TEST'], {}))
+            with open('TEST.smet') as f:
+                self.assertEqual(f.read(), raw)
+            mesowest_to_smet('202410050000', '202410072300', 'TEST', False, False, cachedir=None)
+            with open('TEST.smet') as f:
+                self.assertNotEqual(f.read(), raw)
+
+    def test_incremental_fields_changed_without_new_rows(self):
+        with patch('mesowest_fetch.requests.Session.get', side_effect=self.fake_get):
+            mesowest_to_smet('202410050000', '202410072300', 'TEST', False, False, True, cachedir=None)
+        # The station stopped reporting the surface temperature, nothing new since the last run
+        def without_tss(url, timeout=None):
+            response = self.fake_get(url, timeout)
+            del response.json.return_value['STATION'][0]['OBSERVATIONS']['surface_temp_set_1']
+            return response
+        with patch('mesowest_fetch.requests.Session.get', side_effect=without_tss) as mock_get:
+            mesowest_to_smet('202410050000', '202410072300', 'TEST', False, False, True, cachedir=None)
+        self.assertIn('start=202410050000&end=202410072300', mock_get.call_args.args[0])
+        header, smet = read_smet('TEST.smet')
+        self.assertNotIn('TSS', header['fields'])
+        self.assertEqual(len(smet), 72)
+
+    def test_no_observations(self):
+        self.times = []
+        with patch('mesowest_fetch.requests.Session.get', side_effect=self.fake_get):
+            with self.assertRaisesRegex(ValueError, 'No Mesowest observations for TEST'):
+                mesowest_to_smet('202410050000', '202410072300', 'TEST', False, False, True)
+        self.assertFalse(os.path.exists('TEST.smet'))
+
+
+class TestForecastAppend(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        server = LocalMesowestServer().__enter__()
+        self.addCleanup(server.__exit__)
+        patcher = patch.object(mesowest_fetch, 'MESOWEST_API_URL', server.api_url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    # Stand-in for the HRRR point forecasts, 48 forecast hours per site handed to on_hour one by one
+    @staticmethod
+    def fake_forecast_sites(forecast_start_time, sites, maxprocesses=10, on_hour=None, fail_after=None):
+        cycle = forecast_start_time.strftime('%Y%m%d%H')
+        fhr = np.arange(49)
+        table = {column: np.full(49, 1.) for column in hrrr_snowpack_1_4.COLUMNS}
+        table.update({'INIT (YYYYMMDDHH UTC)': [cycle]*49, 'FHR': fhr, 'T2m (K)': 260. + fhr, 'RH2m (%)': 50.,
+                      'TSFC (K)': 250. + fhr, 'Wind Speed 10m (m/s)': 3., 'Wind Direction 10 m (deg)': 200.,
+                      'Downward Short Wave (W/m2)': 100. - 5*fhr, 'Snowfall (cm)': 7.})
+        table = pd.DataFrame(table)
+        for hour in fhr:
+            if hour == fail_after:
+                raise RuntimeError('F'+str(hour).zfill(2)+' not available')
+            if on_hour is not None:
+                on_hour(hour, {site.stid: table.iloc[hour:hour+1] for site in sites})
+        return {site.stid: table for site in sites}
+
+    def test_forecast_fetched_once(self):
+        with patch('hrrr_snowpack_1_4.get_hrrr_forecast_sites', side_effect=self.fake_forecast_sites) as mock_sites:
+            mesowest_to_smet('202410050000', '202410072300', 'ATH20', False, True)
+        self.assertEqual(mock_sites.call_count, 1)
+        self.assertEqual(mock_sites.call_args.args[0], datetime(2024, 10, 7, 22))
+        self.assertIsNotNone(mock_sites.call_args.kwargs['on_hour'])
+
+        # Forecast rows from the hour after the last observation to the end of the cycle, by field name
+        header, df = read_smet('ATH20.smet', nodata_to_nan=False)
+        self.assertEqual(read_smet_obs_end('ATH20.smet')[1], '2024-10-07T23:00:00')
+        forecast = df[df['timestamp'] > np.datetime64('2024-10-07T23:00:00')]
+        self.assertEqual(len(forecast), 47)
+        self.assertEqual(forecast['timestamp'].iloc[0], np.datetime64('2024-10-08T00:00:00'))
+        self.assertEqual(list(forecast['TA'][0:2]), [262., 263.])
+        self.assertEqual(list(forecast['TSS'][0:2]), [252., 253.])
+        self.assertEqual(forecast['RH'].iloc[0], 0.5)
+        self.assertEqual(forecast['TSG'].iloc[0], 273.15)
+        self.assertTrue((forecast['HS'] == -999).all())
+        self.assertEqual(forecast['ISWR'].iloc[-1], 0.)
+        with open('smet_end_datetime.dat') as f:
+            self.assertEqual(f.read().split('\n')[0:4], ['end_year = 2024', 'end_month = 10', 'end_day = 09',
+                                                          'end_hour = 22'])
+
+        # The next incremental run replaces the forecast rows
+        with patch('hrrr_snowpack_1_4.get_hrrr_forecast_sites', side_effect=self.fake_forecast_sites):
+            mesowest_to_smet('202410050000', '202410080500', 'ATH20', False, True, True)
+        header, df = read_smet('ATH20.smet', nodata_to_nan=False)
+        self.assertTrue((np.diff(df['timestamp'].to_numpy()) == np.timedelta64(1, 'h')).all())
+        self.assertEqual(df['timestamp'].iloc[-1], np.datetime64('2024-10-10T04:00:00'))
+
+    def test_forecast_failure_not_retried(self):
+        with patch('hrrr_snowpack_1_4.get_hrrr_forecast_sites', side_effect=RuntimeError('no cycle')) as mock_sites:
+            mesowest_to_smet('202410050000', '202410072300', 'ATH20', False, True)
+        self.assertEqual(mock_sites.call_count, 1)
+        header, df = read_smet('ATH20.smet')
+        self.assertEqual(df['timestamp'].iloc[-1], np.datetime64('2024-10-07T23:00:00'))
+
+    def test_forecast_streamed(self):
+        # Each forecast hour is in the files as soon as it is handed over
+        seen = []
+        def fake_forecast_sites(forecast_start_time, sites, maxprocesses=10, on_hour=None):
+            def check(fhr, tables):
+                on_hour(fhr, tables)
+                # The first hours are valid before the last observation
+                if os.path.exists('smet_end_datetime.dat'):
+                    with open('smet_end_datetime.dat') as f:
+                        seen.append((fhr, read_last_line('ATH20.smet')[:19], f.read().split('\n')[3]))
+            return self.fake_forecast_sites(forecast_start_time, sites, maxprocesses, check)
+        with patch('hrrr_snowpack_1_4.get_hrrr_forecast_sites', side_effect=fake_forecast_sites):
+            mesowest_to_smet('202410050000', '202410072300', 'ATH20', False, True)
+        self.assertIn((18, '2024-10-08T16:00:00', 'end_hour = 16'), seen)
+        self.assertEqual(seen[-1], (48, '2024-10-09T22:00:00', 'end_hour = 22'))
+
+        # A cycle failing part way leaves the hours written before it, still usable
+        os.remove('ATH20.smet')
+        with patch('hrrr_snowpack_1_4.get_hrrr_forecast_sites',
+                   side_effect=lambda *args, **kwargs: self.fake_forecast_sites(*args, **kwargs, fail_after=19)):
+            mesowest_to_smet('202410050000', '202410072300', 'ATH20', False, True)
+        header, df = read_smet('ATH20.smet', nodata_to_nan=False)
+        self.assertEqual(df['timestamp'].iloc[-1], np.datetime64('2024-10-08T16:00:00'))
+        self.assertTrue((np.diff(df['timestamp'].to_numpy()) == np.timedelta64(1, 'h')).all())
+        with open('smet_end_datetime.dat') as f:
+            self.assertIn('end_hour = 16\n', f.read())
+
+    def test_stations_share_cycle(self):
+        stids = ['ATH20', 'UKALF', 'ST003']
+        with patch('hrrr_snowpack_1_4.get_hrrr_forecast_sites', side_effect=self.fake_forecast_sites) as mock_sites:
+            written, failures = mesowest_to_smet_stations('202410050000', '202410072300', stids, forecast_bool=True)
+        self.assertEqual((written, failures), (stids, {}))
+        self.assertEqual(mock_sites.call_count, 1)
+        self.assertEqual([site.stid for site in mock_sites.call_args.args[1]], stids)
+        for stid in stids:
+            header, df = read_smet(stid+'.smet', nodata_to_nan=False)
+            self.assertEqual(df['timestamp'].iloc[-1], np.datetime64('2024-10-09T22:00:00'))
+            self.assertEqual(df['TA'].iloc[-1], 308.)
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,85 @@
+import unittest
+import numpy as np
+from mesowest_transform import (NODATA, OBSERVATION_TRANSFORMS, parse_timestamps, transform_observations,
+                                transform_forecast)
+
+
+class TestTransformObservations(unittest.TestCase):
+
+    def setUp(self):
+        self.observations = {
+            "date_time": ["2024-10-05T00:00:00Z", "2024-10-05T01:00:00Z", "2024-10-05T02:00:00Z"],
+            "air_temp_set_1": [20.0, -1.5, None],
+            "relative_humidity_set_1": [50.0, 55, 99.9],
+            "wind_speed_set_1": [5.0, None, 6.1],
+            "wind_direction_set_1": [180, 190, None],
+            "snow_depth_set_1": [100.0, 110.0, 0.0],
+            "solar_radiation_set_1": [200.0, -3.2, -150.0],
+            "incoming_radiation_lw_set_1": [None, -100.0, -99.9],
+        }
+
+    def test_transforms(self):
+        timestamps, columns = transform_observations(self.observations)
+        self.assertEqual(list(columns), ['TA', 'RH', 'TSG', 'HS', 'VW', 'DW', 'ISWR', 'ILWR'])
+        np.testing.assert_array_equal(timestamps, np.array(['2024-10-05T00', '2024-10-05T01', '2024-10-05T02'],
+                                                           dtype='datetime64[s]'))
+        np.testing.assert_array_equal(columns['TA'], [20.0 + 273.15, -1.5 + 273.15, NODATA])
+        np.testing.assert_array_equal(columns['RH'], [0.5, 0.55, 99.9/100.0])
+        np.testing.assert_array_equal(columns['TSG'], [273.15]*3)
+        np.testing.assert_array_equal(columns['HS'], [0.1, 0.11, 0.])
+        np.testing.assert_array_equal(columns['VW'], [5.0, NODATA, 6.1])
+        np.testing.assert_array_equal(columns['DW'], [180, 190, NODATA])
+        # Small negative radiation is clipped to 0, -100 and below is missing
+        np.testing.assert_array_equal(columns['ISWR'], [200.0, 0, NODATA])
+        np.testing.assert_array_equal(columns['ILWR'], [NODATA, NODATA, 0])
+
+    def test_matches_list_comprehensions(self):
+        rng = np.random.default_rng(0)
+        values = rng.uniform(-200., 1200., 500).round(2).tolist()
+        values[::7] = [None]*len(values[::7])
+        observations = dict(self.observations, solar_radiation_set_1=values,
+                            date_time=[str(t)+'Z' for t in np.datetime64('2024-10-05T00:00:00')
+                                       + np.arange(500)*np.timedelta64(1, 'h')])
+        for name in ('air_temp_set_1', 'relative_humidity_set_1', 'snow_depth_set_1'):
+            observations[name] = rng.uniform(-50., 3000., 500).round(1).tolist()
+        del observations['wind_speed_set_1'], observations['wind_direction_set_1'], observations['incoming_radiation_lw_set_1']
+        transforms = {field: OBSERVATION_TRANSFORMS[field] for field in ('TA', 'RH', 'HS', 'ISWR')}
+        timestamps, columns = transform_observations(observations, transforms)
+
+        # What mesowest_to_smet did before
+        ISWR = [-999 if val is None else val for val in values]
+        ISWR = [0 if 0 > val > -100 else val for val in ISWR]
+        ISWR = [val if val > -100 else -999 for val in ISWR]
+        expected = {'TA': [temp + 273.15 for temp in observations['air_temp_set_1']],
+                    'RH': [rh / 100.0 for rh in observations['relative_humidity_set_1']],
+                    'HS': [depth / 1000.0 for depth in observations['snow_depth_set_1']],
+                    'ISWR': ISWR}
+        for field, column in columns.items():
+            self.assertEqual([f'{val:.2f}' for val in column], [f'{val:.2f}' for val in expected[field]])
+        self.assertEqual(list(np.datetime_as_string(timestamps, unit='s')),
+                         [dt[0:19] for dt in observations['date_time']])
+
+    def test_missing_required_variable(self):
+        del self.observations['snow_depth_set_1']
+        with self.assertRaises(KeyError):
+            transform_observations(self.observations)
+
+    def test_parse_timestamps(self):
+        timestamps = parse_timestamps(["2024-10-05T00:15:30Z"])
+        self.assertEqual(timestamps.dtype, np.dtype('datetime64[s]'))
+        self.assertEqual(str(timestamps[0]), '2024-10-05T00:15:30')
+
+    def test_transform_forecast(self):
+        # A gap filled from the previous cycle keeps its own INIT and FHR
+        forecast = {'INIT (YYYYMMDDHH UTC)': ['2024031803', '2024031803', '2024031802'], 'FHR': [0, 1, 3],
+                    'T2m (K)': [270.0, 271.0, np.nan], 'RH2m (%)': [50.0, 60.0, 70.0], 'TSFC (K)': [265.0, 266.0, 267.0],
+                    'Downward Short Wave (W/m2)': [10.0, -1.0, 3.0]}
+        timestamps, columns = transform_forecast(forecast, ['TA', 'RH', 'TSG', 'HS', 'TSS', 'ISWR'],
+                                                 np.datetime64('2024-03-18T03:00:00'))
+        self.assertEqual([str(t) for t in timestamps], ['2024-03-18T04:00:00', '2024-03-18T05:00:00'])
+        self.assertEqual([list(values) for values in columns],
+                         [[271.0, NODATA], [0.6, 0.7], [273.15, 273.15], [NODATA, NODATA], [266.0, 267.0], [0.0, 3.0]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from datetime import timedelta
+from unittest.mock import patch
+import mesowest_fetch
+from mesowest_transform import NODATA
+from mesowest_to_smet_forecast import mesowest_to_smet
+from observation_qc import qc_series, qc_observations, qc_blocks, format_qc_report
+from offline_fixtures import LocalMesowestServer
+from smet_io import read_smet
+
+
+class TestObservationQC(unittest.TestCase):
+
+    def setUp(self):
+        self.timestamps = np.datetime64('2024-10-05T00:00:00') + np.arange(12)*np.timedelta64(1, 'h')
+
+    def test_gap_filling(self):
+        values = np.array([NODATA, 1., NODATA, NODATA, 4., NODATA, NODATA, NODATA, 8., 9., np.nan, NODATA])
+        filled, flags = qc_series(self.timestamps, values, {'max_gap': 2})
+        # Runs of at most 2 between valid values only, not at the ends
+        np.testing.assert_array_equal(filled, [NODATA, 1., 2., 3., 4., NODATA, NODATA, NODATA, 8., 9., np.nan, NODATA])
+        self.assertEqual(list(np.flatnonzero(flags['filled'])), [2, 3])
+        # Interpolated in time
+        timestamps = self.timestamps.copy()
+        timestamps[4:] += np.timedelta64(3, 'h')
+        filled, flags = qc_series(timestamps, values, {'max_gap': 2})
+        self.assertEqual(list(filled[1:5]), [1., 1.5, 2., 4.])
+
+    def test_rate_limit_and_despike(self):
+        HS = np.array([1., 1.01, 1.02, 1.6, 1.03, 1.04, 1.5, 1.5, 1.51, NODATA, 1.52, 1.53])
+        checked, flags = qc_series(self.timestamps, HS, {'max_gap': 6, 'despike': 0.2, 'max_rate': 0.15})
+        np.testing.assert_allclose(checked, [1., 1.01, 1.02, 1.025, 1.03, 1.04, 1.27, 1.5, 1.51, 1.515, 1.52, 1.53])
+        self.assertEqual(list(np.flatnonzero(flags['despiked'])), [3])
+        self.assertEqual(list(np.flatnonzero(flags['rate_limited'])), [6])
+        self.assertEqual(list(np.flatnonzero(flags['filled'])), [6, 9])
+
+    def test_blocks_match_whole_record(self):
+        rng = np.random.default_rng(1)
+        for trial in range(50):
+            n = int(rng.integers(1, 400))
+            timestamps = np.datetime64('2024-10-05T00:00:00') + np.cumsum(rng.integers(1, 3, n))*np.timedelta64(1, 'h')
+            columns = {'HS': np.cumsum(rng.normal(0., 0.1, n)), 'TA': rng.normal(270., 8., n), 'VW': rng.normal(0., 1., n)}
+            for values in columns.values():
+                values[rng.random(n) < rng.uniform(0., 0.5)] = NODATA
+            whole, flags = qc_observations(timestamps, columns)
+            bounds = [0] + sorted(rng.choice(np.arange(1, n+1), size=min(n, int(rng.integers(0, 20))), replace=False)) + [n]
+            report = {}
+            blocks = list(qc_blocks([(timestamps[a:b], {field: values[a:b] for field, values in columns.items()})
+                                     for a, b in zip(bounds[:-1], bounds[1:])], report=report))
+            np.testing.assert_array_equal(np.concatenate([block[0] for block in blocks]), timestamps)
+            for field in columns:
+                np.testing.assert_array_equal(np.concatenate([block[1][field] for block in blocks]), whole[field])
+            self.assertEqual(report['HS']['filled'], flags['HS']['filled'].sum())
+        self.assertIn('QC HS: ', format_qc_report(report))
+
+
+class TestObservationQCSmet(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        server = LocalMesowestServer().__enter__()
+        self.addCleanup(server.__exit__)
+        patcher = patch.object(mesowest_fetch, 'MESOWEST_API_URL', server.api_url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def test_incremental_run_ends_in_gap(self):
+        # The stand-in has no snow depth every 53rd hour (since 1970), end the first run on one of them
+        hour = np.datetime64('2024-10-06T00', 'h')
+        hour += np.timedelta64(-int(hour.astype('int64')) % 53, 'h')
+        end = hour.astype(object)
+        mesowest_to_smet('202410050000', end.strftime('%Y%m%d%H%M'), 'ATH20', False, False)
+        header, df = read_smet('ATH20.smet', nodata_to_nan=False)
+        self.assertEqual(df['HS'].iloc[-1], NODATA)
+
+        later = (end + timedelta(hours=30)).strftime('%Y%m%d%H%M')
+        mesowest_to_smet('202410050000', later, 'ATH20', False, False, True)
+        with open('ATH20.smet') as f:
+            incremental = f.read()
+        mesowest_to_smet('202410050000', later, 'ATH20', False, False)
+        with open('ATH20.smet') as f:
+            self.assertEqual(incremental, f.read())
+        header, df = read_smet('ATH20.smet', nodata_to_nan=False)
+        self.assertFalse((df['HS'] == NODATA).any())
+
+
+if __name__ == '__main__':
+    unittest.main()
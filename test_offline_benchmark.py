@@ -0,0 +1,63 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import hrrr_fetch
+import mesowest_fetch
+from offline_benchmark import BENCHMARKS, run_benchmarks, write_results, save_baseline, compare_to_baseline
+
+
+class TestOfflineBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def test_run_and_compare(self):
+        endpoint, api_url = hrrr_fetch.HRRR_S3_ENDPOINT_URL, mesowest_fetch.MESOWEST_API_URL
+        names = ['processhrrr', 'mesowest_to_smet', 'mesowest_to_smet_incremental']
+        results = run_benchmarks('small', repeat=2, benchmarks=names, season_days=10)
+        # The stand-ins are only used during the run
+        self.assertEqual((hrrr_fetch.HRRR_S3_ENDPOINT_URL, mesowest_fetch.MESOWEST_API_URL), (endpoint, api_url))
+        self.assertEqual([result['benchmark'] for result in results], names)
+        for result in results:
+            self.assertEqual(len(result['runs']), 2)
+            self.assertEqual(result['seconds'], min(result['runs']))
+            self.assertEqual(result['params']['season_days'], 10)
+        # Per-stage totals of the best run
+        self.assertIn('slr', results[0]['timing']['hrrr_decode']['stages'])
+        self.assertEqual(results[2]['timing']['mesowest_to_smet']['units'], 1)
+
+        write_results(results, 'results.jsonl')
+        write_results(results, 'results.jsonl')
+        with open('results.jsonl') as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(len(lines), 6)
+        self.assertIn('commit', lines[0])
+
+        # No baseline, no regressions
+        self.assertEqual(compare_to_baseline(results, 'baseline.json'), [])
+        save_baseline(results, 'baseline.json')
+        self.assertEqual(compare_to_baseline(results, 'baseline.json'), [])
+        slower = [dict(result, seconds=result['seconds']*2) for result in results[:1]]
+        self.assertEqual(compare_to_baseline(slower, 'baseline.json', tolerance=0.5),
+                         [('processhrrr@small', slower[0]['seconds'], results[0]['seconds'])])
+        with open('baseline.json') as f:
+            self.assertEqual(sorted(json.load(f)), sorted(name+'@small' for name in names))
+
+    def test_unknown_benchmark(self):
+        with self.assertRaises(ValueError):
+            run_benchmarks('small', benchmarks=['processhrrr', 'nothing'])
+        with self.assertRaises(ValueError):
+            run_benchmarks('small', fhrs=7)
+        self.assertEqual(len(BENCHMARKS), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import os
+import time
+import numpy as np
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+import mesowest_fetch
+import pipeline_timing
+from pipeline_timing import stage, add_bytes, timed, timed_unit, read_timing_log, summarize_timing_log
+from mesowest_to_smet_forecast import mesowest_to_smet
+from offline_fixtures import LocalMesowestServer
+
+
+@timed_unit('square', lambda x: {'x': x})
+def square(x):
+    with stage('multiply'):
+        return x*x
+
+
+class TestPipelineTiming(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        self.logfile = os.path.join(self.tmpdir, 'timing.jsonl')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def test_units_and_stages(self):
+        with timed('outer', self.logfile, cycle='2024031803') as record:
+            with stage('fetch', 100):
+                time.sleep(0.01)
+            add_bytes('fetch', 50)
+            with timed('inner', self.logfile, fhr=1):
+                with stage('decode'):
+                    pass
+            record['rows'] = 3
+        with self.assertRaises(KeyError):
+            with timed('failing', self.logfile):
+                raise KeyError('x')
+
+        inner, outer, failing = read_timing_log(self.logfile)
+        self.assertEqual((inner['event'], inner['fhr']), ('inner', 1))
+        self.assertEqual(list(inner['stages']), ['decode'])
+        # The stages of a unit also count for the one around it
+        self.assertEqual(outer['stages']['fetch']['bytes'], 150)
+        self.assertEqual(outer['stages']['fetch']['calls'], 1)
+        self.assertGreaterEqual(outer['stages']['fetch']['seconds'], 0.01)
+        self.assertEqual(outer['stages']['decode']['calls'], 1)
+        self.assertEqual((outer['cycle'], outer['rows'], outer['pid']), ('2024031803', 3, os.getpid()))
+        self.assertGreater(outer['rss_mb'], 0)
+        self.assertEqual(failing['error'], "KeyError: 'x'")
+
+        summary = summarize_timing_log(self.logfile)
+        self.assertEqual(summary['outer']['units'], 1)
+        self.assertEqual(summary['inner']['stages']['decode']['calls'], 1)
+
+    def test_memory_per_unit(self):
+        with timed('allocating', self.logfile):
+            values = np.ones(100*1024*1024//8)
+        del values
+        with timed('idle', self.logfile):
+            pass
+        allocating, idle = read_timing_log(self.logfile)
+        self.assertGreater(allocating['rss_growth_mb'], 90)
+        self.assertGreaterEqual(allocating['rss_mb'], allocating['rss_growth_mb'])
+        # The process peak is not charged to a unit that did not raise it
+        self.assertEqual(idle['maxrss_growth_mb'], 0)
+        self.assertLess(abs(idle['rss_growth_mb']), 5)
+        summary = summarize_timing_log(self.logfile)
+        self.assertEqual(summary['allocating']['max_rss_growth_mb'], allocating['rss_growth_mb'])
+        self.assertEqual(summary['idle']['max_maxrss_growth_mb'], 0)
+
+    def test_threads_and_no_log(self):
+        # Units of other threads are kept apart
+        with patch.object(pipeline_timing, 'TIMING_LOG', self.logfile):
+            threads = [threading.Thread(target=square, args=(x,)) for x in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        records = read_timing_log(self.logfile)
+        self.assertEqual(sorted(record['x'] for record in records), [0, 1, 2, 3])
+        self.assertTrue(all(record['stages']['multiply']['calls'] == 1 for record in records))
+        # Without a log file nothing is written
+        os.remove(self.logfile)
+        self.assertEqual(square(3), 9)
+        self.assertFalse(os.path.exists(self.logfile))
+
+    def test_profile(self):
+        with patch.object(pipeline_timing, 'TIMING_PROFILE_DIR', os.path.join(self.tmpdir, 'profiles')):
+            with timed('profiled', profile='cprofile', fhr=2):
+                sum(range(1000))
+            with self.assertRaises(ValueError):
+                with timed('profiled', profile='perf'):
+                    pass
+        self.assertEqual(os.listdir('profiles'), ['profiled_2_'+str(os.getpid())+'.prof'])
+
+    def test_mesowest_to_smet(self):
+        with LocalMesowestServer() as server, patch.object(mesowest_fetch, 'MESOWEST_API_URL', server.api_url), \
+                patch.object(pipeline_timing, 'TIMING_LOG', self.logfile):
+            mesowest_to_smet('202410050000', '202410150000', 'ATH20', False, False, cachedir=None)
+        record, = read_timing_log(self.logfile)
+        self.assertEqual((record['event'], record['stid']), ('mesowest_to_smet', 'ATH20'))
+        for name in ('mesowest_fetch', 'mesowest_transform', 'qc', 'smet_write'):
+            self.assertIn(name, record['stages'])
+        self.assertGreater(record['stages']['mesowest_fetch']['bytes'], 0)
+        self.assertGreater(record['stages']['smet_write']['bytes'], os.path.getsize('ATH20.smet')/2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from smet_io import (format_smet_header, format_smet_rows, write_smet, write_smet_rows, read_smet, read_smet_header,
+                     read_last_line, read_last_timestamp, read_smet_obs_end, write_smet_obs_end, find_row_offset)
+
+
+class TestSmetIO(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.smetfile = os.path.join(self.tmpdir, 'TEST.smet')
+        self.header = {'station_id': 'TEST', 'station_name': 'Test Station', 'latitude': 40.0, 'longitude': -111.0,
+                       'altitude': 1524.0, 'nodata': -999, 'tz': 1, 'source': 'Utah Avalanche Center - Synoptic Data'}
+        self.timestamps = np.datetime64('2024-10-05T00:00:00') + np.arange(100)*np.timedelta64(1, 'h')
+        rng = np.random.default_rng(0)
+        self.columns = {'TA': rng.normal(270., 5., 100), 'RH': rng.uniform(0., 1., 100),
+                        'ISWR': np.where(np.arange(100) % 9 == 0, -999, rng.uniform(0., 900., 100))}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_format_matches_fstrings(self):
+        self.assertEqual(format_smet_header(dict(self.header, fields=['timestamp', 'TA'])).splitlines(),
+                         ['SMET 1.1 ASCII', '[HEADER]', 'station_id       = TEST', 'station_name     = Test Station',
+                          'latitude         = 40.0', 'longitude        = -111.0', 'altitude         = 1524.0',
+                          'nodata           = -999', 'tz               = 1',
+                          'source           = Utah Avalanche Center - Synoptic Data', 'fields           = timestamp TA',
+                          '[DATA]'])
+        columns = list(self.columns.values())
+        iso_dates = [str(t) for t in self.timestamps]
+        expected = ''.join(f'{iso_dates[i]} {columns[0][i]:.2f} {columns[1][i]:.2f} {columns[2][i]:.2f}\n'
+                           for i in range(100))
+        self.assertEqual(format_smet_rows(self.timestamps, columns), expected)
+        self.assertEqual(format_smet_rows(np.array(iso_dates), [list(c) for c in columns]), expected)
+
+    def test_roundtrip(self):
+        write_smet(self.smetfile, self.header, self.timestamps, self.columns)
+        header, df = read_smet(self.smetfile)
+        self.assertEqual(header['fields'], ['timestamp', 'TA', 'RH', 'ISWR'])
+        self.assertEqual(header['station_name'], 'Test Station')
+        np.testing.assert_array_equal(df['timestamp'].to_numpy(), self.timestamps)
+        np.testing.assert_allclose(df['TA'], self.columns['TA'], atol=0.005)
+        # nodata comes back as NaN
+        self.assertTrue(np.isnan(df['ISWR'][::9]).all())
+        self.assertFalse(np.isnan(df['ISWR'][1::9]).any())
+
+        header, timestamps, columns = read_smet(self.smetfile, as_frame=False, nodata_to_nan=False)
+        np.testing.assert_array_equal(timestamps, self.timestamps)
+        np.testing.assert_array_equal(columns['ISWR'][::9], -999)
+
+    def test_header_and_last_timestamp(self):
+        write_smet(self.smetfile, self.header, self.timestamps[:0], {field: [] for field in self.columns})
+        header, data_offset = read_smet_header(self.smetfile)
+        self.assertEqual(data_offset, os.path.getsize(self.smetfile))
+        self.assertIsNone(read_last_timestamp(self.smetfile))
+
+        with open(self.smetfile, 'a') as fileID:
+            write_smet_rows(fileID, self.timestamps, list(self.columns.values()), block=7)
+        self.assertEqual(read_last_timestamp(self.smetfile), self.timestamps[-1])
+        self.assertEqual(read_smet_header(self.smetfile), (header, data_offset))
+        self.assertEqual(len(read_smet(self.smetfile)[1]), 100)
+
+    def test_obs_end(self):
+        self.assertIsNone(read_smet_obs_end(self.smetfile))
+        write_smet(self.smetfile, self.header, self.timestamps, self.columns)
+        write_smet_obs_end(self.smetfile)
+        size = os.path.getsize(self.smetfile)
+        with open(self.smetfile, 'a') as fileID:
+            write_smet_rows(fileID, self.timestamps[-1:] + np.timedelta64(1, 'h'), [[1.], [2.], [3.]])
+        self.assertEqual(read_smet_obs_end(self.smetfile), (size, '2024-10-09T03:00:00'))
+        self.assertEqual(read_last_timestamp(self.smetfile), np.datetime64('2024-10-09T04:00:00'))
+        # A file rewritten without updating the sidecar
+        write_smet(self.smetfile, self.header, self.timestamps[:10], self.columns)
+        self.assertIsNone(read_smet_obs_end(self.smetfile))
+
+    def test_read_last_line(self):
+        with open(self.smetfile, 'w') as f:
+            f.write(''.join(str(i)+'\n' for i in range(1000)))
+        self.assertEqual(read_last_line(self.smetfile), '999')
+        self.assertEqual(read_last_line(self.smetfile, blocksize=3), '999')
+        self.assertEqual(read_last_line(self.smetfile, end=4), '1')
+
+    def test_find_row_offset(self):
+        write_smet(self.smetfile, self.header, self.timestamps, self.columns)
+        with open(self.smetfile, 'rb') as f:
+            data = f.read()
+        for blocksize in (64, 4096):
+            for i in (0, 1, 50, 99):
+                for timestamp in (self.timestamps[i], self.timestamps[i] - np.timedelta64(30, 'm')):
+                    offset = find_row_offset(self.smetfile, timestamp, blocksize=blocksize)
+                    self.assertEqual(data[offset:offset+19].decode(), str(self.timestamps[i]))
+        self.assertEqual(find_row_offset(self.smetfile, self.timestamps[-1] + 1), len(data))
+        # Only the rows before end
+        end = find_row_offset(self.smetfile, self.timestamps[60])
+        self.assertEqual(find_row_offset(self.smetfile, self.timestamps[80], end), end)
+        offset = find_row_offset(self.smetfile, self.timestamps[30], end, blocksize=64)
+        self.assertEqual(data[offset:offset+19].decode(), str(self.timestamps[30]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+import numpy as np
+from mesowest_transform import NODATA
+from station_corrections import STATION_CORRECTIONS, station_corrections, apply_corrections
+
+
+class TestStationCorrections(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.start = np.datetime64('2024-10-05T00:00:00')
+        self.n = 5088
+        self.timestamps = self.start + np.arange(self.n)*np.timedelta64(1, 'h')
+        self.HS = rng.uniform(0.5, 3., self.n)
+        self.HS[[100, 3000]] = NODATA
+        self.ISWR = rng.normal(100., 200., self.n)
+
+    def test_matches_index_patches(self):
+        # The patches of pre_processing/mesowest_to_smet.py for a season starting on 2024-10-05
+        HS = list(self.HS)
+        HS[:450] = np.zeros(450)
+        HS[4196] = HS[4195]
+        HS[4323] = HS[4322]
+        HS[4197:4262] = [depth - 2 for depth in HS[4197:4262]]
+        ISWR = [max(value, 0) for value in self.ISWR]
+
+        columns = apply_corrections(self.timestamps, {'HS': self.HS, 'ISWR': self.ISWR}, station_corrections('ATH20'),
+                                    verbose=False)
+        np.testing.assert_array_equal(columns['HS'], HS)
+        np.testing.assert_array_equal(columns['ISWR'], ISWR)
+        # The input is not modified
+        self.assertLess(self.ISWR.min(), 0)
+
+    def test_window_shift(self):
+        whole = apply_corrections(self.timestamps, {'HS': self.HS}, station_corrections('ATH20'), verbose=False)['HS']
+        # A window starting later, the same observations are corrected
+        shifted = apply_corrections(self.timestamps[300:], {'HS': self.HS[300:]}, station_corrections('ATH20'),
+                                    verbose=False)['HS']
+        np.testing.assert_array_equal(shifted, whole[300:])
+        # Other stations only get the corrections of every station
+        other = apply_corrections(self.timestamps, {'HS': self.HS}, station_corrections('UKALF'), verbose=False)['HS']
+        np.testing.assert_array_equal(other, self.HS)
+
+    def test_actions(self):
+        timestamps = self.start + np.arange(8)*np.timedelta64(1, 'h')
+        values = np.array([1., 2., NODATA, 9., 3., 4., 5., -6.])
+        def correct(**correction):
+            return list(apply_corrections(timestamps, {'X': values}, [dict(correction, field='X')], verbose=False)['X'])
+        self.assertEqual(correct(action='hold', start='2024-10-05T02:00:00', end='2024-10-05T03:00:00'),
+                         [1., 2., 2., 2., 3., 4., 5., -6.])
+        self.assertEqual(correct(action='offset', value=1, start='2024-10-05T01:00:00', end='2024-10-05T03:00:00'),
+                         [1., 3., NODATA, 10., 3., 4., 5., -6.])
+        self.assertEqual(correct(action='clip', min=0, max=5),
+                         [1., 2., NODATA, 5., 3., 4., 5., 0.])
+        self.assertEqual(correct(action='zero', end='2024-10-05T01:00:00'),
+                         [0., 0., NODATA, 9., 3., 4., 5., -6.])
+        # Only the spike with valid neighbours
+        self.assertEqual(correct(action='despike', value=4),
+                         [1., 2., NODATA, 9., 3., 4., 5., -6.])
+        values[2] = 2.5
+        self.assertEqual(correct(action='despike', value=4),
+                         [1., 2., 2.5, 2.75, 3., 4., 5., -6.])
+        with self.assertRaises(ValueError):
+            correct(action='smooth')
+
+    def test_table(self):
+        for stid, corrections in STATION_CORRECTIONS.items():
+            for correction in corrections:
+                self.assertIn(correction['action'], ('zero', 'hold', 'offset', 'clip', 'despike'))
+
+
+if __name__ == '__main__':
+    unittest.main()